@@ -1,9 +1,9 @@
 import datetime
+from decimal import Decimal
 
 import pytz
 
-from django.db import models
-from django.db.models import F
+from django.db import connection, models
 from django.utils.translation import ugettext_lazy as _
 
 from smart_selects.db_fields import ChainedForeignKey
@@ -12,6 +12,10 @@ from tracpro.groups.models import Region
 from tracpro.polls.models import Answer, Question, Poll, Response
 
 
+# Answer values that can be cast to numeric.
+NUMERIC_VALUE_RE = r'^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$'
+
+
 class BaselineTerm(models.Model):
     # e.g., 2015 Term 3 Attendance for P3 Girls
     # A term of time to gather statistics for a baseline chart
@@ -59,10 +63,10 @@ class BaselineTerm(models.Model):
         baseline_terms = cls.objects.filter(org=org)
         return baseline_terms
 
-    def _get_answers(self, question, poll, regions, region_selected=None):
+    def _get_responses(self, poll, regions, region_selected=None):
         """
-        Retrieve answers to the question that are relevant for this
-        BaselineTerm.
+        Retrieve responses to the poll that are relevant for this
+        BaselineTerm, and the regions they are from.
         """
         midnight = datetime.time(0, 0, 0, tzinfo=pytz.utc)
         start = datetime.datetime.combine(self.start_date, midnight)
@@ -73,45 +77,98 @@ class BaselineTerm(models.Model):
             pollrun__conducted_on__gte=start,
             pollrun__conducted_on__lt=end)
 
-        region_filter = Region.objects.all()
-        all_regions = Region.objects.filter(id__in=responses.values_list('contact__region', flat=True))
+        all_regions = Region.objects.filter(id__in=responses.values('region'))
         if regions:
-            region_filter = regions
             all_regions = regions
-        if region_selected:
-            region_filter = Region.objects.filter(pk=region_selected)
-
-        responses = responses.filter(contact__region__in=region_filter)
 
-        answers = Answer.objects.filter(response__in=responses, question=question)
-        answers = answers.annotate(region_name=F('response__contact__region__name'))
-        answers = answers.select_related('response', 'response__contact')
+        if region_selected:
+            responses = responses.filter(region=region_selected)
+        elif regions:
+            responses = responses.filter(region__in=regions)
+        else:
+            responses = responses.filter(region__isnull=False)
 
-        response_rate = 0
-        if responses.count():
-            response_rate = round(float(answers.count())/float(responses.count()) * 100, 1)
+        return responses, all_regions
 
-        return answers, all_regions, response_rate
+    def _get_answer_data(self, question, poll, regions, region_selected, query):
+        """
+        Run a query over the numeric values of answers to the question,
+        along with the number of answers and responses.
+
+        The query selects from an "answers" table of (contact_id, local_date,
+        submitted_on, category, value), where local_date is the date of the
+        response in the org's timezone and value is null if the answer is
+        not a number. Each row returned is the query's row followed by the
+        response rate; if the query returns no rows, a single row of nulls is
+        returned with the response rate.
+        """
+        responses, all_regions = self._get_responses(poll, regions, region_selected)
+        responses_sql, responses_params = responses.values(
+            'id', 'contact_id', 'created_on').query.sql_with_params()
+
+        sql = """
+            WITH responses AS ({responses}),
+            answers AS (
+                SELECT r.contact_id,
+                    DATE(r.created_on AT TIME ZONE %s) AS local_date,
+                    a.submitted_on, a.category,
+                    CASE WHEN a.value ~ %s THEN a.value::numeric END AS value
+                FROM polls_answer a
+                INNER JOIN responses r ON r.id = a.response_id
+                WHERE a.question_id = %s
+            ),
+            counts AS (
+                SELECT (SELECT COUNT(*) FROM answers) AS answer_count,
+                    (SELECT COUNT(*) FROM responses) AS response_count
+            )
+            SELECT q.*, counts.answer_count, counts.response_count
+            FROM counts LEFT JOIN ({query}) q ON TRUE
+        """.format(responses=responses_sql, query=query)
+        params = list(responses_params) + [
+            pytz.timezone(self.org.timezone).zone, NUMERIC_VALUE_RE, question.pk]
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+        data = []
+        for row in rows:
+            answer_count, response_count = row[-2:]
+            response_rate = 0
+            if response_count:
+                response_rate = round(float(answer_count)/float(response_count) * 100, 1)
+            data.append(row[:-2] + (response_rate,))
+        return data, all_regions
 
     def get_baseline(self, regions, region_selected=None):
         """ Get all baseline responses """
-        answers, all_regions, response_rate = self._get_answers(
-            self.baseline_question, self.baseline_poll, regions, region_selected)
-        # Retrieve the first result per contact for baseline
-        answers = answers.order_by('response__contact', 'submitted_on').distinct('response__contact')
-        answer_sum = answers.numeric_sum_all_dates()
+        # Sum the first answer per contact, ignoring answers with no category
+        # as they weren't in the required range.
+        data, all_regions = self._get_answer_data(
+            self.baseline_question, self.baseline_poll, regions, region_selected, """
+                SELECT SUM(value) FROM (
+                    SELECT DISTINCT ON (contact_id) category, value FROM answers
+                    ORDER BY contact_id, submitted_on
+                ) first_answers WHERE category IS NOT NULL
+            """)
+        answer_sum, response_rate = data[0]
         dates_list = [self.start_date]
-        return answer_sum, dates_list, response_rate
+        return answer_sum or Decimal(0), dates_list, response_rate
 
     def get_follow_up(self, regions, region_selected=None):
         """ Get all follow up responses """
-        answers, all_regions, response_rate = self._get_answers(
-            self.follow_up_question, self.follow_up_poll, regions, region_selected)
-
-        answers = answers.order_by('submitted_on')
-        answers_list, answers_avg_list, dates, pollrun_list = answers.numeric_group_by_date()
+        # Sum the answers on each date which has numeric answers.
+        data, all_regions = self._get_answer_data(
+            self.follow_up_question, self.follow_up_poll, regions, region_selected, """
+                SELECT local_date, SUM(value) FROM answers
+                GROUP BY local_date HAVING COUNT(value) > 0
+            """)
+        response_rate = data[0][-1]
+        data = sorted(row[:2] for row in data if row[0] is not None)
+        answers_list = [float(total) for date, total in data]
+        dates = [date for date, total in data]
         return answers_list, dates, all_regions, response_rate
 
     def check_for_data(self, regions):
-        answers, all_regions, response_rate = self._get_answers(self.baseline_question, self.baseline_poll, regions, 0)
-        return answers.exists()
+        responses, all_regions = self._get_responses(self.baseline_poll, regions)
+        return Answer.objects.filter(response__in=responses, question=self.baseline_question).exists()
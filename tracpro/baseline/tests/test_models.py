@@ -149,3 +149,20 @@ class BaselineTermTest(TracProDataTest):
             follow_ups,
             [25, 20, 15])
         self.assertEqual(response_rate, 100)
+
+    def test_follow_up_non_numeric(self):
+        """
+        Answers which aren't numbers are left out of the totals, but still
+        count towards the response rate.
+        Region 2 values [n/a, 20, 15]
+        """
+        Answer.objects.filter(
+            response__contact=self.contact4, question=self.poll2_question1,
+            value="25").update(value="n/a")
+        follow_ups, dates, all_regions, response_rate = self.baselineterm.get_follow_up(
+            regions=None, region_selected=None)
+        self.assertEqual(follow_ups, [24, 38, 33])
+        self.assertEqual(
+            [date.day for date in dates],
+            [1, 2, 3])
+        self.assertEqual(response_rate, 100)
@@ -41,10 +41,9 @@ class ContactForm(forms.ModelForm):
 
         # Add form fields to update contact's DataField values.
         self.data_field_keys = []
-        values = {v.field.key: v.get_value() for v in self.instance.contactfield_set.all()}
         for field in org.datafield_set.visible():
             self.data_field_keys.append(field.key)
-            initial = values.get(field.key, None)
+            initial = self.instance.get_data_field_value(field)
             self.fields[field.key] = field.get_form_field(initial=initial)
 
     def save(self, commit=True):
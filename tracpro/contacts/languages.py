@@ -0,0 +1,98 @@
+"""Lookups of languages by ISO 639-2 bibliographic code.
+
+The lookup tables are built from pycountry once, when this module is
+imported, so that language names can be found and searched without scanning
+pycountry's database.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from bisect import bisect_left
+
+import pycountry
+
+
+def _build():
+    languages = {}
+    for language in pycountry.languages:
+        code = getattr(language, 'bibliographic', None)
+        if code:
+            languages[code] = (language.name, getattr(language, 'alpha2', None))
+    index = sorted((name.lower(), code) for code, (name, _) in languages.items())
+    return languages, index
+
+
+# (name, ISO 639-1 code) by bibliographic code.
+_languages, _index = _build()
+
+# Lowercase language names, sorted, for prefix search.
+_index_names = [name for name, _ in _index]
+
+# Bibliographic codes by ISO 639-1 code.
+_codes_by_alpha2 = {alpha2: code for code, (_, alpha2) in _languages.items() if alpha2}
+
+# PostgreSQL's built-in text search configurations by bibliographic code.
+# Text in other languages is searched with the 'simple' configuration, which
+# doesn't stem words or remove stop words.
+# NOTE: The database function tracpro_search_config, created in
+# contacts/migrations/0014_search_functions.py, must be kept in sync.
+SEARCH_CONFIGS = {
+    'dan': 'danish',
+    'dut': 'dutch',
+    'eng': 'english',
+    'fin': 'finnish',
+    'fre': 'french',
+    'ger': 'german',
+    'hun': 'hungarian',
+    'ita': 'italian',
+    'nor': 'norwegian',
+    'por': 'portuguese',
+    'rum': 'romanian',
+    'rus': 'russian',
+    'spa': 'spanish',
+    'swe': 'swedish',
+    'tur': 'turkish',
+}
+
+
+def get_name(code):
+    """Return the name of the language, or None if the code is unknown."""
+    language = _languages.get(code)
+    return language[0] if language else None
+
+
+def get_alpha2(code):
+    """Return the ISO 639-1 code of the language, if it has one."""
+    language = _languages.get(code)
+    return language[1] if language else None
+
+
+def get_code(alpha2):
+    """Return the bibliographic code of a language given its ISO 639-1 code."""
+    return _codes_by_alpha2.get(alpha2)
+
+
+def get_search_config(code):
+    """Return the text search configuration for the language."""
+    return SEARCH_CONFIGS.get(code, 'simple')
+
+
+def search(text, limit=10):
+    """Return (code, name) of languages whose name contains the text.
+
+    Languages whose name starts with the text come first, then other
+    matches, each in alphabetical order.
+    """
+    text = text.strip().lower()
+    codes = []
+    start = bisect_left(_index_names, text)
+    for name, code in _index[start:start + limit]:
+        if not name.startswith(text):
+            break
+        codes.append(code)
+    if len(codes) < limit:
+        for name, code in _index:
+            if text in name and not name.startswith(text):
+                codes.append(code)
+                if len(codes) == limit:
+                    break
+    return [(code, _languages[code][0]) for code in codes]
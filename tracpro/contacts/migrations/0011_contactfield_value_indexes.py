@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """Indexes to support filtering charts by contact data field values.
+
+    The numeric expression must match CONTACT_FIELD_NUMERIC_SQL in
+    contacts/models.py.
+    """
+
+    dependencies = [
+        ('contacts', '0010_auto_20151111_2239'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+            migrations.RunSQL.noop),
+        # Text fields: UPPER(value) LIKE UPPER('%...%') (icontains).
+        migrations.RunSQL(
+            "CREATE INDEX contacts_contactfield_value_trgm "
+            "ON contacts_contactfield USING gin (UPPER(value::text) gin_trgm_ops);",
+            "DROP INDEX contacts_contactfield_value_trgm;"),
+        # Datetime fields: value LIKE 'YYYY-MM-DD%' (startswith).
+        migrations.RunSQL(
+            "CREATE INDEX contacts_contactfield_field_value_like "
+            "ON contacts_contactfield (field_id, value varchar_pattern_ops);",
+            "DROP INDEX contacts_contactfield_field_value_like;"),
+        # Numeric fields: guarded cast of the value to numeric.
+        migrations.RunSQL(
+            "CREATE INDEX contacts_contactfield_field_value_numeric "
+            "ON contacts_contactfield (field_id, "
+            "(CASE WHEN contacts_contactfield.value ~ '^\\s*-?[0-9]+(\\.[0-9]+)?\\s*$' "
+            "THEN CAST(contacts_contactfield.value AS numeric) END));",
+            "DROP INDEX contacts_contactfield_field_value_numeric;"),
+    ]
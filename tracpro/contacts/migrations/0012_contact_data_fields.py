@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.hstore
+from django.contrib.postgres.operations import HStoreExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """Store data field values on the Contact as an hstore document.
+
+    Contact.data_fields is used to show a contact's values. Filters still use
+    the indexed ContactField values.
+    """
+
+    dependencies = [
+        ('contacts', '0011_contactfield_value_indexes'),
+    ]
+
+    operations = [
+        HStoreExtension(),
+        migrations.AddField(
+            model_name='contact',
+            name='data_fields',
+            field=django.contrib.postgres.fields.hstore.HStoreField(default=dict, help_text="Values of this contact's data fields, by data field key.", editable=False, blank=True),
+        ),
+        migrations.RunSQL(
+            "UPDATE contacts_contact c SET data_fields = v.data_fields "
+            "FROM (SELECT cf.contact_id, hstore(array_agg(f.key), array_agg(cf.value)) AS data_fields "
+            "      FROM contacts_contactfield cf "
+            "      INNER JOIN contacts_datafield f ON f.id = cf.field_id "
+            "      GROUP BY cf.contact_id) v "
+            "WHERE c.id = v.contact_id;",
+            migrations.RunSQL.noop),
+    ]
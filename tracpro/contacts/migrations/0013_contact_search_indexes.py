@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """Indexes to support ContactQuerySet.search()."""
+
+    dependencies = [
+        ('contacts', '0012_contact_data_fields'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+            migrations.RunSQL.noop),
+        # Name and URN text: UPPER(...) LIKE UPPER('%...%') (icontains).
+        migrations.RunSQL(
+            "CREATE INDEX contacts_contact_name_trgm "
+            "ON contacts_contact USING gin (UPPER(name::text) gin_trgm_ops);",
+            "DROP INDEX contacts_contact_name_trgm;"),
+        migrations.RunSQL(
+            "CREATE INDEX contacts_contact_urn_trgm "
+            "ON contacts_contact USING gin (UPPER(urn::text) gin_trgm_ops);",
+            "DROP INDEX contacts_contact_urn_trgm;"),
+        # Phone numbers: urn LIKE 'tel:...%' (startswith).
+        migrations.RunSQL(
+            "CREATE INDEX contacts_contact_urn_like "
+            "ON contacts_contact (urn varchar_pattern_ops);",
+            "DROP INDEX contacts_contact_urn_like;"),
+    ]
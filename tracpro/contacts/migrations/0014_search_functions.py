@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Text search configurations by language code, as they were when this
+# migration was written. Later changes to tracpro.contacts.languages need a
+# new migration which replaces tracpro_search_config.
+SEARCH_CONFIGS = {
+    'dan': 'danish',
+    'dut': 'dutch',
+    'eng': 'english',
+    'fin': 'finnish',
+    'fre': 'french',
+    'ger': 'german',
+    'hun': 'hungarian',
+    'ita': 'italian',
+    'nor': 'norwegian',
+    'por': 'portuguese',
+    'rum': 'romanian',
+    'rus': 'russian',
+    'spa': 'spanish',
+    'swe': 'swedish',
+    'tur': 'turkish',
+}
+
+SEARCH_CONFIG_CASES = ' '.join(
+    "WHEN '{}' THEN '{}'::regconfig".format(code, config)
+    for code, config in sorted(SEARCH_CONFIGS.items()))
+
+
+class Migration(migrations.Migration):
+    """Functions used to build the search vectors of contacts' text."""
+
+    dependencies = [
+        ('contacts', '0013_contact_search_indexes'),
+    ]
+
+    operations = [
+        # The text search configuration for a contact's language.
+        migrations.RunSQL(
+            "CREATE FUNCTION tracpro_search_config(language varchar) RETURNS regconfig AS $$ "
+            "SELECT CASE language {} ELSE 'simple'::regconfig END; "
+            "$$ LANGUAGE sql IMMUTABLE;".format(SEARCH_CONFIG_CASES),
+            "DROP FUNCTION tracpro_search_config(varchar);"),
+        # Text is indexed both stemmed in the contact's language and as written.
+        migrations.RunSQL(
+            "CREATE FUNCTION tracpro_search_vector(language varchar, body text) RETURNS tsvector AS $$ "
+            "SELECT to_tsvector(tracpro_search_config(language), COALESCE(body, '')) "
+            "|| to_tsvector('simple', COALESCE(body, '')); "
+            "$$ LANGUAGE sql IMMUTABLE;",
+            "DROP FUNCTION tracpro_search_vector(varchar, text);"),
+    ]
@@ -2,29 +2,70 @@ from __future__ import absolute_import, unicode_literals
 
 import datetime
 from decimal import Decimal, InvalidOperation
+import hashlib
 import logging
+import re
+import threading
 from uuid import uuid4
 
 from django import forms
 from django.conf import settings
+from django.contrib.postgres.fields import HStoreField
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import connection, models
 from django.utils.dateparse import parse_datetime
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.text import force_text
 from django.utils.translation import ugettext_lazy as _
 
+from dash.utils import get_cacheable
 from dash.utils.sync import ChangeType
 
 from temba_client.types import Contact as TembaContact
 
 from tracpro.groups.models import Region, Group
+from tracpro.utils import bulk_update, bump_version, get_version
 
-from .tasks import push_contact_change
+from .tasks import queue_contact_change
 
 
 logger = logging.getLogger(__name__)
 
+CONTACT_FIELD_VERSION_KEY = 'org:%d:contact_field_version'
+
+CONTACT_FIELD_FILTER_KEY = 'org:{org}:contact_field_filter:{version}:{field}:{value}'
+
+CONTACT_FIELD_FILTER_TTL = 60 * 15  # 15 minutes
+
+CONTACT_UNRESOLVED_VERSION_KEY = 'org:%d:contact_unresolved_version'
+
+CONTACT_UNRESOLVED_KEY = 'org:{org}:contact_unresolved:{version}:{uuid}'
+
+CONTACT_UNRESOLVED_TTL = 60 * 60 * 6  # 6 hours
+
+# The DataFieldBatch that is active in this thread, if any.
+_data_field_batch = threading.local()
+
+# Search text which is a (partial) phone number.
+PHONE_SEARCH_RE = re.compile(r'^\+?[0-9][0-9\s\-\(\)]*$')
+
+# Casts a ContactField value to numeric, if it is a valid number.
+# NOTE: The SQL expression must match the index created in
+# contacts/migrations/0011_contactfield_value_indexes.py.
+CONTACT_FIELD_NUMERIC_SQL = (
+    "(CASE WHEN contacts_contactfield.value ~ '^\\s*-?[0-9]+(\\.[0-9]+)?\\s*$' "
+    "THEN CAST(contacts_contactfield.value AS numeric) END)")
+
+
+def serialize_value(value):
+    """Serialize a data field value as unicode for storage."""
+    if value is None:
+        return None
+    elif isinstance(value, datetime.datetime):
+        return unicode(value.isoformat())
+    return force_text(value)
+
 
 class ContactQuerySet(models.QuerySet):
 
@@ -37,9 +78,58 @@ class ContactQuerySet(models.QuerySet):
     def by_regions(self, regions):
         return self.filter(region__in=regions)
 
+    def search(self, text, region_ids=None):
+        """Return contacts matching the search text, best matches first.
+
+        Text that looks like a phone number is matched as a prefix of the
+        contact's tel URN. Other text matches names and URNs that contain it
+        (using trigram indexes), ranked by similarity.
+        """
+        text = text.strip()
+        qs = self.filter(is_active=True)
+        if region_ids is not None:
+            qs = qs.filter(region__in=region_ids)
+
+        if PHONE_SEARCH_RE.match(text):
+            number = re.sub(r'[^0-9]', '', text)
+            qs = qs.filter(models.Q(urn__startswith='tel:' + number) |
+                           models.Q(urn__startswith='tel:+' + number))
+            return qs.order_by('urn', 'pk')
+
+        qs = qs.filter(models.Q(name__icontains=text) | models.Q(urn__icontains=text))
+        qs = qs.extra(
+            select={'rank': "GREATEST(similarity(contacts_contact.name, %s), "
+                            "similarity(contacts_contact.urn, %s))"},
+            select_params=[text, text])
+        return qs.order_by('-rank', 'name', 'pk')
+
+    def matching_data_field(self, data_field, value):
+        """Filter to contacts whose value for the data field matches a filter value.
+
+        Values are matched on the indexed ContactField table; see
+        ContactFieldQuerySet.matching.
+        """
+        matching = ContactField.objects.matching(data_field, value)
+        return self.filter(org=data_field.org_id, pk__in=matching.values('contact'))
+
 
 class ContactManager(models.Manager.from_queryset(ContactQuerySet)):
-    pass
+
+    def get_ids_matching_data_field(self, data_field, value):
+        """Return the set of ids of contacts whose value matches the filter.
+
+        Results are cached until the org's data field values change.
+        """
+        def calculate():
+            matching = self.get_queryset().matching_data_field(data_field, value)
+            return list(matching.values_list('pk', flat=True))
+
+        cache_key = CONTACT_FIELD_FILTER_KEY.format(
+            org=data_field.org_id,
+            version=Contact.get_data_fields_version(data_field.org_id),
+            field=data_field.pk,
+            value=hashlib.md5(force_text(value).encode('utf-8')).hexdigest())
+        return set(get_cacheable(cache_key, CONTACT_FIELD_FILTER_TTL, calculate))
 
 
 @python_2_unicode_compatible
@@ -67,6 +157,9 @@ class Contact(models.Model):
     language = models.CharField(
         max_length=3, verbose_name=_("Language"), null=True, blank=True,
         help_text=_("Language for this contact"))
+    data_fields = HStoreField(
+        default=dict, blank=True, editable=False,
+        help_text=_("Values of this contact's data fields, by data field key."))
 
     # Metadata.
     is_active = models.BooleanField(
@@ -103,7 +196,8 @@ class Contact(models.Model):
         if self.group_id:
             groups.append(self.group.uuid)
 
-        fields = {f.field.key: f.get_value() for f in self.contactfield_set.all()}
+        fields = {f.key: self.get_data_field_value(f)
+                  for f in self.org.datafield_set.all() if f.key in self.data_fields}
 
         temba_contact = TembaContact()
         temba_contact.name = self.name
@@ -126,13 +220,50 @@ class Contact(models.Model):
         """Gets a contact by UUID.
 
         If we don't find them locally, we try to fetch them from RapidPro.
+        Contacts that can't be created locally (e.g., because they are in no
+        Region) are remembered, and raise ValueError without being fetched
+        again until the org's groups or contacts are synced.
         """
         contacts = cls.objects.filter(org=org).select_related('region', 'group')
         try:
             return contacts.get(uuid=uuid)
         except cls.DoesNotExist:
-            temba_contact = org.get_temba_client().get_contact(uuid)
-            return cls.objects.create(**cls.kwargs_from_temba(org, temba_contact))
+            pass
+
+        cache_key = CONTACT_UNRESOLVED_KEY.format(
+            org=org.pk,
+            version=get_version(CONTACT_UNRESOLVED_VERSION_KEY % org.pk),
+            uuid=uuid)
+        reason = cache.get(cache_key)
+        if reason is not None:
+            raise ValueError(reason)
+
+        temba_contact = org.get_temba_client().get_contact(uuid)
+        try:
+            kwargs = cls.kwargs_from_temba(org, temba_contact)
+        except ValueError as e:
+            cache.set(cache_key, force_text(e), CONTACT_UNRESOLVED_TTL)
+            raise
+        return cls.objects.create(**kwargs)
+
+    @classmethod
+    def clear_unresolved(cls, org_id):
+        """Forget which of the org's contacts could not be created locally."""
+        bump_version(CONTACT_UNRESOLVED_VERSION_KEY % org_id)
+
+    @classmethod
+    def get_data_fields_version(cls, org_id):
+        """Return a version token for the org's data field values."""
+        return get_version(CONTACT_FIELD_VERSION_KEY % org_id)
+
+    @classmethod
+    def bump_data_fields_version(cls, org_id):
+        """Invalidate cached lookups of the org's data field values."""
+        bump_version(CONTACT_FIELD_VERSION_KEY % org_id)
+
+    def get_data_field_value(self, data_field):
+        """Return this contact's value for the DataField, parsed according to its type."""
+        return data_field.parse_value(self.data_fields.get(data_field.key))
 
     def get_responses(self, include_empty=True):
         from tracpro.polls.models import Response
@@ -151,10 +282,9 @@ class Contact(models.Model):
 
         def _get_first(model_class, temba_uuids):
             """Return first obj from this org that matches one of the given uuids."""
-            queryset = model_class.get_all(org)
-            tracpro_uuids = queryset.values_list('uuid', flat=True)
-            uuid = next((uuid for uuid in temba_uuids if uuid in tracpro_uuids), None)
-            return queryset.get(uuid=uuid) if uuid else None
+            groups_by_uuid = model_class.get_uuid_map(org)
+            return next((groups_by_uuid[uuid] for uuid in temba_uuids
+                         if uuid in groups_by_uuid), None)
 
         # Use the first Temba group that matches one of the org's Regions.
         region = _get_first(Region, temba_contact.groups)
@@ -182,7 +312,7 @@ class Contact(models.Model):
         }
 
     def push(self, change_type):
-        push_contact_change.delay(self.pk, change_type)
+        queue_contact_change(self.org_id, self.pk, change_type)
 
     def save(self, *args, **kwargs):
         if self.org.pk != self.region.org_id:
@@ -193,6 +323,9 @@ class Contact(models.Model):
         # RapidPro might return blank or null values.
         self.name = self.name or ""
 
+        if self._data_field_values is not None:
+            self._update_data_fields(self._data_field_values)
+
         if not self.uuid:
             # There will be no UUID if we are creating this Contact
             # (rather than importing from RapidPro).
@@ -204,13 +337,36 @@ class Contact(models.Model):
         else:
             push_created = False
 
+        # Data field values are also saved to the ContactField table by the
+        # set_data_field_values post-save signal.
         contact = super(Contact, self).save(*args, **kwargs)
+        self._data_field_values = None
 
         if push_created:
             self.push(ChangeType.created)
 
         return contact
 
+    def _update_data_fields(self, values):
+        """Serialize new data field values onto this (unsaved) instance.
+
+        Stores all values, even for DataFields that are not visible.
+        By doing this, we can quickly show meaningful data when DataField
+        visibility is toggled. Values for keys that we don't have a DataField
+        for are ignored. The serialized values are left in _data_field_values
+        for the set_data_field_values post-save signal.
+        """
+        batch = DataFieldBatch.get_current(self.org_id)
+        if batch:
+            keys = batch.keys
+        else:
+            keys = set(DataField.objects.by_org(self.org).values_list('key', flat=True))
+        # Remove empty strings for consistency with RapidPro.
+        values = {k: serialize_value(v or None) for k, v in values.items() if k in keys}
+        self.data_fields = dict(self.data_fields or {})
+        self.data_fields.update(values)
+        self._data_field_values = values
+
 
 class DataFieldQuerySet(models.QuerySet):
 
@@ -230,7 +386,16 @@ class DataFieldManager(models.Manager.from_queryset(DataFieldQuerySet)):
 
         # Remove DataFields (and corresponding values per contact) that are no
         # longer on RapidPro.
-        DataField.objects.by_org(org).exclude(key__in=temba_fields.keys()).delete()
+        removed = DataField.objects.by_org(org).exclude(key__in=temba_fields.keys())
+        removed_keys = list(removed.values_list('key', flat=True))
+        removed.delete()
+        if removed_keys:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE contacts_contact SET data_fields = data_fields - %s "
+                    "WHERE org_id = %s AND data_fields ?| %s",
+                    [removed_keys, org.pk, removed_keys])
+        Contact.bump_data_fields_version(org.pk)
 
         # Create new or update existing DataFields to match RapidPro data.
         for key, temba_field in temba_fields.items():
@@ -296,15 +461,84 @@ class DataField(models.Model):
             field_type = forms.CharField
         return field_type(label=self.display_name, required=False, **kwargs)
 
+    def parse_value(self, value):
+        """Parse a serialized value according to the type of this field."""
+        if value is None:
+            return None
+        elif self.value_type == DataField.TYPE_DATETIME:
+            return parse_datetime(value)
+        elif self.value_type == DataField.TYPE_NUMERIC:
+            try:
+                return Decimal(value)
+            except InvalidOperation:
+                logger.warning(
+                    "Unable to parse {} value as decimal: {}".format(self, value))
+                return None
+        else:
+            return value
+
 
 class ContactFieldQuerySet(models.QuerySet):
 
+    def matching(self, data_field, value):
+        """Filter to values of the data field that match a filter value.
+
+        Numeric fields are compared as numbers and datetime fields by date.
+        Other fields match if the value contains the (case-insensitive)
+        filter text. Each lookup is supported by an index.
+        """
+        qs = self.filter(field=data_field)
+        if data_field.value_type == DataField.TYPE_NUMERIC:
+            return qs.extra(where=[CONTACT_FIELD_NUMERIC_SQL + ' = %s'], params=[value])
+        elif data_field.value_type == DataField.TYPE_DATETIME:
+            if isinstance(value, datetime.datetime):
+                value = value.date()
+            return qs.filter(value__startswith=value.isoformat())
+        else:
+            return qs.filter(value__icontains=value)
+
     def visible(self):
         return self.filter(field__show_on_tracpro=True)
 
+    def set_values(self, org, values_by_contact):
+        """Save serialized data field values for many of the org's contacts.
+
+        values_by_contact maps contact ids to dicts of values by DataField
+        key. Missing values are created with one bulk insert and changed
+        values are written with one bulk update.
+        """
+        data_fields = dict(DataField.objects.by_org(org).values_list('key', 'pk'))
+        existing = self.filter(contact_id__in=values_by_contact.keys())
+        existing = {(contact_id, field_id): (pk, value) for pk, contact_id, field_id, value
+                    in existing.values_list('pk', 'contact_id', 'field_id', 'value')}
+
+        new_fields = []
+        changed = []
+        for contact_id, values in values_by_contact.items():
+            for key, value in values.items():
+                field_id = data_fields.get(key)
+                if field_id is None:
+                    continue  # The DataField has been removed since the contact was saved.
+                if (contact_id, field_id) not in existing:
+                    new_fields.append(
+                        ContactField(contact_id=contact_id, field_id=field_id, value=value))
+                elif existing[(contact_id, field_id)][1] != value:
+                    changed.append((existing[(contact_id, field_id)][0], value))
+
+        if new_fields:
+            ContactField.objects.bulk_create(new_fields)
+        if changed:
+            bulk_update(ContactField, ['value'], changed)
+        if new_fields or changed:
+            Contact.bump_data_fields_version(org.pk)
+
 
 class ContactField(models.Model):
-    """Many-to-many relationship to represent a Contact's value for a DataField."""
+    """Many-to-many relationship to represent a Contact's value for a DataField.
+
+    Values are also stored on Contact.data_fields, which is used for display.
+    Filters use this table, where the values are indexed.
+    """
     contact = models.ForeignKey('contacts.Contact')
     field = models.ForeignKey('contacts.DataField')
     value = models.CharField(max_length=255, null=True)
@@ -316,26 +550,52 @@ class ContactField(models.Model):
 
     def get_value(self):
         """Retrieve the value of this instance according to the DataField type."""
-        if self.value is None:
-            return None
-        elif self.field.value_type == DataField.TYPE_DATETIME:
-            return parse_datetime(self.value)
-        elif self.field.value_type == DataField.TYPE_NUMERIC:
-            try:
-                return Decimal(self.value)
-            except InvalidOperation:
-                logger.warning(
-                    "Unable to parse {} value for {} as decimal: {}".format(
-                        self.field, self.contact, self.value))
-                return None
-        else:
-            return self.value
+        return self.field.parse_value(self.value)
 
     def set_value(self, value):
         """Serialize the value on this instance according to its type."""
-        if value is None:
-            self.value = None
-        elif isinstance(value, datetime.datetime):
-            self.value = unicode(value.isoformat())
-        else:
-            self.value = force_text(value)
+        self.value = serialize_value(value)
+
+
+class DataFieldBatch(object):
+    """Saves the ContactField values of an org's contacts in batches.
+
+    While the batch is active, the set_data_field_values post-save signal
+    hands each contact's values to the batch instead of writing them, and
+    the org's DataField keys are looked up only once:
+
+        with DataFieldBatch(org):
+            ...  # save many contacts
+    """
+
+    def __init__(self, org, batch_size=500):
+        self.org = org
+        self.batch_size = batch_size
+        self.keys = None
+        self.pending = {}
+
+    def __enter__(self):
+        self.keys = set(DataField.objects.by_org(self.org).values_list('key', flat=True))
+        _data_field_batch.current = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _data_field_batch.current = None
+        # Contacts that were saved must get their values, even on error.
+        self.flush()
+
+    @classmethod
+    def get_current(cls, org_id):
+        """Return the active batch for the org in this thread, if any."""
+        batch = getattr(_data_field_batch, 'current', None)
+        return batch if batch and batch.org.pk == org_id else None
+
+    def add(self, contact_id, values):
+        self.pending.setdefault(contact_id, {}).update(values)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            ContactField.objects.set_values(self.org, self.pending)
+            self.pending = {}
@@ -5,15 +5,54 @@ from django.utils import timezone
 
 from celery.utils.log import get_task_logger
 from djcelery_transactions import task
+from django_redis import get_redis_connection
 
 from dash.utils import datetime_to_ms
-from dash.utils.sync import sync_pull_contacts, sync_push_contact
+from dash.utils.sync import ChangeType, sync_pull_contacts, sync_push_contact
 
 from tracpro.orgs_ext.tasks import OrgTask
 
 
 logger = get_task_logger(__name__)
 
+# Ids of contacts with changes to push, and when each was first queued (in ms).
+CONTACT_PUSH_QUEUE_KEY = 'org:%d:contact_push_queue'
+
+# Ids of queued contacts that have not been created in RapidPro yet.
+CONTACT_PUSH_CREATED_KEY = 'org:%d:contact_push_created'
+
+# Set while a push of the org's queued changes is scheduled.
+CONTACT_PUSH_SCHEDULED_KEY = 'org:%d:contact_push_scheduled'
+
+# How long changes are collected before they are pushed, in seconds.
+CONTACT_PUSH_DELAY = 10
+
+CONTACT_PUSH_BATCH_SIZE = 100
+
+
+def queue_contact_change(org_id, contact_id, change_type):
+    """Queue a local contact change to be pushed to RapidPro.
+
+    Changes to the same contact within the push delay are pushed once, with
+    the contact's state at the time of the push.
+    """
+    pipe = get_redis_connection().pipeline()
+    pipe.hsetnx(CONTACT_PUSH_QUEUE_KEY % org_id, contact_id, datetime_to_ms(timezone.now()))
+    if change_type == ChangeType.created:
+        pipe.sadd(CONTACT_PUSH_CREATED_KEY % org_id, contact_id)
+    pipe.set(CONTACT_PUSH_SCHEDULED_KEY % org_id, 1, ex=CONTACT_PUSH_DELAY * 6, nx=True)
+    if pipe.execute()[-1]:
+        push_org_contact_changes.apply_async(args=[org_id], countdown=CONTACT_PUSH_DELAY)
+
+
+def get_contact_push_queue(org_id):
+    """Return the number of queued contact changes and the age of the oldest, in seconds."""
+    queued_on = get_redis_connection().hvals(CONTACT_PUSH_QUEUE_KEY % org_id)
+    if not queued_on:
+        return 0, None
+    oldest = min(int(ms) for ms in queued_on)
+    return len(queued_on), (datetime_to_ms(timezone.now()) - oldest) / 1000.0
+
 
 @task
 def push_contact_change(contact_id, change_type):
@@ -28,23 +67,83 @@ def push_contact_change(contact_id, change_type):
 
     logger.info("Pushing %s change to contact %s" % (change_type.name.upper(), contact.uuid))
 
-    region_uuids = set([r.uuid for r in Region.get_all(org)])
-    group_uuids = set([r.uuid for r in Group.get_all(org)])
+    region_uuids = set(Region.get_uuid_map(org))
+    group_uuids = set(Group.get_uuid_map(org))
 
     sync_push_contact(org, contact, change_type, [region_uuids, group_uuids])
 
 
+@task
+def push_org_contact_changes(org_id):
+    """Push the org's queued contact changes to RapidPro in batches."""
+    from tracpro.groups.models import Group, Region
+    from tracpro.orgs_ext.constants import TaskType
+    from .models import Contact
+
+    # Take the queued changes; changes queued from now on schedule a new push.
+    pipe = get_redis_connection().pipeline()
+    pipe.delete(CONTACT_PUSH_SCHEDULED_KEY % org_id)
+    pipe.hgetall(CONTACT_PUSH_QUEUE_KEY % org_id)
+    pipe.delete(CONTACT_PUSH_QUEUE_KEY % org_id)
+    pipe.smembers(CONTACT_PUSH_CREATED_KEY % org_id)
+    pipe.delete(CONTACT_PUSH_CREATED_KEY % org_id)
+    _, queued, _, created, _ = pipe.execute()
+    if not queued:
+        return
+
+    queued = {int(pk): int(ms) for pk, ms in queued.items()}
+    created = set(int(pk) for pk in created)
+    org = apps.get_model('orgs', 'Org').objects.get(pk=org_id)
+    region_uuids = set(Region.get_uuid_map(org))
+    group_uuids = set(Group.get_uuid_map(org))
+
+    logger.info("Pushing changes to %d contacts for org #%d" % (len(queued), org_id))
+
+    pushed = failed = 0
+    contact_ids = sorted(queued)
+    for start in range(0, len(contact_ids), CONTACT_PUSH_BATCH_SIZE):
+        batch = contact_ids[start:start + CONTACT_PUSH_BATCH_SIZE]
+        for contact in Contact.objects.filter(pk__in=batch).select_related('region', 'group'):
+            contact.org = org
+            if contact.pk in created:
+                if not contact.is_active:
+                    continue  # Deleted before it was ever created remotely.
+                change_type = ChangeType.created
+            elif not contact.is_active:
+                change_type = ChangeType.deleted
+            else:
+                change_type = ChangeType.updated
+            try:
+                sync_push_contact(org, contact, change_type, [region_uuids, group_uuids])
+            except Exception:
+                logger.exception("Unable to push %s change to contact %s" % (
+                    change_type.name.upper(), contact.uuid))
+                failed += 1
+            else:
+                pushed += 1
+
+    now = datetime_to_ms(timezone.now())
+    task_result = dict(time=now,
+                       counts=dict(pushed=pushed, failed=failed),
+                       latency=(now - min(queued.values())) / 1000.0)
+    org.set_task_result(TaskType.push_contacts, task_result)
+
+    logger.info("Finished pushing contact changes for org #%d (%d pushed, %d failed)" %
+                (org_id, pushed, failed))
+
+
 @task
 class SyncOrgContacts(OrgTask):
 
     def org_task(self, org):
         from tracpro.groups.models import Region, Group
         from tracpro.orgs_ext.constants import TaskType
-        from .models import Contact
+        from .models import Contact, DataFieldBatch
 
         logger.info('Starting contact sync task for org #%d' % org.id)
 
-        sync_groups = [r.uuid for r in Region.get_all(org)] + [g.uuid for g in Group.get_all(org)]
+        # The org's group maps are also used to match each contact's groups.
+        sync_groups = list(Region.get_uuid_map(org)) + list(Group.get_uuid_map(org))
 
         most_recent_contact = Contact.objects.by_org(org).active().exclude(temba_modified_on=None)
         most_recent_contact = most_recent_contact.order_by('-temba_modified_on').first()
@@ -53,9 +152,14 @@ class SyncOrgContacts(OrgTask):
         else:
             last_time = None
 
-        created, updated, deleted, failed = sync_pull_contacts(
-            org, Contact, fields=(), groups=sync_groups, last_time=last_time,
-            delete_blocked=True)
+        # Data field values are saved in bulk rather than per contact.
+        with DataFieldBatch(org):
+            created, updated, deleted, failed = sync_pull_contacts(
+                org, Contact, fields=(), groups=sync_groups, last_time=last_time,
+                delete_blocked=True)
+
+        # Contacts that couldn't be created before may now be resolvable.
+        Contact.clear_unresolved(org.pk)
 
         task_result = dict(time=datetime_to_ms(timezone.now()),
                            counts=dict(created=len(created),
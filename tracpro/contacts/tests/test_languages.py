@@ -0,0 +1,35 @@
+from __future__ import unicode_literals
+
+from django.test import SimpleTestCase
+
+from .. import languages
+
+
+class TestLanguages(SimpleTestCase):
+
+    def test_get_name(self):
+        self.assertEqual(languages.get_name('eng'), "English")
+        self.assertIsNone(languages.get_name('xxx'))
+
+    def test_get_alpha2(self):
+        self.assertEqual(languages.get_alpha2('eng'), 'en')
+        self.assertIsNone(languages.get_alpha2('xxx'))
+
+    def test_get_code(self):
+        self.assertEqual(languages.get_code('en'), 'eng')
+        self.assertIsNone(languages.get_code('xx'))
+
+    def test_get_search_config(self):
+        self.assertEqual(languages.get_search_config('fre'), 'french')
+        self.assertEqual(languages.get_search_config('kin'), 'simple')
+        self.assertEqual(languages.get_search_config(None), 'simple')
+
+    def test_search(self):
+        self.assertEqual(languages.search("Kin"), [('kin', "Kinyarwanda")])
+        self.assertEqual(len(languages.search("")), 10)
+
+        # Prefix matches come before other matches.
+        results = [name for _, name in languages.search("fr", limit=50)]
+        self.assertEqual(results[0], "French")
+        self.assertTrue(all(name.lower().startswith("fr") for name in results[:2]))
+        self.assertTrue(any(not name.lower().startswith("fr") for name in results))
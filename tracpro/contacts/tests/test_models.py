@@ -3,6 +3,7 @@ from __future__ import absolute_import, unicode_literals
 import datetime
 from decimal import Decimal
 
+import mock
 import pytz
 
 from temba_client.types import Contact as TembaContact
@@ -11,11 +12,13 @@ from django.test.utils import override_settings
 from django.utils import timezone
 from dash.utils.sync import ChangeType
 
+from tracpro.orgs_ext.constants import TaskType
 from tracpro.polls.models import Response
 from tracpro.test import factories
 from tracpro.test.cases import TracProDataTest, TracProTest
 
 from .. import models
+from .. import tasks
 
 
 class ContactTest(TracProDataTest):
@@ -78,6 +81,23 @@ class ContactTest(TracProDataTest):
         contact = models.Contact.get_or_fetch(self.unicef, 'C-009')
         self.assertEqual(contact.name, "Mo Polls")
 
+    def test_get_or_fetch_unresolved(self):
+        """Contacts in no Region are not fetched again until they are cleared."""
+        self.mock_temba_client.get_contact.return_value = TembaContact.create(
+            uuid='C-009', name="Mo Polls",
+            urns=['tel:078123'], groups=['G-006'],
+            fields={},
+            language='eng', modified_on=timezone.now())
+        for i in range(2):
+            with self.assertRaises(ValueError):
+                models.Contact.get_or_fetch(self.unicef, 'C-009')
+        self.assertEqual(self.mock_temba_client.get_contact.call_count, 1)
+
+        models.Contact.clear_unresolved(self.unicef.pk)
+        with self.assertRaises(ValueError):
+            models.Contact.get_or_fetch(self.unicef, 'C-009')
+        self.assertEqual(self.mock_temba_client.get_contact.call_count, 2)
+
     def test_kwargs_from_temba(self):
         modified_date = timezone.now()
         temba_contact = TembaContact.create(
@@ -110,6 +130,23 @@ class ContactTest(TracProDataTest):
         # try creating contact from them
         models.Contact.objects.create(**kwargs)
 
+    def test_kwargs_from_temba_group_maps(self):
+        """Groups are matched from the org's UUID maps without further queries."""
+        temba_contact = TembaContact.create(
+            uuid='C-007', name="Jan", urns=['tel:123'], groups=['G-002', 'G-006'],
+            fields={}, language='eng', modified_on=timezone.now())
+        models.Contact.kwargs_from_temba(self.unicef, temba_contact)
+
+        with self.assertNumQueries(0):
+            kwargs = models.Contact.kwargs_from_temba(self.unicef, temba_contact)
+        self.assertEqual(kwargs['region'], self.region2)
+        self.assertEqual(kwargs['group'], self.group2)
+
+        # The maps are rebuilt after groups of the org change.
+        self.region2.deactivate()
+        with self.assertRaises(ValueError):
+            models.Contact.kwargs_from_temba(self.unicef, temba_contact)
+
     def test_as_temba(self):
         temba_contact = self.contact1.as_temba()
         self.assertEqual(temba_contact.name, "Ann")
@@ -152,6 +189,99 @@ class ContactTest(TracProDataTest):
 
         self.assertEqual(self.mock_temba_client.delete_contact.call_count, 1)
 
+    @mock.patch('tracpro.contacts.tasks.push_org_contact_changes.apply_async')
+    def test_push_coalesced(self, mock_apply_async):
+        """Queued changes are pushed once per contact, in one task."""
+        self.contact1.push(ChangeType.updated)
+        self.contact1.push(ChangeType.updated)
+        self.contact2.delete()
+        self.assertEqual(mock_apply_async.call_count, 1)
+        self.assertEqual(tasks.get_contact_push_queue(self.unicef.pk)[0], 2)
+
+        tasks.push_org_contact_changes(self.unicef.pk)
+        self.assertEqual(self.mock_temba_client.update_contact.call_count, 1)
+        self.assertEqual(self.mock_temba_client.delete_contact.call_count, 1)
+        self.assertEqual(tasks.get_contact_push_queue(self.unicef.pk), (0, None))
+        result = self.unicef.get_task_result(TaskType.push_contacts)
+        self.assertEqual(result['counts'], {'pushed': 2, 'failed': 0})
+
+    def test_save_data_fields(self):
+        """Data field values are stored on the contact and in ContactField."""
+        factories.DataField(org=self.unicef, key='gender')
+        factories.DataField(org=self.unicef, key='age', value_type=models.DataField.TYPE_NUMERIC)
+
+        self.contact1._data_field_values = {'gender': 'M', 'age': 32, 'unknown': 'x'}
+        self.contact1.save()
+        self.contact1.refresh_from_db()
+        self.assertEqual(self.contact1.data_fields, {'gender': 'M', 'age': '32'})
+        self.assertEqual(
+            dict(self.contact1.contactfield_set.values_list('field__key', 'value')),
+            {'gender': 'M', 'age': '32'})
+
+        # Updated values are merged with existing values.
+        self.contact1._data_field_values = {'age': ''}
+        self.contact1.save()
+        self.contact1.refresh_from_db()
+        self.assertEqual(self.contact1.data_fields, {'gender': 'M', 'age': None})
+        self.assertEqual(self.contact1.contactfield_set.get(field__key='age').value, None)
+
+    def test_save_data_fields_in_batch(self):
+        """ContactField values are saved in bulk while a DataFieldBatch is active."""
+        factories.DataField(org=self.unicef, key='gender')
+        self.contact2._data_field_values = {'gender': 'F'}
+        self.contact2.save()
+
+        with models.DataFieldBatch(self.unicef, batch_size=2) as batch:
+            for contact, gender in ((self.contact1, 'M'), (self.contact2, 'M'),
+                                    (self.contact3, 'F')):
+                contact._data_field_values = {'gender': gender}
+                contact.save()
+            # The first two contacts were flushed when the batch filled up.
+            self.assertEqual(batch.pending, {self.contact3.pk: {'gender': 'F'}})
+            self.assertFalse(self.contact3.contactfield_set.exists())
+
+        values = models.ContactField.objects.filter(field__key='gender')
+        self.assertEqual(dict(values.values_list('contact', 'value')), {
+            self.contact1.pk: 'M',
+            self.contact2.pk: 'M',
+            self.contact3.pk: 'F',
+        })
+
+    def test_matching_data_field(self):
+        """Values are matched according to the DataField type."""
+        text = factories.DataField(org=self.unicef, key='name')
+        numeric = factories.DataField(
+            org=self.unicef, key='age', value_type=models.DataField.TYPE_NUMERIC)
+        date = factories.DataField(
+            org=self.unicef, key='born', value_type=models.DataField.TYPE_DATETIME)
+        for contact, values in (
+                (self.contact1, {'name': "Hello World", 'age': "5.0",
+                                 'born': "2015-09-15T21:32:56.349186"}),
+                (self.contact2, {'name': "Goodbye", 'age': "6",
+                                 'born': "2015-09-16T01:00:00"}),
+                (self.contact3, {'name': "100%", 'age': "five"})):
+            contact._data_field_values = values
+            contact.save()
+
+        matching = models.Contact.objects.matching_data_field
+        self.assertEqual(list(matching(text, "world")), [self.contact1])
+        self.assertEqual(list(matching(text, "%")), [self.contact3])
+        self.assertEqual(list(matching(numeric, Decimal("5"))), [self.contact1])
+        self.assertEqual(list(matching(date, datetime.date(2015, 9, 15))), [self.contact1])
+
+    def test_get_ids_matching_data_field(self):
+        """Matching contact ids are cached until the data field values change."""
+        data_field = factories.DataField(org=self.unicef, key='gender')
+        self.contact1._data_field_values = {'gender': 'F'}
+        self.contact1.save()
+
+        get_ids = models.Contact.objects.get_ids_matching_data_field
+        self.assertEqual(get_ids(data_field, "f"), {self.contact1.pk})
+
+        self.contact2._data_field_values = {'gender': 'F'}
+        self.contact2.save()
+        self.assertEqual(get_ids(data_field, "f"), {self.contact1.pk, self.contact2.pk})
+
     def test_str(self):
         self.assertEqual(str(self.contact1), "Ann")
         self.contact1.name = ""
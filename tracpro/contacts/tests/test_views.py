@@ -5,6 +5,8 @@ import pytz
 from temba_client.types import Contact as TembaContact, Run
 
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from tracpro.polls.models import Response
@@ -182,6 +184,54 @@ class ContactCRUDLTest(TracProDataTest):
         self.assertEqual(len(response.context['object_list']), 3)
         self.assertContains(response, "Farm Poll")
 
+    def test_search(self):
+        url = reverse('contacts.contact_search')
+
+        self.login(self.admin)
+        response = self.url_get('unicef', url, {'search': "an"})
+        results = json.loads(response.content)['results']
+        self.assertEqual(set(r['name'] for r in results), set(["Ann", "Dan"]))
+
+        # Phone numbers are matched by prefix.
+        response = self.url_get('unicef', url, {'search': "+23"})
+        results = json.loads(response.content)['results']
+        self.assertEqual([r['id'] for r in results], [self.contact2.pk])
+
+        # Users only find contacts in their regions.
+        self.login(self.user1)
+        response = self.url_get('unicef', url, {'search': "an"})
+        results = json.loads(response.content)['results']
+        self.assertEqual([r['id'] for r in results], [self.contact1.pk])
+
+    def test_list__pollrun_completion(self):
+        """Completion icons are looked up once for the page, not once per row."""
+        pollrun1 = factories.UniversalPollRun(
+            poll=self.poll1, conducted_on=datetime.datetime(2014, 12, 1, tzinfo=pytz.UTC))
+        factories.Response(
+            pollrun=pollrun1, contact=self.contact1, status=Response.STATUS_COMPLETE)
+        factories.Response(
+            pollrun=pollrun1, contact=self.contact2, status=Response.STATUS_PARTIAL)
+
+        self.login(self.user1)
+        url = reverse('contacts.contact_list')
+        self.url_get('unicef', url)  # Warm up the caches used by every page.
+        with CaptureQueriesContext(connection) as queries:
+            response = self.url_get('unicef', url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'glyphicon-ok', count=1)
+        self.assertContains(response, 'glyphicon-time', count=2)
+
+        # More rows don't need more queries.
+        for name in ("Dan", "Eve"):
+            contact = factories.Contact(
+                org=self.unicef, name=name, region=self.region1, group=self.group1)
+            factories.Response(
+                pollrun=pollrun1, contact=contact, status=Response.STATUS_COMPLETE)
+        with self.assertNumQueries(len(queries)):
+            response = self.url_get('unicef', url)
+        self.assertContains(response, 'glyphicon-ok', count=3)
+        self.assertContains(response, 'glyphicon-time', count=2)
+
     def test_delete(self):
         # log in as an org administrator
         self.login(self.admin)
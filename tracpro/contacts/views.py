@@ -2,8 +2,6 @@ from __future__ import absolute_import, unicode_literals
 
 from collections import OrderedDict
 
-import pycountry
-
 from dash.orgs.views import OrgPermsMixin, OrgObjPermsMixin
 from dash.utils import get_obj_cacheable
 from dash.utils.sync import ChangeType
@@ -17,6 +15,7 @@ from smartmin.users.views import (
 
 from tracpro.polls.models import PollRun, Response
 
+from . import languages
 from .fields import URN_SCHEME_CHOICES
 from .forms import ContactForm
 from .models import Contact
@@ -24,7 +23,7 @@ from .models import Contact
 
 class ContactCRUDL(SmartCRUDL):
     model = Contact
-    actions = ('create', 'read', 'update', 'delete', 'list')
+    actions = ('create', 'read', 'update', 'delete', 'list', 'search')
 
     class ContactBase(object):
 
@@ -40,21 +39,15 @@ class ContactCRUDL(SmartCRUDL):
             if 'initial' in self.request.POST or 'initial' in self.request.GET:
                 initial = self.request.POST.get('initial', self.request.GET.get('initial'))
                 results = []
-                if initial:
-                    lang = pycountry.languages.get(bibliographic=initial)
-                    name = lang.name.split(';')[0]
-                    results.append(dict(id=lang.bibliographic, text=name))
+                name = languages.get_name(initial) if initial else None
+                if name:
+                    results.append(dict(id=initial, text=name.split(';')[0]))
                 return JsonResponse(dict(results=results))
 
             if 'search' in self.request.GET or 'search' in self.request.POST:
                 search = self.request.POST.get('search', self.request.GET.get('search'))
-                search = search.strip().lower()
-                results = []
-                for lang in pycountry.languages:
-                    if len(results) == 10:
-                        break
-                    if len(search) == 0 or search in lang.name.lower():
-                        results.append(dict(id=lang.bibliographic, text=lang.name))
+                results = [dict(id=code, text=name)
+                           for code, name in languages.search(search, limit=10)]
                 return JsonResponse(dict(results=results))
 
             return super(ContactCRUDL.ContactFormMixin, self).get(request, *args, **kwargs)
@@ -68,7 +61,7 @@ class ContactCRUDL(SmartCRUDL):
 
         def get_language(self, obj):
             if obj.language:
-                return pycountry.languages.get(bibliographic=obj.language).name
+                return languages.get_name(obj.language)
             return None
 
         def get_urn(self, obj):
@@ -119,9 +112,9 @@ class ContactCRUDL(SmartCRUDL):
 
         def lookup_field_value(self, context, obj, field):
             if field in self.data_fields:
-                value = self.data_fields.get(field).contactfield_set.filter(contact=obj)
-                value = value.first()
-                return value.get_value() or "-" if value else "Unknown"
+                if field not in obj.data_fields:
+                    return "Unknown"
+                return obj.get_data_field_value(self.data_fields.get(field)) or "-"
             return super(ContactCRUDL.Read, self).lookup_field_value(context, obj, field)
 
     class List(OrgPermsMixin, ContactFieldsMixin, ContactBase, SmartListView):
@@ -144,8 +137,7 @@ class ContactCRUDL(SmartCRUDL):
         def lookup_field_value(self, context, obj, field):
             if field.startswith('pollrun_'):
                 pollrun = self.derive_pollruns()[field]
-                has_completed = pollrun.responses.filter(
-                    contact=obj, status=Response.STATUS_COMPLETE).exists()
+                has_completed = (pollrun.pk, obj.pk) in self.derive_completed(context)
                 return ('<span class="glyphicon glyphicon-%s"></span>' %
                         ('ok' if has_completed else 'time'))
 
@@ -171,13 +163,49 @@ class ContactCRUDL(SmartCRUDL):
 
             return get_obj_cacheable(self, '_pollruns', fetch)
 
+        def derive_completed(self, context):
+            """Return (pollrun id, contact id) pairs of complete responses.
+
+            Covers the derived pollruns and the contacts on the current page.
+            """
+            def fetch():
+                pollrun_ids = [p.pk for p in self.derive_pollruns().values()]
+                contact_ids = [c.pk for c in context['object_list']]
+                responses = Response.objects.filter(
+                    pollrun__in=pollrun_ids, contact__in=contact_ids,
+                    status=Response.STATUS_COMPLETE)
+                return set(responses.values_list('pollrun', 'contact'))
+
+            return get_obj_cacheable(self, '_completed', fetch)
+
         def derive_queryset(self, **kwargs):
             qs = super(ContactCRUDL.List, self).derive_queryset(**kwargs)
             qs = qs.filter(org=self.request.org, is_active=True)
-            if self.request.data_regions is not None:
-                qs = qs.filter(region__in=self.request.data_regions)
+            if self.request.data_region_ids is not None:
+                qs = qs.filter(region__in=self.request.data_region_ids)
             return qs
 
+    class Search(OrgPermsMixin, SmartListView):
+        """The best matching contacts for the search text, as JSON."""
+        max_results = 20
+
+        def get(self, request, *args, **kwargs):
+            text = self.request.GET.get('search', '')
+            results = []
+            if text.strip():
+                # Search the selected regions, or else all of the user's regions.
+                region_ids = self.request.data_region_ids
+                if region_ids is None:
+                    region_ids = self.request.user_region_ids
+                contacts = Contact.objects.by_org(self.request.org).search(text, region_ids)
+                contacts = contacts.select_related('region')[:self.max_results]
+                results = [{'id': c.pk, 'name': c.name, 'urn': c.get_urn()[1],
+                            'region': c.region.name} for c in contacts]
+            return JsonResponse({
+                'count': len(results),
+                'results': results,
+            })
+
     class Delete(OrgObjPermsMixin, ContactBase, SmartDeleteView):
         cancel_url = '@contacts.contact_list'
         redirect_url = '@contacts.contact_list'
@@ -0,0 +1 @@
+default_app_config = "tracpro.groups.apps.GroupConfig"
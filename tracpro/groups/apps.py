@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class GroupConfig(AppConfig):
+    name = "tracpro.groups"
+
+    def ready(self):
+        from . import signals  # noqa
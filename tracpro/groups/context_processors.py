@@ -1,10 +1,16 @@
+from __future__ import absolute_import, unicode_literals
+
+from dash.utils import get_obj_cacheable
 
 
 def show_subregions_toggle_form(request):
-    show = False
-    if request.region:
-        if any(c in request.user_regions for c in request.region.get_descendants()):
-            show = True
+    def calculate():
+        # Show the toggle if the user can access any of the region's sub-regions.
+        if not request.region:
+            return False
+        descendant_ids = request.region.get_descendant_ids()
+        return any(pk in descendant_ids for pk in request.user_region_ids)
     return {
-        'show_subregions_toggle_form': show,
+        'show_subregions_toggle_form': get_obj_cacheable(
+            request, '_show_subregions_toggle_form', calculate),
     }
@@ -0,0 +1,145 @@
+"""Rolling counts of non-empty responses by region and reporter group.
+
+Counts are kept in a Redis sorted set per org, group type and UTC day, scored
+by group id, and are updated as responses are ingested. The counts for a
+window of time are the sum of the daily buckets that it covers.
+
+The buckets for an org are rebuilt from the database once a day by the
+RebuildOrgLeaderboards task, so that they catch up with responses which were
+not created through ingestion, and with responses whose region or group has
+been corrected. Requests only read the buckets.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from collections import Counter, defaultdict
+import datetime
+
+from django.db.models import Count
+from django.utils import timezone
+
+from django_redis import get_redis_connection
+import pytz
+
+
+MOST_ACTIVE_KEY = 'org:{org}:most_active:{kind}:{day}'
+
+MOST_ACTIVE_BUILT_KEY = 'org:{org}:most_active_built'
+
+# Keep daily buckets for a little longer than the longest Window.
+MOST_ACTIVE_DAYS = 160
+
+MOST_ACTIVE_REBUILD_INTERVAL = 60 * 60 * 24  # 1 day
+
+KINDS = ('region', 'group')
+
+
+def get_day(value):
+    """Return the UTC date of the datetime."""
+    return value.astimezone(pytz.UTC).date()
+
+
+def get_key(org_id, kind, day):
+    return MOST_ACTIVE_KEY.format(org=org_id, kind=kind, day=day.isoformat())
+
+
+def get_entries(responses):
+    """Return the leaderboard entries of the active, non-empty responses.
+
+    Each entry is a tuple of updated_on, region id and group id. Call this
+    before responses are retired or changed, so that their counts can be
+    removed.
+    """
+    from tracpro.polls.models import Response
+    responses = responses.filter(is_active=True).exclude(status=Response.STATUS_EMPTY)
+    return list(responses.values_list(
+        'updated_on', 'region_id', 'group_id'))
+
+
+def update(org_id, added=(), removed=()):
+    """Add and remove leaderboard entries for the org.
+
+    Entries of None, for responses which are not counted, are ignored.
+    """
+    deltas = Counter()
+    for entries, delta in ((added, 1), (removed, -1)):
+        for updated_on, region_id, group_id in filter(None, entries):
+            day = get_day(updated_on)
+            for kind, pk in zip(KINDS, (region_id, group_id)):
+                if pk is not None:
+                    deltas[(kind, day, pk)] += delta
+
+    oldest = get_day(timezone.now()) - datetime.timedelta(days=MOST_ACTIVE_DAYS)
+    deltas = {k: v for k, v in deltas.items() if v and k[1] > oldest}
+    if not deltas:
+        return
+
+    pipe = get_redis_connection().pipeline(transaction=False)
+    for (kind, day, pk), delta in deltas.items():
+        key = get_key(org_id, kind, day)
+        pipe.zincrby(key, pk, delta)
+        pipe.expire(key, MOST_ACTIVE_DAYS * 24 * 60 * 60)
+    pipe.execute()
+
+
+def get_counts(org, kind, window):
+    """Return the number of non-empty responses per group id in the window.
+
+    The window is widened to whole UTC days.
+    """
+    window_min, window_max = window.to_range()
+    first_day = get_day(window_min)
+    last_day = get_day(window_max - datetime.timedelta(microseconds=1))
+    num_days = (last_day - first_day).days + 1
+
+    pipe = get_redis_connection().pipeline(transaction=False)
+    for offset in range(num_days):
+        day = first_day + datetime.timedelta(days=offset)
+        pipe.zrange(get_key(org.pk, kind, day), 0, -1, withscores=True)
+
+    counts = defaultdict(int)
+    for bucket in pipe.execute():
+        for pk, score in bucket:
+            counts[int(pk)] += int(score)
+    return {pk: count for pk, count in counts.items() if count > 0}
+
+
+def rebuild_if_due(org):
+    """Rebuild the org's daily buckets if they haven't been rebuilt in the last day.
+
+    Returns whether the buckets were rebuilt.
+    """
+    if get_redis_connection().exists(MOST_ACTIVE_BUILT_KEY.format(org=org.pk)):
+        return False
+    rebuild(org)
+    return True
+
+
+def rebuild(org):
+    """Replace the org's daily buckets with counts from the database."""
+    from tracpro.polls.models import Response
+
+    today = get_day(timezone.now())
+    days = [today - datetime.timedelta(days=offset) for offset in range(MOST_ACTIVE_DAYS)]
+    start = datetime.datetime.combine(days[-1], datetime.time.min).replace(tzinfo=pytz.UTC)
+
+    responses = Response.objects.filter(
+        org=org, is_active=True, updated_on__gte=start)
+    responses = responses.exclude(status=Response.STATUS_EMPTY)
+    responses = responses.extra(select={
+        'day': "DATE(polls_response.updated_on AT TIME ZONE 'UTC')",
+    })
+
+    pipe = get_redis_connection().pipeline()
+    pipe.delete(*[get_key(org.pk, kind, day) for kind in KINDS for day in days])
+    for kind in KINDS:
+        counts = responses.filter(**{'%s__isnull' % kind: False})
+        counts = counts.values('day', kind).annotate(count=Count('pk'))
+        buckets = defaultdict(dict)
+        for count in counts:
+            buckets[count['day']][str(count[kind])] = count['count']
+        for day, scores in buckets.items():
+            key = get_key(org.pk, kind, day)
+            pipe.zadd(key, **scores)
+            pipe.expire(key, MOST_ACTIVE_DAYS * 24 * 60 * 60)
+    pipe.set(MOST_ACTIVE_BUILT_KEY.format(org=org.pk), 1, ex=MOST_ACTIVE_REBUILD_INTERVAL)
+    pipe.execute()
@@ -1,19 +1,84 @@
 from __future__ import absolute_import, unicode_literals
 
+from dash.utils import get_cacheable
+
+from .models import Region, get_region_access_version
+
+
+REGION_CONTEXT_KEY = (
+    'org:{org}:user:{user}:region_context:{region}:{subregions}:{tree}:{access}')
+
+REGION_CONTEXT_TTL = 60 * 60  # 1 hour
+
 
 class UserRegionsMiddleware(object):
 
     def process_request(self, request):
-        """Store commonly-used region variables on the request."""
-        self.set_user_regions(request)
-        self.set_include_subregions(request)
-        self.set_region(request)
-        self.set_data_regions(request)
+        """Store commonly-used region variables on the request.
 
-    def set_user_regions(self, request):
-        # Determine the org regions the user has access to.
+        The region ids are cached per user, org, selected region and
+        include_subregions, until the org's region hierarchy or the user's
+        region access changes.
+        """
+        self.set_include_subregions(request)
         if request.org and request.user.is_authenticated():
-            request.user_regions = request.user.get_all_regions(request.org)
+            context = self.get_region_context(request)
+        else:
+            context = {
+                'user_region_ids': None,
+                'region_id': None,
+                'data_region_ids': None,
+            }
+        self.set_user_regions(request, context['user_region_ids'])
+        self.set_region(request, context['region_id'])
+        self.set_data_regions(request, context['data_region_ids'])
+
+    def get_region_context(self, request):
+        """Return the ids of the user's regions, current region and data regions."""
+        org, user = request.org, request.user
+        session_region_id = request.session.get('{org}:region_id'.format(org=org.pk))
+
+        def calculate():
+            user_region_ids = list(user.get_all_regions(org).values_list('pk', flat=True))
+
+            # Find the currently-active region.
+            region_id = int(session_region_id) if session_region_id else None
+            if region_id not in user_region_ids:
+                region_id = None
+            if region_id is None and not user.is_admin_for(org):
+                # Only org admins may see "All Regions".
+                region_id = user_region_ids[0] if user_region_ids else None
+
+            # Calculate which org regions to retrieve data for.
+            if region_id is None:
+                data_region_ids = None
+            elif request.include_subregions:
+                tree = Region.get_tree(org.pk)
+                descendant_ids = tree.get_descendant_ids(region_id, include_self=True)
+                data_region_ids = [pk for pk in user_region_ids if pk in descendant_ids]
+            else:
+                data_region_ids = [region_id]
+
+            return {
+                'user_region_ids': user_region_ids,
+                'region_id': region_id,
+                'data_region_ids': data_region_ids,
+            }
+
+        cache_key = REGION_CONTEXT_KEY.format(
+            org=org.pk,
+            user=user.pk,
+            region=session_region_id,
+            subregions=int(request.include_subregions),
+            tree=Region.get_tree_version(org.pk),
+            access=get_region_access_version(user.pk))
+        return get_cacheable(cache_key, REGION_CONTEXT_TTL, calculate)
+
+    def set_user_regions(self, request, user_region_ids):
+        # The org regions the user has access to.
+        request.user_region_ids = user_region_ids
+        if user_region_ids is not None:
+            request.user_regions = Region.objects.filter(pk__in=user_region_ids)
         else:
             request.user_regions = None
 
@@ -21,26 +86,17 @@ class UserRegionsMiddleware(object):
         # Whether or not sub-region data should be included.
         request.include_subregions = request.session.get('include_subregions', True)
 
-    def set_region(self, request):
-        # Find the currently-active region.
-        if request.org and request.user.is_authenticated():
-            region_id = request.session.get(
-                '{org}:region_id'.format(org=request.org.pk))
-            region = request.user_regions.filter(pk=region_id).first()
-            if not region and not request.user.is_admin_for(request.org):
-                # Only org admins may see "All Regions".
-                region = request.user_regions.first()
-            request.region = region
+    def set_region(self, request, region_id):
+        # The currently-active region.
+        if region_id is not None:
+            request.region = Region.objects.filter(pk=region_id).first()
         else:
             request.region = None
 
-    def set_data_regions(self, request):
-        # Calculate which org regions to retrieve data for.
-        if request.region:
-            if request.include_subregions:
-                request.data_regions = request.region.get_descendants(include_self=True)
-                request.data_regions = request.data_regions.filter(pk__in=request.user_regions)
-            else:
-                request.data_regions = [request.region]
+    def set_data_regions(self, request, data_region_ids):
+        # The org regions to retrieve data for.
+        request.data_region_ids = data_region_ids
+        if data_region_ids is not None:
+            request.data_regions = Region.objects.filter(pk__in=data_region_ids)
         else:
             request.data_regions = None
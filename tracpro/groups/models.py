@@ -1,14 +1,52 @@
 from __future__ import absolute_import, unicode_literals
 
+from collections import defaultdict
+
 from mptt import models as mptt
+from mptt.managers import TreeManager
 
 from django.conf import settings
-from django.db import models, transaction
-from django.db.models import Count
+from django.db import connection, models, transaction
+from django.db.models import Count, Max
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 
+from dash.utils import get_obj_cacheable
+
 from tracpro.contacts.tasks import SyncOrgContacts
+from tracpro.utils import bulk_update, bump_version, get_version
+
+from . import leaderboards
+from .tasks import bump_versions
+
+
+REGION_TREE_VERSION_KEY = 'org:%d:region_tree_version'
+
+REGION_ACCESS_VERSION_KEY = 'user:%d:region_access_version'
+
+# Key of the transaction-level advisory lock which serializes the allocation
+# of new region tree ids across orgs.
+REGION_TREE_ID_LOCK = 4127001
+
+# Region trees built by this process, by org id.
+_region_trees = {}
+
+
+def get_region_access_version(user_id):
+    """Return a version token for the user's region and org admin access."""
+    return get_version(REGION_ACCESS_VERSION_KEY % user_id)
+
+
+def bump_region_access_version(user_ids):
+    """Invalidate cached region access for each of the users.
+
+    The versions are bumped again once the current transaction is committed.
+    """
+    keys = [REGION_ACCESS_VERSION_KEY % user_id for user_id in user_ids]
+    for key in keys:
+        bump_version(key)
+    if keys:
+        bump_versions.delay(keys)
 
 
 @python_2_unicode_compatible
@@ -31,46 +69,103 @@ class AbstractGroup(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        super(AbstractGroup, self).save(*args, **kwargs)
+        self.clear_uuid_map(self.org)
+
     def deactivate(self):
         self.is_active = False
         self.save()
 
     @classmethod
     def sync_with_temba(cls, org, uuids):
-        """Sync org groups with the selected UUIDs."""
-        # De-activate any groups that are not specified.
-        other_groups = cls.objects.filter(org=org, is_active=True)
-        other_groups = other_groups.exclude(uuid__in=uuids)
-        for group in other_groups:
-            group.deactivate()
+        """Sync org groups with the selected UUIDs.
 
+        Groups are created, updated and deactivated in bulk. Contacts are
+        only re-synced if groups were created, reactivated or deactivated.
+        """
         # Fetch group details at once.
         temba_groups = org.get_temba_client().get_groups()
         temba_groups = {g.uuid: g.name for g in temba_groups}
 
-        for uuid in uuids:
-            if uuid in temba_groups:
-                # Create a new item or update an existing one.
-                obj, _ = cls.objects.get_or_create(org=org, uuid=uuid)
-                obj.is_active = True
-                obj.name = temba_groups.get(uuid)
-                obj.save()
-            else:
-                # The group was removed remotely and should be removed locally.
-                obj = cls.objects.filter(org=org, uuid=uuid).first()
-                if obj:
-                    obj.deactivate()
+        # Groups that were removed remotely should be removed locally.
+        selected = set(uuids) & set(temba_groups)
+
+        existing = cls.objects.filter(org=org).values_list('uuid', 'pk', 'name', 'is_active')
+        existing = {uuid: (pk, name, is_active) for uuid, pk, name, is_active in existing}
+
+        to_create = [cls(org=org, uuid=uuid, name=temba_groups[uuid])
+                     for uuid in selected if uuid not in existing]
+        to_update = []
+        to_deactivate = []
+        for uuid, (pk, name, is_active) in existing.items():
+            if uuid in selected:
+                if not is_active or name != temba_groups[uuid]:
+                    to_update.append((pk, temba_groups[uuid], True))
+            elif is_active:
+                to_deactivate.append(pk)
+        reactivated = any(not existing[uuid][2] for uuid in selected if uuid in existing)
+
+        with transaction.atomic():
+            if to_deactivate:
+                cls._sync_deactivate(org, to_deactivate)
+            if to_create:
+                cls._sync_create(to_create)
+            if to_update:
+                bulk_update(cls, ['name', 'is_active'], to_update)
+
+        cls.clear_uuid_map(org)
 
-        SyncOrgContacts.delay(org.pk)
+        if to_create or to_deactivate or reactivated:
+            from tracpro.contacts.models import Contact
+            Contact.clear_unresolved(org.pk)
+            SyncOrgContacts.delay(org.pk)
+
+    @classmethod
+    def _sync_create(cls, groups):
+        cls.objects.bulk_create(groups)
+
+    @classmethod
+    def _sync_deactivate(cls, org, pks):
+        cls.objects.filter(pk__in=pks).update(is_active=False)
 
     @classmethod
     def get_all(cls, org):
         return cls.objects.filter(org=org, is_active=True)
 
+    @classmethod
+    def get_uuid_map(cls, org):
+        """Return the org's active groups by UUID.
+
+        The map is kept on the org instance, so that it is built once per
+        request or task, until groups of the org are changed through it.
+        """
+        def calculate():
+            return {group.uuid: group for group in cls.get_all(org)}
+        return get_obj_cacheable(org, cls._uuid_map_attr(), calculate)
+
+    @classmethod
+    def clear_uuid_map(cls, org):
+        org.__dict__.pop(cls._uuid_map_attr(), None)
+
+    @classmethod
+    def _uuid_map_attr(cls):
+        return '_%s_uuid_map' % cls.__name__.lower()
+
     @classmethod
     def get_response_counts(cls, org, window=None, include_empty=False):
+        """Return the number of responses in the window by active group id.
+
+        Counts of non-empty responses within a window are read from the
+        org's leaderboard, which counts whole UTC days.
+        """
         from tracpro.polls.models import Response
-        qs = Response.objects.filter(pollrun__poll__org=org, is_active=True)
+        if window and not include_empty:
+            counts = leaderboards.get_counts(org, cls.__name__.lower(), window)
+            active_ids = cls.get_all(org).filter(pk__in=counts).values_list('pk', flat=True)
+            return {pk: counts[pk] for pk in active_ids}
+
+        qs = Response.objects.filter(org=org, is_active=True)
 
         if not include_empty:
             qs = qs.exclude(status=Response.STATUS_EMPTY)
@@ -79,7 +174,7 @@ class AbstractGroup(models.Model):
             window_min, window_max = window.to_range()
             qs = qs.filter(updated_on__gte=window_min, updated_on__lt=window_max)
 
-        field = 'contact__%s' % cls.__name__.lower()
+        field = cls.__name__.lower()
 
         qs = qs.filter(**{'%s__is_active' % field: True})
         counts = qs.values(field).annotate(count=Count(field))
@@ -102,6 +197,125 @@ class AbstractGroup(models.Model):
         return self.contacts.filter(is_active=True)
 
 
+class RegionTree(object):
+    """In-memory copy of the region hierarchy for an org.
+
+    Trees are built once per process and shared between requests until the
+    org's tree version changes (see Region.get_tree).
+    """
+
+    def __init__(self, version, parents):
+        """Create a tree from a mapping of region id to parent id."""
+        self.version = version
+        self.parents = dict(parents)
+        self.children = defaultdict(list)
+        for region_id, parent_id in self.parents.items():
+            if parent_id is not None:
+                self.children[parent_id].append(region_id)
+        self._descendants = {}
+
+    def get_ancestor_ids(self, region_id, include_self=False):
+        """Return ids of the region's ancestors, starting from the root."""
+        ancestors = [region_id] if include_self else []
+        parent_id = self.parents.get(region_id)
+        while parent_id is not None:
+            ancestors.append(parent_id)
+            parent_id = self.parents.get(parent_id)
+        return ancestors[::-1]
+
+    def get_descendant_ids(self, region_id, include_self=False):
+        """Return the set of ids of the region's descendants."""
+        descendants = self._descendants.get(region_id)
+        if descendants is None:
+            descendants = set()
+            to_visit = list(self.children.get(region_id, []))
+            while to_visit:
+                child_id = to_visit.pop()
+                descendants.add(child_id)
+                to_visit.extend(self.children.get(child_id, []))
+            descendants = self._descendants[region_id] = frozenset(descendants)
+        return descendants | {region_id} if include_self else descendants
+
+    def get_family_ids(self, region_id):
+        """Return the set of ids of the region, its ancestors and its descendants."""
+        family = self.get_descendant_ids(region_id, include_self=True)
+        return family.union(self.get_ancestor_ids(region_id))
+
+
+class RegionManager(TreeManager):
+
+    def rebuild(self):
+        super(RegionManager, self).rebuild()
+        org_ids = self.model.objects.order_by().values_list('org', flat=True).distinct()
+        for org_id in org_ids:
+            Region.bump_tree_version(org_id)
+
+    @transaction.atomic
+    def rebuild_org(self, org):
+        """Rebuild the MPTT fields of the org's regions from their parents.
+
+        Unlike rebuild(), only the org's own trees are locked and rewritten.
+        The org's roots reuse the org's existing tree ids where possible.
+        """
+        ordering = list(self.model._mptt_meta.order_insertion_by) + ['pk']
+        regions = self.filter(org=org).order_by(*ordering).select_for_update()
+        regions = regions.values_list('pk', 'parent_id', 'tree_id')
+
+        roots = []
+        children = defaultdict(list)
+        tree_ids = set()
+        for pk, parent_id, tree_id in regions:
+            if parent_id is None:
+                roots.append(pk)
+            else:
+                children[parent_id].append(pk)
+            tree_ids.add(tree_id)
+
+        # Allocate a tree id for each root, adding new ones after the highest
+        # tree id in use if the org now has more roots. Tree id 0 is used for
+        # regions created while MPTT updates are disabled, so is never reused.
+        tree_ids.discard(0)
+        tree_ids = sorted(tree_ids)
+        if len(roots) > len(tree_ids):
+            # Only the org's own rows are locked above, so another org could
+            # otherwise read the same highest tree id concurrently.
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", [REGION_TREE_ID_LOCK])
+            next_tree_id = (self.aggregate(max_id=Max('tree_id'))['max_id'] or 0) + 1
+            tree_ids.extend(range(next_tree_id, next_tree_id + len(roots) - len(tree_ids)))
+
+        rows = []
+        for root, tree_id in zip(roots, tree_ids):
+            # Walk each tree depth-first, numbering nodes as they are entered
+            # and left.
+            counter = 1
+            lefts = {root: 1}
+            stack = [(root, 0, iter(children[root]))]
+            while stack:
+                pk, level, remaining = stack[-1]
+                child = next(remaining, None)
+                if child is not None:
+                    counter += 1
+                    lefts[child] = counter
+                    stack.append((child, level + 1, iter(children[child])))
+                else:
+                    counter += 1
+                    rows.append((pk, lefts[pk], counter, level, tree_id))
+                    stack.pop()
+
+        bulk_update(self.model, ['lft', 'rght', 'level', 'tree_id'], rows)
+        Region.bump_tree_version(org.pk)
+
+    @transaction.atomic
+    def update_parents(self, org, parents):
+        """Set the parent of each of the org's regions, then rebuild the org's trees.
+
+        parents maps region id to parent id (or None).
+        """
+        bulk_update(self.model, ['parent'], parents.items())
+        self.rebuild_org(org)
+
+
 class Region(mptt.MPTTModel, AbstractGroup):
     """A geographical region modelled as a group."""
     users = models.ManyToManyField(
@@ -110,23 +324,64 @@ class Region(mptt.MPTTModel, AbstractGroup):
     parent = mptt.TreeForeignKey(
         'self', null=True, blank=True, related_name="children", db_index=True)
 
+    objects = RegionManager()
+
     class MPTTMeta:
         order_insertion_by = ['name']
 
+    def save(self, *args, **kwargs):
+        super(Region, self).save(*args, **kwargs)
+        Region.bump_tree_version(self.org_id)
+
+    def delete(self, *args, **kwargs):
+        super(Region, self).delete(*args, **kwargs)
+        Region.bump_tree_version(self.org_id)
+
+    @classmethod
+    def get_tree(cls, org_id):
+        """Return the RegionTree for the org, rebuilding it if it has changed."""
+        version = cls.get_tree_version(org_id)
+        tree = _region_trees.get(org_id)
+        if tree is None or tree.version != version:
+            parents = cls.objects.filter(org_id=org_id).order_by()
+            tree = RegionTree(version, parents.values_list('pk', 'parent_id'))
+            _region_trees[org_id] = tree
+        return tree
+
+    @classmethod
+    def get_tree_version(cls, org_id):
+        """Return a version token for the org's region hierarchy."""
+        return get_version(REGION_TREE_VERSION_KEY % org_id)
+
+    @classmethod
+    def bump_tree_version(cls, org_id):
+        """Invalidate the org's RegionTree in every process.
+
+        The version is bumped again once the current transaction is committed,
+        so that trees built from the old parents in the meantime are replaced.
+        """
+        key = REGION_TREE_VERSION_KEY % org_id
+        bump_version(key)
+        bump_versions.delay([key])
+
+    def get_ancestor_ids(self, include_self=False):
+        return Region.get_tree(self.org_id).get_ancestor_ids(self.pk, include_self)
+
+    def get_descendant_ids(self, include_self=False):
+        return Region.get_tree(self.org_id).get_descendant_ids(self.pk, include_self)
+
     @transaction.atomic
     def deactivate(self):
         # Make this region's parent the parent of all of its children.
-        with Region.objects.disable_mptt_updates():
-            for child in self.get_children():
-                child.parent = self.parent
-                child.save()
-        Region.objects.rebuild()
+        Region.objects.filter(parent=self).update(parent=self.parent)
 
         # Move this node out of the tree.
         # If this region is re-activated, it will appear at the top level.
         self.parent = None
 
-        super(Region, self).deactivate()
+        with Region.objects.disable_mptt_updates():
+            super(Region, self).deactivate()
+        Region.objects.rebuild_org(self.org)
 
     def get_users(self):
         return self.users.filter(is_active=True).select_related('profile')
@@ -134,8 +389,42 @@ class Region(mptt.MPTTModel, AbstractGroup):
     @classmethod
     def sync_with_temba(cls, org, uuids):
         """Rebuild the tree hierarchy after new nodes are added."""
-        super(Region, cls).sync_with_temba(org, uuids)
-        Region.objects.rebuild()
+        with transaction.atomic():
+            super(Region, cls).sync_with_temba(org, uuids)
+            Region.objects.rebuild_org(org)
+
+    @classmethod
+    def _sync_create(cls, regions):
+        """Create new top-level regions.
+
+        The MPTT fields are placeholders until Region.objects.rebuild_org()
+        is called.
+        """
+        for region in regions:
+            region.lft, region.rght, region.level, region.tree_id = 1, 2, 0, 0
+        super(Region, cls)._sync_create(regions)
+
+    @classmethod
+    def _sync_deactivate(cls, org, pks):
+        """Deactivate regions and move them out of the tree.
+
+        Children of a deactivated region are moved to its nearest ancestor
+        that remains active. Region.objects.rebuild_org() must be called
+        afterwards.
+        """
+        pks = set(pks)
+        parents = dict(cls.objects.filter(org=org).values_list('pk', 'parent_id'))
+
+        new_parents = []
+        for pk, parent_id in parents.items():
+            if pk in pks or parent_id not in pks:
+                continue
+            while parent_id in pks:
+                parent_id = parents[parent_id]
+            new_parents.append((pk, parent_id))
+        bulk_update(cls, ['parent'], new_parents)
+
+        cls.objects.filter(pk__in=pks).update(is_active=False, parent=None)
 
 
 class Group(AbstractGroup):
@@ -0,0 +1,36 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+
+from dash.orgs.models import Org
+
+from .models import Region, bump_region_access_version
+
+
+def _get_changed_user_ids(instance, action, pk_set, related_users):
+    """Return ids of the users whose access changed with an m2m change."""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return []
+    if isinstance(instance, User):
+        return [instance.pk]
+    if action == 'pre_clear':
+        return list(related_users.values_list('pk', flat=True))
+    return pk_set
+
+
+@receiver(m2m_changed, sender=Region.users.through)
+def region_users_changed(sender, instance, action, pk_set, **kwargs):
+    """Invalidate cached region access when region users change."""
+    related_users = instance.users.all() if isinstance(instance, Region) else None
+    bump_region_access_version(
+        _get_changed_user_ids(instance, action, pk_set, related_users))
+
+
+@receiver(m2m_changed, sender=Org.administrators.through)
+def org_administrators_changed(sender, instance, action, pk_set, **kwargs):
+    """Invalidate cached region access when org administrators change."""
+    related_users = instance.administrators.all() if isinstance(instance, Org) else None
+    bump_region_access_version(
+        _get_changed_user_ids(instance, action, pk_set, related_users))
@@ -0,0 +1,32 @@
+from __future__ import absolute_import, unicode_literals
+
+from djcelery_transactions import task
+
+from tracpro.orgs_ext.tasks import OrgTask
+from tracpro.utils import bump_version
+
+from . import leaderboards
+
+
+@task
+def bump_versions(keys):
+    """Replace the version tokens stored at the cache keys.
+
+    Changes made in a transaction queue this task so that their versions are
+    bumped again once they are committed. Until then, other processes may
+    cache data read from the old state under the version bumped earlier.
+    """
+    for key in keys:
+        bump_version(key)
+
+
+@task
+class RebuildOrgLeaderboards(OrgTask):
+
+    def org_task(self, org):
+        """Rebuild the org's most active leaderboards once a day.
+
+        Only one rebuild runs at a time for each org, so that concurrent
+        rebuilds can't overwrite each other's counts.
+        """
+        leaderboards.rebuild_if_due(org)
@@ -0,0 +1,42 @@
+from django.test import RequestFactory
+
+from tracpro.test import factories
+from tracpro.test.cases import TracProTest
+
+from ..context_processors import show_subregions_toggle_form
+
+
+class TestShowSubregionsToggleForm(TracProTest):
+
+    def setUp(self):
+        super(TestShowSubregionsToggleForm, self).setUp()
+        self.org = factories.Org()
+        self.kenya = factories.Region(org=self.org, name="Kenya")
+        self.nairobi = factories.Region(org=self.org, name="Nairobi", parent=self.kenya)
+
+    def get_request(self, region, user_region_ids):
+        request = RequestFactory().get("/")
+        request.region = region
+        request.user_region_ids = user_region_ids
+        return request
+
+    def test_no_region(self):
+        request = self.get_request(None, None)
+        context = show_subregions_toggle_form(request)
+        self.assertFalse(context['show_subregions_toggle_form'])
+
+    def test_no_subregions(self):
+        request = self.get_request(self.nairobi, [self.kenya.pk, self.nairobi.pk])
+        context = show_subregions_toggle_form(request)
+        self.assertFalse(context['show_subregions_toggle_form'])
+
+    def test_subregions(self):
+        request = self.get_request(self.kenya, [self.kenya.pk, self.nairobi.pk])
+        context = show_subregions_toggle_form(request)
+        self.assertTrue(context['show_subregions_toggle_form'])
+
+    def test_inaccessible_subregions(self):
+        """Sub-regions the user can't access should not be counted."""
+        request = self.get_request(self.kenya, [self.kenya.pk])
+        context = show_subregions_toggle_form(request)
+        self.assertFalse(context['show_subregions_toggle_form'])
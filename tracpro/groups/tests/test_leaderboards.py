@@ -0,0 +1,69 @@
+from __future__ import unicode_literals
+
+from dateutil.relativedelta import relativedelta
+
+from django.utils import timezone
+
+from tracpro.polls import models as polls
+from tracpro.test import factories
+from tracpro.test.cases import TracProDataTest
+
+from .. import leaderboards
+from .. import models
+
+
+class TestLeaderboards(TracProDataTest):
+
+    def setUp(self):
+        super(TestLeaderboards, self).setUp()
+        self.pollrun = factories.UniversalPollRun(poll=self.poll1)
+        self.five_days_ago = timezone.now() - relativedelta(days=5)
+
+    def create_response(self, contact, status=polls.Response.STATUS_COMPLETE):
+        return factories.Response(
+            pollrun=self.pollrun, contact=contact,
+            created_on=self.five_days_ago, updated_on=self.five_days_ago,
+            status=status)
+
+    def test_rebuild(self):
+        """Counts are rebuilt from the database once a day, and not when they are read."""
+        self.create_response(self.contact1)
+        self.create_response(self.contact2)
+        self.create_response(self.contact4, status=polls.Response.STATUS_EMPTY)
+
+        self.assertEqual(
+            leaderboards.get_counts(self.unicef, 'region', polls.Window.last_30_days), {})
+
+        self.assertTrue(leaderboards.rebuild_if_due(self.unicef))
+        self.assertFalse(leaderboards.rebuild_if_due(self.unicef))
+
+        counts = leaderboards.get_counts(self.unicef, 'region', polls.Window.last_30_days)
+        self.assertEqual(counts, {self.region1.pk: 2})
+        counts = leaderboards.get_counts(self.unicef, 'group', polls.Window.last_30_days)
+        self.assertEqual(counts, {self.group1.pk: 2})
+
+    def test_update(self):
+        """Ingested responses move counts without rebuilding."""
+        leaderboards.rebuild(self.unicef)
+        response = self.create_response(self.contact1)
+        leaderboards.update(self.unicef.pk, added=[response.get_leaderboard_entry()])
+        self.assertEqual(
+            models.Region.get_response_counts(self.unicef, polls.Window.last_30_days),
+            {self.region1.pk: 1})
+
+        response.status = polls.Response.STATUS_EMPTY
+        leaderboards.update(
+            self.unicef.pk,
+            added=[response.get_leaderboard_entry()],
+            removed=[(response.updated_on, self.region1.pk, self.group1.pk)])
+        self.assertEqual(
+            models.Region.get_response_counts(self.unicef, polls.Window.last_30_days), {})
+        self.assertEqual(
+            models.Group.get_response_counts(self.unicef, polls.Window.last_30_days), {})
+
+    def test_inactive_groups(self):
+        """Inactive groups are left out of the counts."""
+        self.create_response(self.contact1)
+        self.region1.deactivate()
+        self.assertEqual(
+            models.Region.get_response_counts(self.unicef, polls.Window.last_30_days), {})
@@ -1,4 +1,4 @@
-from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import AnonymousUser, User
 from django.test import RequestFactory
 
 from tracpro.test import factories
@@ -15,6 +15,7 @@ class TestUserRegionsMiddleware(TracProTest):
         self.middleware = UserRegionsMiddleware()
         self.org = factories.Org()
         self.user = factories.User()
+        self.session_key = '{}:region_id'.format(self.org.pk)
 
     def get_request(self, **kwargs):
         request_kwargs = {'HTTP_HOST': "{}.testserver".format(self.org.subdomain)}
@@ -53,29 +54,65 @@ class TestUserRegionsMiddleware(TracProTest):
         self.assertTrue(hasattr(request, 'region'))
         self.assertTrue(hasattr(request, 'include_subregions'))
         self.assertTrue(hasattr(request, 'user_regions'))
+        self.assertTrue(hasattr(request, 'user_region_ids'))
         self.assertTrue(hasattr(request, 'data_regions'))
+        self.assertTrue(hasattr(request, 'data_region_ids'))
 
     def test_user_regions__unauthenticated(self):
         """User regions should be set to null for unauthenticated users."""
-        request = self.get_request(user=AnonymousUser(), org=self.org)
-        self.middleware.set_user_regions(request)
+        request = self.get_request(user=AnonymousUser(), org=self.org, session={})
+        self.middleware.process_request(request)
         self.assertIsNone(request.user_regions)
+        self.assertIsNone(request.user_region_ids)
 
     def test_user_regions__no_org(self):
         """User regions should be set to null for non-org views."""
-        request = self.get_request(user=self.user, org=None)
-        self.middleware.set_user_regions(request)
+        request = self.get_request(user=self.user, org=None, session={})
+        self.middleware.process_request(request)
         self.assertIsNone(request.user_regions)
+        self.assertIsNone(request.user_region_ids)
 
     def test_user_regions(self):
         """User regions should be set to the value of get_all_regions."""
         self.make_regions()
         self.region_kenya.users.add(self.user)
-        request = self.get_request(user=self.user, org=self.org)
-        self.middleware.set_user_regions(request)
+        request = self.get_request(user=self.user, org=self.org, session={})
+        self.middleware.process_request(request)
         self.assertEqual(
             set(request.user_regions),
             set([self.region_kenya, self.region_nairobi, self.region_mombasa]))
+        self.assertEqual(
+            set(request.user_region_ids),
+            set([self.region_kenya.pk, self.region_nairobi.pk, self.region_mombasa.pk]))
+
+    def test_user_regions__access_changed(self):
+        """Cached region ids should be invalidated when the user's access changes."""
+        self.make_regions()
+        self.region_kenya.users.add(self.user)
+        request = self.get_request(user=self.user, org=self.org, session={})
+        self.middleware.process_request(request)
+        self.assertEqual(len(request.user_region_ids), 3)
+
+        self.user.update_regions([self.region_nairobi])
+        request = self.get_request(
+            user=User.objects.get(pk=self.user.pk), org=self.org, session={})
+        self.middleware.process_request(request)
+        self.assertEqual(request.user_region_ids, [self.region_nairobi.pk])
+
+    def test_user_regions__hierarchy_changed(self):
+        """Cached region ids should be invalidated when the hierarchy changes."""
+        self.make_regions()
+        self.region_kenya.users.add(self.user)
+        request = self.get_request(user=self.user, org=self.org, session={})
+        self.middleware.process_request(request)
+        self.assertEqual(len(request.user_region_ids), 3)
+
+        self.region_entebbe.parent = self.region_kenya
+        self.region_entebbe.save()
+        request = self.get_request(
+            user=User.objects.get(pk=self.user.pk), org=self.org, session={})
+        self.middleware.process_request(request)
+        self.assertEqual(len(request.user_region_ids), 4)
 
     def test_include_subregions__default(self):
         """If key is not in the session, should default to True."""
@@ -97,83 +134,83 @@ class TestUserRegionsMiddleware(TracProTest):
 
     def test_data_regions__no_region(self):
         """If there is no current region, data_regions should be None."""
-        request = self.get_request(user=self.user, region=None)
-        self.middleware.set_data_regions(request)
+        self.org.administrators.add(self.user)
+        request = self.get_request(user=self.user, org=self.org, session={})
+        self.middleware.process_request(request)
         self.assertIsNone(request.data_regions)
+        self.assertIsNone(request.data_region_ids)
 
     def test_data_regions__include_subregions(self):
         """Include all subregions user has access to if include_subregions is True."""
         self.make_regions()
-        user_regions = Region.objects.filter(pk__in=(
-            self.region_uganda.pk, self.region_kenya.pk, self.region_nairobi.pk))
-        request = self.get_request(
-            user=self.user, region=self.region_kenya, include_subregions=True,
-            user_regions=user_regions)
-        self.middleware.set_data_regions(request)
+        self.region_kenya.users.add(self.user)
+        request = self.get_request(user=self.user, org=self.org, session={
+            'include_subregions': True,
+            self.session_key: str(self.region_kenya.pk),
+        })
+        self.middleware.process_request(request)
         self.assertEqual(
             set(request.data_regions),
-            set([self.region_kenya, self.region_nairobi]))
+            set([self.region_kenya, self.region_nairobi, self.region_mombasa]))
+        self.assertEqual(
+            set(request.data_region_ids),
+            set([self.region_kenya.pk, self.region_nairobi.pk, self.region_mombasa.pk]))
 
     def test_data_regions__exclude_subregions(self):
         """Include only the current region if include_subregions is False."""
         self.make_regions()
-        user_regions = Region.objects.filter(pk__in=(
-            self.region_uganda.pk, self.region_kenya.pk, self.region_nairobi.pk))
-        request = self.get_request(
-            user=self.user, region=self.region_kenya, include_subregions=False,
-            user_regions=user_regions)
-        self.middleware.set_data_regions(request)
-        self.assertEqual(
-            set(request.data_regions),
-            set([self.region_kenya]))
+        self.region_kenya.users.add(self.user)
+        request = self.get_request(user=self.user, org=self.org, session={
+            'include_subregions': False,
+            self.session_key: str(self.region_kenya.pk),
+        })
+        self.middleware.process_request(request)
+        self.assertEqual(list(request.data_regions), [self.region_kenya])
+        self.assertEqual(request.data_region_ids, [self.region_kenya.pk])
 
     def test_region__unauthenticated(self):
         """Current region should be None for an unauthenticated user."""
-        request = self.get_request(user=AnonymousUser(), org=self.org)
-        self.middleware.set_region(request)
+        request = self.get_request(user=AnonymousUser(), org=self.org, session={})
+        self.middleware.process_request(request)
         self.assertIsNone(request.region)
 
     def test_region__no_org(self):
         """Current region should be None if there is no current org."""
-        request = self.get_request(user=self.user, org=None)
-        self.middleware.set_region(request)
+        request = self.get_request(user=self.user, org=None, session={})
+        self.middleware.process_request(request)
         self.assertIsNone(request.region)
 
     def test_region__not_set__admin(self):
         """If region_id is not in the session, admin will see All Regions."""
         self.make_regions()
         self.org.administrators.add(self.user)
-        user_regions = Region.objects.filter(pk__in=(
-            self.region_uganda.pk, self.region_kenya.pk, self.region_nairobi.pk))
-        request = self.get_request(
-            user=self.user, org=self.org, session={}, user_regions=user_regions)
-        self.middleware.set_region(request)
+        request = self.get_request(user=self.user, org=self.org, session={})
+        self.middleware.process_request(request)
         self.assertIsNone(request.region)
 
     def test_region__not_set(self):
         """If region_id is not in the session, user will see first of their regions."""
         self.make_regions()
-        user_regions = Region.objects.filter(pk=self.region_kenya.pk)
-        request = self.get_request(
-            user=self.user, org=self.org, session={}, user_regions=user_regions)
-        self.middleware.set_region(request)
+        self.region_kenya.users.add(self.user)
+        request = self.get_request(user=self.user, org=self.org, session={})
+        self.middleware.process_request(request)
         self.assertEqual(request.region, self.region_kenya)
 
     def test_region__not_in_user_regions(self):
         """If region is not in user regions, return the first of the user's regions."""
         self.make_regions()
-        user_regions = Region.objects.filter(pk=self.region_kenya.pk)
-        request = self.get_request(
-            user=self.user, org=self.org, session={'region_id': self.region_nairobi.pk},
-            user_regions=user_regions)
-        self.middleware.set_region(request)
+        self.region_kenya.users.add(self.user)
+        request = self.get_request(user=self.user, org=self.org, session={
+            self.session_key: str(self.region_uganda.pk),
+        })
+        self.middleware.process_request(request)
         self.assertEqual(request.region, self.region_kenya)
 
     def test_region(self):
         self.make_regions()
-        user_regions = Region.objects.filter(pk=self.region_kenya.pk)
-        request = self.get_request(
-            user=self.user, org=self.org, session={'region_id': self.region_kenya.pk},
-            user_regions=user_regions)
-        self.middleware.set_region(request)
-        self.assertEqual(request.region, self.region_kenya)
+        self.region_kenya.users.add(self.user)
+        request = self.get_request(user=self.user, org=self.org, session={
+            self.session_key: str(self.region_nairobi.pk),
+        })
+        self.middleware.process_request(request)
+        self.assertEqual(request.region, self.region_nairobi)
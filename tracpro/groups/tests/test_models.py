@@ -1,3 +1,5 @@
+import mock
+
 from django.contrib.auth.models import User
 from django.test.utils import override_settings
 
@@ -70,6 +72,69 @@ class TestRegion(TracProTest):
             self.makerere,
         ]))
 
+    def test_get_tree(self):
+        """The region tree mirrors the org's region hierarchy."""
+        tree = models.Region.get_tree(self.org.pk)
+        self.assertEqual(
+            tree.get_ancestor_ids(self.makerere.pk),
+            [self.uganda.pk, self.kampala.pk])
+        self.assertEqual(
+            tree.get_descendant_ids(self.kampala.pk),
+            set([self.makerere.pk, self.inactive.pk]))
+        self.assertEqual(
+            tree.get_descendant_ids(self.kampala.pk, include_self=True),
+            set([self.kampala.pk, self.makerere.pk, self.inactive.pk]))
+        self.assertEqual(
+            tree.get_family_ids(self.kampala.pk),
+            set([self.uganda.pk, self.kampala.pk, self.makerere.pk, self.inactive.pk]))
+
+        # The tree is shared until the hierarchy changes.
+        self.assertIs(models.Region.get_tree(self.org.pk), tree)
+        self.makerere.deactivate()
+        tree = models.Region.get_tree(self.org.pk)
+        self.assertEqual(tree.get_ancestor_ids(self.makerere.pk), [])
+        self.assertEqual(tree.get_descendant_ids(self.kampala.pk), set([self.inactive.pk]))
+
+    def test_bump_tree_version_after_commit(self):
+        """The tree version is bumped again once the transaction is committed."""
+        key = models.REGION_TREE_VERSION_KEY % self.org.pk
+        with mock.patch.object(models.bump_versions, 'delay') as mock_delay:
+            models.Region.objects.rebuild_org(self.org)
+        mock_delay.assert_called_once_with([key])
+
+    def test_rebuild_org(self):
+        """Only the org's own trees are rebuilt from the parent links."""
+        other = factories.Region(name="Other")
+        other_mptt = (other.tree_id, other.lft, other.rght, other.level)
+
+        models.Region.objects.filter(pk=self.makerere.pk).update(parent=self.uganda)
+        models.Region.objects.rebuild_org(self.org)
+        self.refresh_regions()
+        other.refresh_from_db()
+
+        self.assertEqual(
+            set(self.uganda.get_descendants()),
+            set([self.kampala, self.entebbe, self.makerere, self.inactive]))
+        self.assertEqual(list(self.kampala.get_descendants()), [self.inactive])
+        self.assertEqual(self.makerere.level, 1)
+        self.assertEqual(
+            (other.tree_id, other.lft, other.rght, other.level), other_mptt)
+
+    def test_update_parents(self):
+        models.Region.objects.update_parents(self.org, {
+            self.kampala.pk: None,
+            self.entebbe.pk: self.kampala.pk,
+        })
+        self.refresh_regions()
+
+        self.assertIsNone(self.kampala.parent)
+        self.assertEqual(self.entebbe.parent, self.kampala)
+        self.assertEqual(list(self.uganda.get_descendants()), [])
+        self.assertEqual(
+            set(self.kampala.get_descendants()),
+            set([self.entebbe, self.makerere, self.inactive]))
+        self.assertNotEqual(self.uganda.tree_id, self.kampala.tree_id)
+
     def test_deactivate_no_children(self):
         """Deactivation workflow when region has no children."""
         self.makerere.deactivate()
@@ -135,7 +200,23 @@ class TestRegion(TracProTest):
         self.assertEqual(self.kampala.name, "Changed")
         self.assertEqual(self.kampala.parent, self.uganda)
         self.assertEqual(self.mock_temba_client.get_groups.call_count, 1)
-        self.assertEqual(self.mock_temba_client.get_contacts.call_count, 2)
+        # Contacts are not re-synced when only group names have changed.
+        self.assertEqual(self.mock_temba_client.get_contacts.call_count, 0)
+
+    def test_sync_deactivate_parent(self):
+        """Children of a deactivated region are moved to its parent."""
+        self.mock_temba_client.get_groups.return_value = self.temba_groups.values()
+        uuids = ['1', '3', '4']  # no Kampala
+        models.Region.sync_with_temba(self.org, uuids)
+        self.refresh_regions()
+
+        self.assertFalse(self.kampala.is_active)
+        self.assertIsNone(self.kampala.parent)
+        self.assertEqual(self.makerere.parent, self.uganda)
+        self.assertEqual(self.inactive.parent, self.uganda)
+        self.assertEqual(
+            set(self.uganda.get_descendants()),
+            set([self.entebbe, self.makerere, self.inactive]))
 
     def test_sync_reactivate(self):
         """Reactivate a group that existed previously."""
@@ -206,19 +206,21 @@ class RegionCRUDL(SmartCRUDL):
                 logger.warning("{} Hierarchy: {} {}".format(org, msg, raw_data))
                 return self.error_response(400, msg)
 
-            # Re-set parent values for each region, then rebuild the mptt tree.
-            with Region.objects.disable_mptt_updates():
-                for region_id, parent_id in data.items():
-                    region = regions.get(str(region_id))
-                    parent = regions.get(str(parent_id))
-                    if region.parent != parent:
-                        old = region.parent.name if region.parent else None
-                        new = parent.name if parent else None
-                        msg = "Updating parent of {} from {} -> {}".format(region, old, new)
-                        logger.debug("{} Hierarchy: {}".format(org, msg))
-                        region.parent = parent
-                        region.save()
-            Region.objects.rebuild()
+            # Re-set parent values for changed regions, then rebuild the
+            # org's mptt trees.
+            parents = {}
+            for region_id, parent_id in data.items():
+                region = regions.get(str(region_id))
+                parent = regions.get(str(parent_id))
+                parent_id = parent.pk if parent else None
+                if region.parent_id != parent_id:
+                    old_parent = regions.get(str(region.parent_id))
+                    old = old_parent.name if old_parent else None
+                    new = parent.name if parent else None
+                    msg = "Updating parent of {} from {} -> {}".format(region, old, new)
+                    logger.debug("{} Hierarchy: {}".format(org, msg))
+                    parents[region.pk] = parent_id
+            Region.objects.update_parents(org, parents)
 
             msg = '{} region hierarchy has been updated.'.format(org.name)
             logger.info("{} Hierarchy: {} {}".format(org, msg, raw_data))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0006_inboxmessage_1'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageBatch',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('number', models.PositiveIntegerField()),
+                ('contact_uuids', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=36), size=None)),
+                ('status', models.CharField(help_text='Current status of this batch', max_length=1, verbose_name='Status', choices=[('P', 'Pending'), ('S', 'Sent'), ('A', 'Partially sent'), ('F', 'Failed')])),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('sent_on', models.DateTimeField(null=True)),
+                ('message', models.ForeignKey(related_name='batches', to='msgs.Message')),
+            ],
+            options={
+                'ordering': ('message', 'number'),
+            },
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='status',
+            field=models.CharField(help_text='Current status of this message', max_length=1, verbose_name='Status', choices=[('P', 'Pending'), ('S', 'Sent'), ('A', 'Partially sent'), ('F', 'Failed')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='messagebatch',
+            unique_together=set([('message', 'number')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0007_messagebatch'),
+    ]
+
+    operations = [
+        # Remove duplicate copies of messages before adding the unique index.
+        migrations.RunSQL(
+            "DELETE FROM msgs_inboxmessage AS a USING msgs_inboxmessage AS b "
+            "WHERE a.rapidpro_message_id = b.rapidpro_message_id AND a.id > b.id;",
+            migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='inboxmessage',
+            name='rapidpro_message_id',
+            field=models.IntegerField(unique=True),
+        ),
+    ]
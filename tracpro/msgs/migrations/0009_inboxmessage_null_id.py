@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0008_inboxmessage_unique_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='inboxmessage',
+            name='rapidpro_message_id',
+            field=models.IntegerField(unique=True, null=True),
+        ),
+    ]
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orgs', '0013_auto_20150715_1831'),
+        ('contacts', '0013_contact_search_indexes'),
+        ('msgs', '0009_inboxmessage_null_id'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='inboxmessage',
+            index_together=set([('contact', 'created_on')]),
+        ),
+        migrations.CreateModel(
+            name='InboxConversation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('text', models.CharField(max_length=640, null=True)),
+                ('direction', models.CharField(max_length=1, null=True)),
+                ('archived', models.BooleanField(default=False)),
+                ('created_on', models.DateTimeField(null=True)),
+                ('delivered_on', models.DateTimeField(null=True)),
+                ('sent_on', models.DateTimeField(null=True)),
+                ('message_count', models.PositiveIntegerField(default=0, verbose_name='Messages')),
+                ('unread_count', models.PositiveIntegerField(default=0, verbose_name='Unanswered')),
+                ('archived_count', models.PositiveIntegerField(default=0, verbose_name='Archived')),
+                ('contact', models.OneToOneField(related_name='inbox_conversation', to='contacts.Contact')),
+                ('latest_message', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, to='msgs.InboxMessage', null=True)),
+                ('org', models.ForeignKey(related_name='inbox_conversations', verbose_name='Organization', to='orgs.Org')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='inboxconversation',
+            index_together=set([
+                ('org', 'created_on'),
+                ('org', 'delivered_on'),
+                ('org', 'sent_on'),
+                ('org', 'text'),
+                ('org', 'message_count'),
+                ('org', 'unread_count'),
+            ]),
+        ),
+        # Summarize existing conversations.
+        migrations.RunSQL(
+            """
+            INSERT INTO msgs_inboxconversation (
+                contact_id, org_id, latest_message_id, text, direction, archived,
+                created_on, delivered_on, sent_on,
+                message_count, unread_count, archived_count)
+            SELECT DISTINCT ON (m.contact_id)
+                m.contact_id, m.org_id, m.id, m.text, m.direction, m.archived,
+                m.created_on, m.delivered_on, m.sent_on,
+                c.message_count, c.unread_count, c.archived_count
+            FROM msgs_inboxmessage m
+            INNER JOIN (
+                SELECT m.contact_id,
+                    COUNT(*) AS message_count,
+                    SUM(CASE WHEN m.direction = 'I'
+                             AND m.created_on > COALESCE(r.last_reply, '-infinity')
+                        THEN 1 ELSE 0 END) AS unread_count,
+                    SUM(CASE WHEN m.archived THEN 1 ELSE 0 END) AS archived_count
+                FROM msgs_inboxmessage m
+                INNER JOIN (
+                    SELECT contact_id,
+                        MAX(CASE WHEN direction = 'O' THEN created_on END) AS last_reply
+                    FROM msgs_inboxmessage
+                    GROUP BY contact_id
+                ) r ON r.contact_id = m.contact_id
+                GROUP BY m.contact_id
+            ) c ON c.contact_id = m.contact_id
+            ORDER BY m.contact_id, m.created_on DESC NULLS LAST, m.id DESC;
+            """,
+            "DELETE FROM msgs_inboxconversation;"),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """A full-text search vector of inbox messages, kept up to date by a trigger."""
+
+    dependencies = [
+        ('contacts', '0014_search_functions'),
+        ('msgs', '0010_inboxconversation'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "ALTER TABLE msgs_inboxmessage ADD COLUMN search_vector tsvector;",
+            "ALTER TABLE msgs_inboxmessage DROP COLUMN search_vector;"),
+        migrations.RunSQL(
+            "UPDATE msgs_inboxmessage AS m "
+            "SET search_vector = tracpro_search_vector(c.language, m.text) "
+            "FROM contacts_contact AS c WHERE c.id = m.contact_id;",
+            migrations.RunSQL.noop),
+        migrations.RunSQL(
+            "CREATE INDEX msgs_inboxmessage_search "
+            "ON msgs_inboxmessage USING gin (search_vector);",
+            "DROP INDEX msgs_inboxmessage_search;"),
+        migrations.RunSQL(
+            """
+            CREATE FUNCTION msgs_inboxmessage_search_vector() RETURNS trigger AS $$
+            BEGIN
+                NEW.search_vector := tracpro_search_vector(
+                    (SELECT language FROM contacts_contact WHERE id = NEW.contact_id), NEW.text);
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER msgs_inboxmessage_search_vector
+            BEFORE INSERT OR UPDATE OF text, contact_id ON msgs_inboxmessage
+            FOR EACH ROW EXECUTE PROCEDURE msgs_inboxmessage_search_vector();
+            """,
+            """
+            DROP TRIGGER msgs_inboxmessage_search_vector ON msgs_inboxmessage;
+            DROP FUNCTION msgs_inboxmessage_search_vector();
+            """),
+    ]
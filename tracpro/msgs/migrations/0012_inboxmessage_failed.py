@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0011_inboxmessage_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inboxmessage',
+            name='failed',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,15 +1,17 @@
 from __future__ import absolute_import, unicode_literals
 
 from django.conf import settings
-from django.db import models
+from django.contrib.postgres.fields import ArrayField
+from django.db import connection, models, transaction
 from django.db.models import Q
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 
 from tracpro.contacts.models import Contact
 from tracpro.polls.models import Response
+from tracpro.utils import bulk_update, text_search_where
 
-from .tasks import send_message
+from .tasks import resolve_message_recipients
 
 
 MESSAGE_MAX_LEN = 640
@@ -23,10 +25,12 @@ COHORT_CHOICES = ((COHORT_ALL, _("All participants")),
 
 STATUS_PENDING = 'P'
 STATUS_SENT = 'S'
+STATUS_PARTIAL = 'A'
 STATUS_FAILED = 'F'
 
 STATUS_CHOICES = ((STATUS_PENDING, _("Pending")),
                   (STATUS_SENT, _("Sent")),
+                  (STATUS_PARTIAL, _("Partially sent")),
                   (STATUS_FAILED, _("Failed")))
 
 
@@ -60,25 +64,55 @@ class Message(models.Model):
 
     @classmethod
     def create(cls, org, user, text, pollrun, cohort, region):
-
-        message = cls.objects.create(org=org, sent_by=user, text=text, pollrun=pollrun, cohort=cohort, region=region)
-
-        if cohort == COHORT_ALL:
-            responses = pollrun.get_responses(region)
-        elif cohort == COHORT_RESPONDENTS:
-            responses = pollrun.get_responses(region).filter(status=Response.STATUS_COMPLETE)
-        elif cohort == COHORT_NONRESPONDENTS:
-            responses = pollrun.get_responses(region).exclude(status=Response.STATUS_COMPLETE)
-        else:  # pragma: no cover
+        """Create a message to the cohort, which is resolved and sent by a task."""
+        if cohort not in dict(COHORT_CHOICES):  # pragma: no cover
             raise ValueError("Invalid cohort code: %s" % cohort)
+        if not pollrun.covers_region(region, include_subregions=True):
+            raise ValueError("Request for responses in region where poll wasn't conducted")
 
-        for contact in [r.contact for r in responses]:
-            message.recipients.add(contact)
+        message = cls.objects.create(org=org, sent_by=user, text=text, pollrun=pollrun,
+                                     cohort=cohort, region=region, status=STATUS_PENDING)
 
-        send_message.delay(message.pk)
+        resolve_message_recipients.delay(message.pk)
 
         return message
 
+    def get_cohort_responses(self):
+        responses = self.pollrun.get_responses(self.region)
+        if self.cohort == COHORT_RESPONDENTS:
+            responses = responses.filter(status=Response.STATUS_COMPLETE)
+        elif self.cohort == COHORT_NONRESPONDENTS:
+            responses = responses.exclude(status=Response.STATUS_COMPLETE)
+        return responses
+
+    def get_cohort_size(self):
+        """Return the number of contacts in the cohort."""
+        return self.get_cohort_responses().order_by().values('contact_id').distinct().count()
+
+    def add_cohort_recipients(self):
+        """Add the cohort's contacts as recipients, with a single INSERT ... SELECT.
+
+        Returns the number of recipients added.
+        """
+        contact_ids = self.get_cohort_responses().order_by().values('contact_id').distinct()
+        subquery, params = contact_ids.query.sql_with_params()
+
+        through = Message.recipients.through._meta
+        qn = connection.ops.quote_name
+        sql = (
+            "INSERT INTO {table} ({message}, {contact}) "
+            "SELECT %s, r.contact_id FROM ({subquery}) r "
+            "WHERE NOT EXISTS (SELECT 1 FROM {table} t "
+            "WHERE t.{message} = %s AND t.{contact} = r.contact_id)"
+        ).format(
+            table=qn(through.db_table),
+            message=qn(through.get_field('message').column),
+            contact=qn(through.get_field('contact').column),
+            subquery=subquery)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [self.pk] + list(params) + [self.pk])
+            return cursor.rowcount
+
     @classmethod
     def get_all(cls, org, regions=None):
         messages = cls.objects.filter(org=org)
@@ -88,7 +122,56 @@ class Message(models.Model):
         return messages.select_related('region')
 
     def as_json(self):
-        return dict(id=self.pk, recipients=self.recipients.count())
+        # Recipients are added in the background, so report the cohort size.
+        return dict(id=self.pk, status=self.status, recipients=self.get_cohort_size())
+
+    def create_batches(self, batch_size):
+        """Split the recipients into batches to be sent."""
+        uuids = list(self.recipients.order_by('pk').values_list('uuid', flat=True))
+        MessageBatch.objects.bulk_create([
+            MessageBatch(message=self, number=number, contact_uuids=uuids[start:start + batch_size],
+                         status=STATUS_PENDING)
+            for number, start in enumerate(range(0, len(uuids), batch_size), 1)])
+
+    def get_batch_counts(self):
+        """Return the number of batches of this message by status."""
+        counts = {status: 0 for status, label in STATUS_CHOICES}
+        counts.update(self.batches.values_list('status').annotate(count=models.Count('pk')))
+        return counts
+
+    def update_status(self):
+        """Set the status of this message from the status of its batches."""
+        counts = self.get_batch_counts()
+        if counts[STATUS_PENDING]:
+            self.status = STATUS_PENDING
+        elif counts[STATUS_FAILED] and counts[STATUS_SENT]:
+            self.status = STATUS_PARTIAL
+        elif counts[STATUS_FAILED]:
+            self.status = STATUS_FAILED
+        else:
+            self.status = STATUS_SENT
+        self.save(update_fields=('status',))
+
+
+class MessageBatch(models.Model):
+    """A part of a Message's recipients, sent with one broadcast."""
+
+    message = models.ForeignKey(Message, related_name='batches')
+
+    number = models.PositiveIntegerField()
+
+    contact_uuids = ArrayField(models.CharField(max_length=36))
+
+    status = models.CharField(max_length=1, verbose_name=_("Status"), choices=STATUS_CHOICES,
+                              help_text=_("Current status of this batch"))
+
+    attempts = models.PositiveIntegerField(default=0)
+
+    sent_on = models.DateTimeField(null=True)
+
+    class Meta:
+        ordering = ('message', 'number')
+        unique_together = ('message', 'number')
 
 
 @python_2_unicode_compatible
@@ -98,7 +181,8 @@ class InboxMessage(models.Model):
     """
     org = models.ForeignKey("orgs.Org", verbose_name=_("Organization"), related_name="inbox_messages")
 
-    rapidpro_message_id = models.IntegerField()
+    # Null for replies that have been sent but not yet fetched from RapidPro.
+    rapidpro_message_id = models.IntegerField(unique=True, null=True)
 
     contact = models.ForeignKey("contacts.Contact", related_name="inbox_messages")
 
@@ -114,6 +198,12 @@ class InboxMessage(models.Model):
 
     direction = models.CharField(max_length=1, null=True)
 
+    # Set for replies which could not be sent to RapidPro.
+    failed = models.BooleanField(default=False)
+
+    class Meta:
+        index_together = [('contact', 'created_on')]
+
     @classmethod
     def get_all(cls, org, regions=None):
         messages = cls.objects.filter(org=org)
@@ -121,5 +211,192 @@ class InboxMessage(models.Model):
             messages = messages.filter(contact__region__in=regions)
         return messages
 
+    @classmethod
+    def search(cls, org, text, regions=None, language=None):
+        """Inbox messages matching the search text, newest first.
+
+        The search_vector column is maintained by a database trigger.
+        """
+        where, params = text_search_where('msgs_inboxmessage.search_vector', text, language)
+        messages = cls.get_all(org, regions).extra(where=[where], params=params)
+        return messages.order_by('-pk')
+
+    def save(self, *args, **kwargs):
+        super(InboxMessage, self).save(*args, **kwargs)
+        InboxConversation.update_for_contacts([self.contact_id])
+
+    @classmethod
+    def save_from_temba(cls, org, temba_messages, contacts_by_uuid):
+        """Create or update inbox messages from RapidPro messages.
+
+        Existing messages are updated in bulk and new ones are created in
+        bulk, so the cost is a fixed number of queries per call. Replies
+        recorded locally when they were sent are matched to their RapidPro
+        message by contact and text. Messages whose contact is not in
+        contacts_by_uuid are skipped and returned.
+        Returns (created, updated, skipped).
+        """
+        fields = ('text', 'archived', 'created_on', 'delivered_on', 'sent_on', 'direction')
+        existing = dict(cls.objects.filter(
+            rapidpro_message_id__in=[m.id for m in temba_messages]).values_list(
+            'rapidpro_message_id', 'pk'))
+
+        unfetched = {}
+        unfetched_replies = cls.objects.filter(
+            org=org, rapidpro_message_id=None, direction='O', failed=False,
+            contact__in=contacts_by_uuid.values()).order_by('created_on')
+        for pk, contact_id, text in unfetched_replies.values_list('pk', 'contact', 'text'):
+            unfetched.setdefault((contact_id, text), []).append(pk)
+
+        new, rows, skipped, seen, contact_ids = [], [], [], set(), set()
+        for temba_message in temba_messages:
+            contact_id = contacts_by_uuid.get(temba_message.contact)
+            if contact_id is None:
+                skipped.append(temba_message)
+                continue
+            if temba_message.id in seen:
+                continue
+            seen.add(temba_message.id)
+            contact_ids.add(contact_id)
+            values = [getattr(temba_message, field) for field in fields]
+            pk = existing.get(temba_message.id)
+            if pk is None and temba_message.direction == 'O':
+                replies = unfetched.get((contact_id, temba_message.text))
+                pk = replies.pop(0) if replies else None
+            if pk is not None:
+                rows.append([pk, temba_message.id, org.pk, contact_id] + values)
+            else:
+                new.append(cls(
+                    org=org, rapidpro_message_id=temba_message.id, contact_id=contact_id,
+                    **dict(zip(fields, values))))
+
+        cls.objects.bulk_create(new)
+        updated = bulk_update(cls, ('rapidpro_message_id', 'org', 'contact') + fields, rows)
+        InboxConversation.update_for_contacts(contact_ids)
+        return len(new), updated, skipped
+
     def __str__(self):
         return self.text
+
+
+# Key of the transaction-level advisory locks, one per contact, held while a
+# contact's InboxConversation is recalculated.
+CONVERSATION_LOCK = 4127002
+
+# Summary of each contact's inbox messages: the latest message, the number of
+# messages, the number of incoming messages since the last reply and the
+# number of archived messages.
+CONVERSATION_SQL = """
+SELECT DISTINCT ON (m.contact_id)
+    m.contact_id, m.org_id, m.id, m.text, m.direction, m.archived,
+    m.created_on, m.delivered_on, m.sent_on,
+    c.message_count, c.unread_count, c.archived_count
+FROM msgs_inboxmessage m
+INNER JOIN (
+    SELECT m.contact_id,
+        COUNT(*) AS message_count,
+        SUM(CASE WHEN m.direction = 'I' AND m.created_on > COALESCE(r.last_reply, '-infinity')
+            THEN 1 ELSE 0 END) AS unread_count,
+        SUM(CASE WHEN m.archived THEN 1 ELSE 0 END) AS archived_count
+    FROM msgs_inboxmessage m
+    INNER JOIN (
+        SELECT contact_id, MAX(CASE WHEN direction = 'O' THEN created_on END) AS last_reply
+        FROM msgs_inboxmessage
+        WHERE contact_id = ANY(%s)
+        GROUP BY contact_id
+    ) r ON r.contact_id = m.contact_id
+    GROUP BY m.contact_id
+) c ON c.contact_id = m.contact_id
+ORDER BY m.contact_id, m.created_on DESC NULLS LAST, m.id DESC
+"""
+
+
+@python_2_unicode_compatible
+class InboxConversation(models.Model):
+    """
+    Summary of the inbox messages exchanged with a contact, kept up to date
+    as inbox messages are saved
+    """
+    org = models.ForeignKey("orgs.Org", verbose_name=_("Organization"), related_name="inbox_conversations")
+
+    contact = models.OneToOneField("contacts.Contact", related_name="inbox_conversation")
+
+    latest_message = models.ForeignKey(
+        InboxMessage, null=True, on_delete=models.SET_NULL, related_name='+')
+
+    # Fields of the latest message.
+    text = models.CharField(max_length=MESSAGE_MAX_LEN, null=True)
+
+    direction = models.CharField(max_length=1, null=True)
+
+    archived = models.BooleanField(default=False)
+
+    created_on = models.DateTimeField(null=True)
+
+    delivered_on = models.DateTimeField(null=True)
+
+    sent_on = models.DateTimeField(null=True)
+
+    message_count = models.PositiveIntegerField(default=0, verbose_name=_("Messages"))
+
+    unread_count = models.PositiveIntegerField(default=0, verbose_name=_("Unanswered"))
+
+    archived_count = models.PositiveIntegerField(default=0, verbose_name=_("Archived"))
+
+    class Meta:
+        # One index for each column the inbox can be sorted by.
+        index_together = [
+            ('org', 'created_on'),
+            ('org', 'delivered_on'),
+            ('org', 'sent_on'),
+            ('org', 'text'),
+            ('org', 'message_count'),
+            ('org', 'unread_count'),
+        ]
+
+    @classmethod
+    def get_all(cls, org, regions=None):
+        conversations = cls.objects.filter(org=org)
+        if regions is not None:
+            conversations = conversations.filter(contact__region__in=regions)
+        return conversations
+
+    @classmethod
+    @transaction.atomic
+    def update_for_contacts(cls, contact_ids):
+        """Recalculate the conversations of the given contacts."""
+        contact_ids = list(set(contact_ids))
+        if not contact_ids:
+            return
+
+        # Lock the contacts' conversations (in a consistent order, to avoid
+        # deadlocks) so that concurrent updates for the same contact can't
+        # both insert its conversation.
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_advisory_xact_lock(%s, ids.id) "
+                "FROM (SELECT unnest(%s::integer[]) AS id) ids",
+                [CONVERSATION_LOCK, sorted(contact_ids)])
+            cursor.execute(CONVERSATION_SQL, [contact_ids])
+            summaries = cursor.fetchall()
+
+        fields = ('org', 'latest_message', 'text', 'direction', 'archived', 'created_on',
+                  'delivered_on', 'sent_on', 'message_count', 'unread_count', 'archived_count')
+        attnames = [cls._meta.get_field(field).attname for field in fields]
+        existing = dict(cls.objects.filter(contact__in=contact_ids).values_list('contact', 'pk'))
+
+        new, rows = [], []
+        for summary in summaries:
+            contact_id, values = summary[0], list(summary[1:])
+            if contact_id in existing:
+                rows.append([existing.pop(contact_id)] + values)
+            else:
+                new.append(cls(contact_id=contact_id, **dict(zip(attnames, values))))
+
+        # Contacts which no longer have any messages.
+        cls.objects.filter(pk__in=existing.values()).delete()
+        cls.objects.bulk_create(new)
+        bulk_update(cls, fields, rows)
+
+    def __str__(self):
+        return self.text or ''
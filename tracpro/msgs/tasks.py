@@ -1,88 +1,216 @@
 from __future__ import unicode_literals
 
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
 from celery.utils.log import get_task_logger
+from dash.utils import datetime_to_ms
+from django_redis import get_redis_connection
 from djcelery_transactions import task
+from temba_client.utils import parse_iso8601, format_iso8601
 
 from tracpro.orgs_ext.tasks import OrgTask
 
 
 logger = get_task_logger(__name__)
 
+LAST_FETCHED_INBOX_TIME_KEY = 'org:%d:last_fetched_inbox_time'
+
+# Set while the org's recent inbox messages don't need to be fetched again.
+INBOX_REFETCHED_KEY = 'org:%d:inbox_refetched'
+
+# Messages are fetched by when they were created, so changes to messages that
+# have already been fetched (e.g. archiving) are only picked up when the
+# recent messages are fetched again. This is done once a day, for messages of
+# the last 30 days; changes to older messages are not picked up.
+INBOX_REFETCH_INTERVAL = 24 * 60 * 60
+INBOX_REFETCH_WINDOW = 30 * 24 * 60 * 60
+
+# Seconds for which messages from contacts that haven't been synced yet are
+# fetched again.
+INBOX_UNKNOWN_CONTACT_RETRY = 60 * 60
+
+# Seconds to wait after sending a reply before fetching it from RapidPro.
+INBOX_REPLY_FETCH_DELAY = 2
+
+# Seconds of a contact's messages to fetch when none have been fetched yet.
+INBOX_CONTACT_FETCH_WINDOW = 24 * 60 * 60
+
+
+@task
+def resolve_message_recipients(message_id):
+    """Add the recipients of a new cohort message, then send it."""
+    from .models import Message
+
+    message = Message.objects.select_related('pollrun', 'region').get(pk=message_id)
+    count = message.add_cohort_recipients()
+
+    logger.info("Added %d recipients to message %d" % (count, message.pk))
+
+    send_message.delay(message.pk)
+
+
+def send_broadcast(client, text, contact_uuids):
+    """Send a broadcast, retrying with exponential backoff.
+
+    Returns the number of attempts made and whether the broadcast was sent.
+    """
+    for attempt in range(1, settings.MESSAGE_SEND_RETRIES + 2):
+        try:
+            client.create_broadcast(text, contacts=contact_uuids)
+            return attempt, True
+        except Exception:
+            logger.warning("Broadcast attempt %d failed" % attempt, exc_info=1)
+            if attempt <= settings.MESSAGE_SEND_RETRIES:
+                time.sleep(settings.MESSAGE_SEND_RETRY_DELAY * 2 ** (attempt - 1))
+    return attempt, False
+
 
 @task
 def send_message(message_id):
+    """Send the message's pending and failed batches, several at a time."""
     from .models import Message, STATUS_SENT, STATUS_FAILED
 
     message = Message.objects.select_related('org').get(pk=message_id)
+    if not message.batches.exists():
+        message.create_batches(settings.MESSAGE_BATCH_SIZE)
+    batches = list(message.batches.exclude(status=STATUS_SENT))
 
     client = message.org.get_temba_client()
 
-    try:
-        client.create_broadcast(message.text, contacts=[c.uuid for c in message.recipients.all()])
+    def send(batch):
+        return send_broadcast(client, message.text, batch.contact_uuids)
 
-        message.status = STATUS_SENT
-        message.save(update_fields=('status',))
+    if batches:
+        # Only the API calls are made in the pool; batches are saved here.
+        pool = ThreadPool(min(settings.MESSAGE_SEND_CONCURRENCY, len(batches)))
+        try:
+            results = pool.map(send, batches)
+        finally:
+            pool.close()
+            pool.join()
 
-        logger.info("Sent message %d from user #%d" % (message.pk, message.sent_by.pk))
-    except Exception:
-        message.status = STATUS_FAILED
-        message.save(update_fields=('status',))
+        for batch, (attempts, sent) in zip(batches, results):
+            batch.attempts += attempts
+            batch.status = STATUS_SENT if sent else STATUS_FAILED
+            batch.sent_on = timezone.now() if sent else None
+            batch.save(update_fields=('attempts', 'status', 'sent_on'))
+            if not sent:
+                logger.error("Sending batch %d of message %d failed" % (batch.number, message.pk))
 
-        logger.error("Sending message %d failed" % message.pk, exc_info=1)
+    message.update_status()
+
+    logger.info("Sent message %d from user #%d (status %s)" % (
+        message.pk, message.sent_by_id, message.get_status_display()))
 
 
 @task
-def send_unsolicited_message(org, text, contact):
+def send_unsolicited_message(inbox_message_id):
+    """Send a reply recorded in the inbox, then fetch it back from RapidPro."""
+    from .models import InboxMessage
+
+    inbox_message = InboxMessage.objects.select_related('org', 'contact').get(pk=inbox_message_id)
+    contact = inbox_message.contact
 
-    client = org.get_temba_client()
+    client = inbox_message.org.get_temba_client()
 
     try:
-        client.create_broadcast(text, contacts=[contact.uuid])
+        client.create_broadcast(inbox_message.text, contacts=[contact.uuid])
 
         logger.info("Sent unsolicited message response to %s" % (contact.name))
     except Exception:
 
         logger.error("Error sending unsolicited message to %s failed" % (contact.name), exc_info=1)
+        inbox_message.failed = True
+        inbox_message.save(update_fields=['failed'])
+        return
+
+    # Allow the message to reach the server before fetching it.
+    fetch_contact_inbox_messages.apply_async(
+        (inbox_message.org_id, contact.pk), countdown=INBOX_REPLY_FETCH_DELAY)
+
+
+@task
+def fetch_contact_inbox_messages(org_id, contact_id):
+    """Fetch a single contact's recent inbox messages."""
+    from tracpro.contacts.models import Contact
+    from .models import InboxMessage
+
+    contact = Contact.objects.select_related('org').get(org=org_id, pk=contact_id)
+
+    newest_message = contact.inbox_messages.exclude(rapidpro_message_id=None)
+    newest_message = newest_message.order_by('-created_on').first()
+    if newest_message:
+        last_time = newest_message.created_on
+    else:
+        last_time = timezone.now() - timedelta(seconds=INBOX_CONTACT_FETCH_WINDOW)
+
+    client = contact.org.get_temba_client()
+    inbox_messages = client.get_messages(_types="I", contacts=[contact.uuid], after=last_time)
+
+    created, updated, _ = InboxMessage.save_from_temba(
+        contact.org, inbox_messages, {contact.uuid: contact.pk})
+
+    logger.info("Fetched %d new and updated inbox messages for contact #%d"
+                % (created + updated, contact.pk))
 
 
 @task
 class FetchOrgInboxMessages(OrgTask):
 
     def org_task(self, org):
-        from .models import InboxMessage
+        """
+        Fetches inbox messages created since the last fetch for the given org
+        and creates/updates local inbox messages. Once a day, the recent
+        messages are fetched again to pick up changes to them.
+        """
         from tracpro.contacts.models import Contact
+        from tracpro.orgs_ext.constants import TaskType
+        from .models import InboxMessage
 
         client = org.get_temba_client()
-
-        inbox_messages = client.get_messages(_types="I")
-
-        for inbox_message in inbox_messages:
-            contact = Contact.objects.filter(uuid=inbox_message.contact).first()
-            # If the contact sync task hasn't gotten this contact yet,
-            # don't get the message yet
-            if contact:
-                inbox_message_record = InboxMessage.objects.filter(
-                    rapidpro_message_id=inbox_message.id)
-                if inbox_message_record:
-                    inbox_message_record.update(
-                        org=org,
-                        contact=contact,
-                        text=inbox_message.text,
-                        archived=inbox_message.archived,
-                        created_on=inbox_message.created_on,
-                        delivered_on=inbox_message.delivered_on,
-                        sent_on=inbox_message.sent_on,
-                        direction=inbox_message.direction,
-                    )
-                else:
-                    InboxMessage.objects.create(
-                        org=org,
-                        rapidpro_message_id=inbox_message.id,
-                        contact=contact,
-                        text=inbox_message.text,
-                        archived=inbox_message.archived,
-                        created_on=inbox_message.created_on,
-                        delivered_on=inbox_message.delivered_on,
-                        sent_on=inbox_message.sent_on,
-                        direction=inbox_message.direction,
-                    )
+        redis_connection = get_redis_connection()
+        last_time_key = LAST_FETCHED_INBOX_TIME_KEY % org.pk
+        last_time = redis_connection.get(last_time_key)
+        until = timezone.now()
+
+        if last_time is not None:
+            last_time = parse_iso8601(last_time)
+        else:
+            newest_message = InboxMessage.objects.filter(org=org).exclude(rapidpro_message_id=None)
+            newest_message = newest_message.order_by('-created_on').first()
+            last_time = newest_message.created_on if newest_message else None
+
+        refetched_key = INBOX_REFETCHED_KEY % org.pk
+        if last_time is not None and not redis_connection.exists(refetched_key):
+            last_time = min(last_time, until - timedelta(seconds=INBOX_REFETCH_WINDOW))
+
+        inbox_messages = client.get_messages(_types="I", after=last_time, before=until)
+
+        uuids = set(inbox_message.contact for inbox_message in inbox_messages)
+        contacts_by_uuid = dict(Contact.objects.filter(org=org, uuid__in=uuids).values_list('uuid', 'pk'))
+
+        created, updated, skipped = InboxMessage.save_from_temba(org, inbox_messages, contacts_by_uuid)
+
+        # If the contact sync task hasn't gotten a message's contact yet, fetch
+        # the message again next time, unless it has been waiting too long.
+        next_time = until
+        if skipped:
+            oldest_skipped = min(inbox_message.created_on for inbox_message in skipped)
+            retry_from = until - timedelta(seconds=INBOX_UNKNOWN_CONTACT_RETRY)
+            next_time = max(min(oldest_skipped, until), retry_from)
+
+        logger.info("Fetched %d new and updated inbox messages for org #%d (since=%s, skipped=%d)"
+                    % (len(inbox_messages), org.id,
+                       format_iso8601(last_time) if last_time else 'Never', len(skipped)))
+
+        task_result = dict(time=datetime_to_ms(timezone.now()), counts=dict(
+            fetched=len(inbox_messages), created=created, updated=updated, skipped=len(skipped)))
+        org.set_task_result(TaskType.fetch_inbox_messages, task_result)
+
+        redis_connection.set(last_time_key, format_iso8601(next_time))
+        redis_connection.set(refetched_key, 1, ex=INBOX_REFETCH_INTERVAL, nx=True)
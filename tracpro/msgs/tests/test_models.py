@@ -1,12 +1,18 @@
 from __future__ import absolute_import, unicode_literals
 
+import datetime
+
 from django.test.utils import override_settings
 from django.utils import timezone
 
-from temba_client.types import Broadcast
+from django_redis import get_redis_connection
+
+from temba_client.types import Broadcast, Message as TembaMessage
 
 from tracpro.msgs.models import (
-    Message, COHORT_ALL, COHORT_RESPONDENTS, COHORT_NONRESPONDENTS)
+    InboxConversation, InboxMessage, Message, COHORT_ALL, COHORT_RESPONDENTS, COHORT_NONRESPONDENTS,
+    STATUS_FAILED, STATUS_PARTIAL, STATUS_PENDING, STATUS_SENT)
+from tracpro.msgs.tasks import INBOX_REFETCHED_KEY, FetchOrgInboxMessages, send_message
 from tracpro.polls.models import Response
 from tracpro.test import factories
 from tracpro.test.cases import TracProDataTest
@@ -50,7 +56,7 @@ class MessageTest(TracProDataTest):
                          [self.contact1, self.contact2, self.contact4])
         self.assertEqual(str(msg1), "Test #1")
 
-        self.assertEqual(msg1.as_json(), dict(id=msg1.pk, recipients=3))
+        self.assertEqual(msg1.as_json(), dict(id=msg1.pk, status=STATUS_PENDING, recipients=3))
 
         msg2 = Message.create(
             self.unicef, self.admin, "Test #1", pollrun1, COHORT_RESPONDENTS,
@@ -74,3 +80,131 @@ class MessageTest(TracProDataTest):
         self.assertEqual(msg4.region, self.region1)
         self.assertEqual(list(msg4.recipients.order_by('pk')),
                          [self.contact1, self.contact2])
+
+        # Recipients are only added once.
+        self.assertEqual(msg4.add_cohort_recipients(), 0)
+        self.assertEqual(msg4.recipients.count(), 2)
+
+    @override_settings(
+        CELERY_ALWAYS_EAGER=True,
+        CELERY_EAGER_PROPAGATES_EXCEPTIONS=True,
+        BROKER_BACKEND='memory',
+        MESSAGE_BATCH_SIZE=2,
+        MESSAGE_SEND_RETRIES=1,
+        MESSAGE_SEND_RETRY_DELAY=0,
+    )
+    def test_send_batches(self):
+        """Recipients are sent in batches, each with its own status."""
+        def create_broadcast(text, contacts):
+            if self.contact4.uuid in contacts:
+                raise Exception("Broadcast failed")
+            return Broadcast.create()
+        self.mock_temba_client.create_broadcast.side_effect = create_broadcast
+
+        pollrun1 = factories.UniversalPollRun(poll=self.poll1, conducted_on=timezone.now())
+        for contact in (self.contact1, self.contact2, self.contact4):
+            factories.Response(pollrun=pollrun1, contact=contact)
+
+        msg = Message.create(self.unicef, self.admin, "Test", pollrun1, COHORT_ALL, None)
+        msg.refresh_from_db()
+        self.assertEqual(msg.status, STATUS_PARTIAL)
+
+        batch1, batch2 = msg.batches.all()
+        self.assertEqual(batch1.contact_uuids, [self.contact1.uuid, self.contact2.uuid])
+        self.assertEqual((batch1.status, batch1.attempts), (STATUS_SENT, 1))
+        self.assertEqual(batch2.contact_uuids, [self.contact4.uuid])
+        self.assertEqual((batch2.status, batch2.attempts), (STATUS_FAILED, 2))
+
+        # Sending again only retries the failed batch.
+        self.mock_temba_client.create_broadcast.side_effect = None
+        send_message(msg.pk)
+        msg.refresh_from_db()
+        self.assertEqual(msg.status, STATUS_SENT)
+        self.assertEqual(self.mock_temba_client.create_broadcast.call_count, 4)
+
+
+class InboxMessageTest(TracProDataTest):
+
+    def test_fetch_incremental(self):
+        now = timezone.now()
+
+        def temba_message(id, contact, text):
+            return TembaMessage.create(
+                id=id, contact=contact, text=text, archived=False, created_on=now,
+                delivered_on=None, sent_on=None, direction='I')
+
+        self.mock_temba_client.get_messages.return_value = [
+            temba_message(101, 'C-001', "Hello"),
+            temba_message(102, 'C-002', "Hi"),
+            temba_message(103, 'C-999', "Not synced yet"),
+        ]
+        FetchOrgInboxMessages(self.unicef.pk)
+
+        self.assertEqual(
+            set(InboxMessage.objects.values_list('rapidpro_message_id', 'contact')),
+            set([(101, self.contact1.pk), (102, self.contact2.pk)]))
+
+        # Messages are only fetched since the last fetch, which is held back
+        # for the message whose contact wasn't known.
+        self.assertEqual(self.mock_temba_client.get_messages.call_args[1]['after'], None)
+        self.mock_temba_client.get_messages.return_value = [
+            temba_message(101, 'C-001', "Hello again"),
+            temba_message(104, 'C-001', "Bye"),
+        ]
+        FetchOrgInboxMessages(self.unicef.pk)
+        self.assertEqual(self.mock_temba_client.get_messages.call_args[1]['after'], now)
+
+        self.assertEqual(InboxMessage.objects.count(), 3)
+        self.assertEqual(InboxMessage.objects.get(rapidpro_message_id=101).text, "Hello again")
+        self.assertEqual(InboxMessage.objects.get(rapidpro_message_id=104).text, "Bye")
+
+    def test_fetch_refetch(self):
+        """Recent messages are fetched again once a day to pick up changes."""
+        now = timezone.now()
+        self.mock_temba_client.get_messages.return_value = [TembaMessage.create(
+            id=101, contact='C-001', text="Hello", archived=False, created_on=now,
+            delivered_on=None, sent_on=None, direction='I')]
+        FetchOrgInboxMessages(self.unicef.pk)
+
+        # Once the day has passed, messages of the last 30 days are fetched.
+        get_redis_connection().delete(INBOX_REFETCHED_KEY % self.unicef.pk)
+        self.mock_temba_client.get_messages.return_value = [TembaMessage.create(
+            id=101, contact='C-001', text="Hello", archived=True, created_on=now,
+            delivered_on=None, sent_on=None, direction='I')]
+        FetchOrgInboxMessages(self.unicef.pk)
+
+        after = self.mock_temba_client.get_messages.call_args[1]['after']
+        self.assertLess(after, now - datetime.timedelta(days=29))
+        self.assertTrue(InboxMessage.objects.get(rapidpro_message_id=101).archived)
+        self.assertEqual(InboxConversation.objects.get(contact=self.contact1).archived_count, 1)
+
+    def test_conversation(self):
+        now = timezone.now()
+
+        def create(text, direction, minutes, archived=False):
+            return InboxMessage.objects.create(
+                org=self.unicef, contact=self.contact1, text=text, direction=direction,
+                archived=archived, created_on=now + datetime.timedelta(minutes=minutes))
+
+        create("Hello", 'I', 0, archived=True)
+        create("Hi, how can we help?", 'O', 1)
+        create("Our pump is broken", 'I', 2)
+        latest = create("Please send someone", 'I', 3)
+
+        conversation = InboxConversation.objects.get(contact=self.contact1)
+        self.assertEqual(conversation.latest_message, latest)
+        self.assertEqual(conversation.text, "Please send someone")
+        self.assertEqual(conversation.created_on, latest.created_on)
+        self.assertEqual(conversation.message_count, 4)
+        self.assertEqual(conversation.unread_count, 2)
+        self.assertEqual(conversation.archived_count, 1)
+
+        # A reply answers the incoming messages.
+        create("On our way", 'O', 4)
+        conversation = InboxConversation.objects.get(contact=self.contact1)
+        self.assertEqual(conversation.message_count, 5)
+        self.assertEqual(conversation.unread_count, 0)
+
+        self.contact1.inbox_messages.all().delete()
+        InboxConversation.update_for_contacts([self.contact1.pk])
+        self.assertFalse(InboxConversation.objects.filter(contact=self.contact1).exists())
@@ -1,5 +1,9 @@
 from __future__ import absolute_import, unicode_literals
 
+import json
+
+from temba_client.types import Broadcast, Message as TembaMessage
+
 from django.core.urlresolvers import reverse
 from django.utils import timezone
 
@@ -77,9 +81,16 @@ class InboxMessageCRUDLTest(TracProDataTest):
     def test_list(self):
         url = reverse('msgs.inboxmessage_list')
 
-        # Only the most recent message related per contact should display
+        # Only the most recent message related per contact should display,
+        # most recent first
         response = self.url_get('unicef', url)
-        self.assertEqual(list(response.context['object_list']),
+        conversations = response.context['object_list']
+        self.assertEqual([c.latest_message for c in conversations],
+                         [self.inboxmsg3, self.inboxmsg2])
+        self.assertEqual([c.message_count for c in conversations], [1, 2])
+
+        response = self.url_get('unicef', url, {'_order': 'text'})
+        self.assertEqual([c.latest_message for c in response.context['object_list']],
                          [self.inboxmsg2, self.inboxmsg3])
 
     def test_conversation(self):
@@ -89,3 +100,63 @@ class InboxMessageCRUDLTest(TracProDataTest):
         response = self.url_get('unicef', url)
         self.assertEqual(list(response.context['object_list']),
                          [self.inboxmsg2, self.inboxmsg1])
+
+    def test_conversation_reply(self):
+        url = reverse('msgs.inboxmessage_conversation', args=[self.contact1.pk])
+        latest_url = reverse('msgs.inboxmessage_latest', args=[self.contact1.pk])
+
+        self.mock_temba_client.create_broadcast.return_value = Broadcast.create()
+        self.mock_temba_client.get_messages.return_value = [TembaMessage.create(
+            id=9999, contact='C-001', text="Thanks!", archived=False,
+            created_on=timezone.now(), delivered_on=None, sent_on=None, direction='O')]
+
+        response = self.url_post('unicef', url, {'text': "Thanks!"})
+        self.assertRedirects(response, 'http://unicef.testserver%s' % url,
+                             fetch_redirect_response=False)
+
+        # The reply is recorded and then matched to the fetched message.
+        reply = InboxMessage.objects.get(text="Thanks!")
+        self.assertEqual(reply.rapidpro_message_id, 9999)
+        self.assertEqual(reply.direction, 'O')
+        self.assertEqual(self.mock_temba_client.create_broadcast.call_count, 1)
+        self.assertEqual(
+            self.mock_temba_client.get_messages.call_args[1]['contacts'], ['C-001'])
+
+        response = self.url_get('unicef', latest_url, {'after': self.inboxmsg2.pk})
+        data = json.loads(response.content)
+        self.assertEqual([m['id'] for m in data['results']], [reply.pk])
+        self.assertEqual(data['unfetched'], 0)
+
+    def test_conversation_reply_failed(self):
+        url = reverse('msgs.inboxmessage_conversation', args=[self.contact1.pk])
+
+        self.mock_temba_client.create_broadcast.side_effect = Exception("Unable to send")
+
+        self.url_post('unicef', url, {'text': "Thanks!"})
+
+        # The reply is marked as failed and is no longer waiting to be fetched.
+        reply = InboxMessage.objects.get(text="Thanks!")
+        self.assertTrue(reply.failed)
+        self.assertEqual(self.mock_temba_client.get_messages.call_count, 0)
+
+        response = self.url_get('unicef', url)
+        self.assertEqual(response.context['unfetched'], 0)
+        self.assertContains(response, "Failed to send")
+
+    def test_search(self):
+        url = reverse('msgs.inboxmessage_search')
+
+        response = self.url_get('unicef', url, {'search': "messages"})
+        data = json.loads(response.content)
+        self.assertEqual([m['id'] for m in data['results']],
+                         [self.inboxmsg3.pk, self.inboxmsg2.pk, self.inboxmsg1.pk])
+        self.assertIsNone(data['next'])
+
+        response = self.url_get('unicef', url, {'search': "recent contact1"})
+        data = json.loads(response.content)
+        self.assertEqual([m['id'] for m in data['results']], [self.inboxmsg2.pk])
+
+        # Results are paged by id.
+        response = self.url_get('unicef', url, {'search': "message", 'before': self.inboxmsg2.pk})
+        data = json.loads(response.content)
+        self.assertEqual([m['id'] for m in data['results']], [self.inboxmsg1.pk])
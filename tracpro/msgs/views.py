@@ -1,9 +1,10 @@
 from __future__ import absolute_import, unicode_literals
 import logging
-import time
 
 from django.core.urlresolvers import reverse
+from django.db.models import Max
 from django.http import JsonResponse
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.shortcuts import redirect, get_object_or_404
 
@@ -13,12 +14,13 @@ from dash.utils import get_obj_cacheable
 from smartmin.users.views import (
     SmartCRUDL, SmartListView, SmartCreateView, SmartReadView)
 
+from tracpro.contacts import languages
 from tracpro.contacts.models import Contact
 from tracpro.polls.models import PollRun
 
 from .forms import InboxMessageResponseForm
-from .models import Message, InboxMessage
-from .tasks import send_unsolicited_message, FetchOrgInboxMessages
+from .models import Message, InboxConversation, InboxMessage
+from .tasks import send_unsolicited_message
 
 
 logger = logging.getLogger(__name__)
@@ -39,6 +41,9 @@ class MessageListMixin(object):
     def get_region(self, obj):
         return obj.region if obj.region else _("All")
 
+    def get_status(self, obj):
+        return obj.get_status_display()
+
     def lookup_field_link(self, context, field, obj):
         if field == 'pollrun':
             return reverse('polls.pollrun_read', args=[obj.pollrun.pk])
@@ -61,11 +66,11 @@ class MessageCRUDL(SmartCRUDL):
             return JsonResponse(msg.as_json())
 
     class List(OrgPermsMixin, MessageListMixin, SmartListView):
-        fields = ('sent_on', 'sent_by', 'pollrun', 'cohort', 'region', 'text')
+        fields = ('sent_on', 'sent_by', 'pollrun', 'cohort', 'region', 'text', 'status')
         title = _("Message Log")
 
         def derive_queryset(self, **kwargs):
-            return Message.get_all(self.request.org, self.request.data_regions)
+            return Message.get_all(self.request.org, self.request.data_region_ids)
 
         def lookup_field_link(self, context, field, obj):
             return super(MessageCRUDL.List, self).lookup_field_link(context, field, obj)
@@ -100,39 +105,21 @@ class MessageCRUDL(SmartCRUDL):
 
 
 class InboxMessageCRUDL(SmartCRUDL):
-    actions = ('read', 'list', 'conversation')
+    actions = ('read', 'list', 'conversation', 'latest', 'search')
     model = InboxMessage
 
     class List(OrgPermsMixin, SmartListView):
+        model = InboxConversation
         fields = (
             'contact', 'direction', 'text', 'archived', 'created_on',
-            'delivered_on', 'sent_on')
+            'delivered_on', 'sent_on', 'message_count', 'unread_count')
         link_fields = ('contact', 'text')
+        default_order = ('-created_on',)
         title = "Unsolicited message conversations by most recent message"
 
         def derive_queryset(self, **kwargs):
-            qs = InboxMessage.get_all(self.request.org, self.request.data_regions)
-            qs = qs.select_related('contact')
-
-            qs = qs.order_by('contact', '-created_on')
-            qs = qs.distinct('contact')
-
-            return qs
-
-        def order_queryset(self, qs):
-            """
-            Override the order_queryset() method from smartmin
-            This method errors because of the distinct('contact') filter
-            in derive_queryset so we needed to override it.
-            """
-            if '_order' in self.request.REQUEST:
-                order_by = self.request.REQUEST['_order']
-                # Only sort if order_by is a valid field in this object
-                if order_by.replace('-', '') in self.derive_fields():
-                    qs = InboxMessage.objects.filter(pk__in=qs.values('pk'))
-                    qs = qs.order_by(order_by)
-
-            return qs
+            qs = InboxConversation.get_all(self.request.org, self.request.data_region_ids)
+            return qs.select_related('contact')
 
         def lookup_field_link(self, context, field, obj):
             return reverse('msgs.inboxmessage_conversation', kwargs={
@@ -140,7 +127,7 @@ class InboxMessageCRUDL(SmartCRUDL):
             })
 
     class Conversation(OrgPermsMixin, SmartListView):
-        fields = ('text', 'direction', 'created_on')
+        fields = ('text', 'direction', 'created_on', 'status')
         title = "Conversation"
 
         def get_queryset(self, **kwargs):
@@ -161,23 +148,99 @@ class InboxMessageCRUDL(SmartCRUDL):
             context = super(InboxMessageCRUDL.Conversation, self).get_context_data(**kwargs)
             context['form'] = self.form
             context['contact'] = self.contact
+            context['latest_id'] = self.contact.inbox_messages.aggregate(latest=Max('pk'))['latest'] or 0
+            context['unfetched'] = self.contact.inbox_messages.filter(
+                rapidpro_message_id=None, failed=False).count()
             return context
 
+        def get_status(self, obj):
+            if obj.failed:
+                return _("Failed to send")
+            elif obj.rapidpro_message_id is None:
+                return _("Sending")
+            return ""
+
         def post(self, request, *args, **kwargs):
             if self.form.is_valid():
-                # Send the new inbox message through the temba task
-                send_unsolicited_message(self.request.org, request.POST.get('text'), self.contact)
+                # Record the reply now and send it in the background. It is
+                # matched to its RapidPro message when that is fetched.
+                inbox_message = InboxMessage.objects.create(
+                    org=self.request.org,
+                    contact=self.contact,
+                    text=self.form.cleaned_data['text'],
+                    direction='O',
+                    created_on=timezone.now(),
+                )
+                send_unsolicited_message.delay(inbox_message.pk)
                 logger.info("Sending a message to %s" % (self.contact))
-                # Wait 1 second to allow message to reach server then run the task
-                # to pull all inbox messages for this org into the
-                # local InboxMessage table
-                time.sleep(1)
-                FetchOrgInboxMessages(self.request.org.pk)
-                logger.info("Retrieving inbox messages for %s" % (self.request.org))
                 return redirect('msgs.inboxmessage_conversation', contact_id=self.contact.pk)
             else:
                 return self.get(request, *args, **kwargs)
 
+    class Latest(OrgPermsMixin, SmartListView):
+        """Messages in a conversation since the given message, as JSON.
+
+        Polled by the conversation page to pick up replies and messages
+        fetched in the background.
+        """
+
+        @classmethod
+        def derive_url_pattern(cls, path, action):
+            return r'^%s/%s/(?P<contact_id>\d+)/$' % (path, action)
+
+        def get(self, request, contact_id, *args, **kwargs):
+            regions = self.request.user.get_all_regions(self.request.org)
+            contact = get_object_or_404(Contact.objects.filter(region__in=regions), pk=contact_id)
+            try:
+                after = int(request.GET.get('after', 0))
+            except ValueError:
+                after = 0
+
+            messages = contact.inbox_messages.filter(pk__gt=after).order_by('created_on')
+            return JsonResponse({
+                'results': [{
+                    'id': message.pk,
+                    'text': message.text,
+                    'direction': message.direction,
+                    'created_on': message.created_on,
+                    'failed': message.failed,
+                } for message in messages],
+                'unfetched': contact.inbox_messages.filter(rapidpro_message_id=None, failed=False).count(),
+            })
+
+    class Search(OrgPermsMixin, SmartListView):
+        """Inbox messages matching the search text, as JSON.
+
+        Messages are returned newest first. The next page is requested by
+        passing the 'next' value of a page as 'before'.
+        """
+        max_results = 50
+
+        def get(self, request, *args, **kwargs):
+            text = self.request.GET.get('search', '')
+            before = self.request.GET.get('before', '')
+            results, next_id = [], None
+            if text.strip():
+                # Search the selected regions, or else all of the user's regions.
+                region_ids = self.request.data_region_ids
+                if region_ids is None:
+                    region_ids = self.request.user_region_ids
+                language = languages.get_code(getattr(request, 'LANGUAGE_CODE', None))
+                messages = InboxMessage.search(self.request.org, text, region_ids, language)
+                if before.isdigit():
+                    messages = messages.filter(pk__lt=before)
+                messages = list(messages.select_related('contact')[:self.max_results])
+                results = [{'id': m.pk, 'text': m.text, 'direction': m.direction,
+                            'created_on': m.created_on, 'contact': m.contact.name,
+                            'contact_id': m.contact_id} for m in messages]
+                if len(messages) == self.max_results:
+                    next_id = messages[-1].pk
+            return JsonResponse({
+                'count': len(results),
+                'results': results,
+                'next': next_id,
+            })
+
     class Read(OrgPermsMixin, SmartReadView):
 
         def derive_queryset(self, **kwargs):
@@ -4,3 +4,5 @@ from enum import Enum
 class TaskType(Enum):
     sync_contacts = 1
     fetch_runs = 2
+    push_contacts = 3
+    fetch_inbox_messages = 4
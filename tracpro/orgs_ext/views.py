@@ -8,6 +8,8 @@ from dash.utils import ms_to_datetime
 from smartmin.templatetags.smartmin import format_datetime
 from smartmin.views import SmartUpdateView
 
+from tracpro.contacts.tasks import get_contact_push_queue
+
 from . import constants
 from . import forms
 
@@ -33,7 +35,8 @@ class OrgExtCRUDL(OrgCRUDL):
 
     class Home(OrgCRUDL.Home):
         fields = ('name', 'timezone', 'api_token', 'last_contact_sync',
-                  'last_flow_run_fetch')
+                  'last_flow_run_fetch', 'contact_push_queue',
+                  'last_contact_push')
         field_config = {
             'api_token': {
                 'label': _("RapidPro API Token"),
@@ -65,6 +68,25 @@ class OrgExtCRUDL(OrgCRUDL):
             else:
                 return None
 
+        def get_contact_push_queue(self, obj):
+            depth, age = get_contact_push_queue(obj.pk)
+            if depth:
+                return "%d waiting (oldest %d seconds ago)" % (depth, age)
+            else:
+                return None
+
+        def get_last_contact_push(self, obj):
+            result = obj.get_task_result(constants.TaskType.push_contacts)
+            if result:
+                return "%s (%d pushed, %d failed, waited up to %d seconds)" % (
+                    format_datetime(ms_to_datetime(result['time'])),
+                    result['counts']['pushed'],
+                    result['counts']['failed'],
+                    result['latency'],
+                )
+            else:
+                return None
+
     class Edit(InferOrgMixin, OrgPermsMixin, SmartUpdateView):
         fields = ('name', 'timezone', 'contact_fields')
         form_class = forms.OrgExtForm
@@ -0,0 +1,203 @@
+from __future__ import absolute_import, unicode_literals
+
+import gzip
+import tempfile
+
+import pyarrow
+import pyarrow.parquet
+import unicodecsv
+
+from django.core.files import File
+from django.db import connection, transaction
+from django.utils import timezone
+
+from smartmin.templatetags.smartmin import format_datetime
+
+
+# Number of responses to load (along with their answers) at a time.
+EXPORT_CHUNK_SIZE = 1000
+
+# Number of answers to write in each Parquet row group.
+PARQUET_ROW_GROUP_SIZE = 50000
+
+# One row per answer, with the numeric value parsed in the database.
+PARQUET_ANSWERS_SQL = """
+    SELECT r.id, r.pollrun_id, pr.conducted_on, r.updated_on, r.status,
+           c.uuid, reg.name, grp.name, a.question_id, q.name,
+           a.value,
+           CASE WHEN a.value ~ '^\\s*-?[0-9]+(\\.[0-9]+)?\\s*$'
+                THEN CAST(a.value AS double precision) END,
+           a.category, a.submitted_on
+    FROM polls_answer a
+    INNER JOIN polls_response r ON r.id = a.response_id
+    INNER JOIN polls_pollrun pr ON pr.id = r.pollrun_id
+    INNER JOIN polls_question q ON q.id = a.question_id
+    INNER JOIN contacts_contact c ON c.id = r.contact_id
+    LEFT OUTER JOIN groups_region reg ON reg.id = r.region_id
+    LEFT OUTER JOIN groups_group grp ON grp.id = r.group_id
+    WHERE a.response_id IN ({responses})
+    ORDER BY a.response_id, q."order"
+"""
+
+
+def _chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_response_headers(questions):
+    """Return the header row for a response export."""
+    resp_headers = ['Date']
+    contact_headers = ['Name', 'URN', 'Region', 'Group']
+    question_headers = [q.name for q in questions]
+    return resp_headers + contact_headers + question_headers
+
+
+def iter_response_rows(responses, questions, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield an export row for each response.
+
+    Answers are loaded for a chunk of responses at a time, rather than with
+    a query per response.
+    """
+    from .models import Answer
+
+    # Region and group are those recorded on the response, not the contact's
+    # current ones.
+    responses = responses.select_related('contact', 'region', 'group')
+    for chunk in _chunked(responses.iterator(), chunk_size):
+        answers = Answer.objects.filter(response__in=[r.pk for r in chunk])
+        answers = answers.values_list('response', 'question', 'value')
+        values = {(r_id, q_id): value for r_id, q_id, value in answers}
+
+        for resp in chunk:
+            resp_cols = [format_datetime(resp.updated_on)]
+            contact_cols = [
+                resp.contact.name, resp.contact.urn,
+                resp.region, resp.group]
+            answer_cols = [values.get((resp.pk, q.pk)) or '' for q in questions]
+            yield resp_cols + contact_cols + answer_cols
+
+
+def write_responses_csv(out, responses, questions, progress=None):
+    """Write responses as CSV to a file-like object.
+
+    If given, progress is called with the number of rows written after each
+    chunk. Returns the total number of responses written.
+    """
+    writer = unicodecsv.writer(out)
+    writer.writerow(get_response_headers(questions))
+    count = 0
+    for count, row in enumerate(iter_response_rows(responses, questions), 1):
+        writer.writerow(row)
+        if progress and count % EXPORT_CHUNK_SIZE == 0:
+            progress(count)
+    return count
+
+
+def write_export(job):
+    """Write the file for an ExportJob and save it to the default storage."""
+    questions = list(job.poll.questions.active())
+    responses = job.get_responses()
+
+    timezone.activate(job.org.timezone)
+    try:
+        with tempfile.TemporaryFile() as tmp:
+            if job.file_format == job.FORMAT_PARQUET:
+                count = write_answers_parquet(tmp, responses, job.set_progress)
+            else:
+                if job.file_format == job.FORMAT_CSV_GZIP:
+                    out = gzip.GzipFile(fileobj=tmp, mode='wb')
+                else:
+                    out = tmp
+
+                count = write_responses_csv(out, responses, questions, job.set_progress)
+                if out is not tmp:
+                    out.close()  # Writes the gzip trailer; leaves tmp open.
+
+            tmp.seek(0)
+            job.file.save(job.get_filename(), File(tmp), save=False)
+    finally:
+        timezone.deactivate()
+
+    return count
+
+
+def _get_parquet_schema():
+    timestamp = pyarrow.timestamp('us', tz='UTC')
+    category = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    return pyarrow.schema([
+        ('response_id', pyarrow.int64()),
+        ('pollrun_id', pyarrow.int64()),
+        ('conducted_on', timestamp),
+        ('updated_on', timestamp),
+        ('status', category),
+        ('contact', pyarrow.string()),
+        ('region', category),
+        ('group', category),
+        ('question_id', pyarrow.int64()),
+        ('question', category),
+        ('value', pyarrow.string()),
+        ('value_numeric', pyarrow.float64()),
+        ('category', category),
+        ('submitted_on', timestamp),
+    ])
+
+
+def _iter_row_batches(sql, params, batch_size):
+    """Yield batches of rows from a server-side (named) cursor.
+
+    Only one batch of rows is held in memory at a time.
+    """
+    with transaction.atomic():
+        cursor = connection.connection.cursor(name='tracpro_export')
+        try:
+            cursor.itersize = batch_size
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+
+def write_answers_parquet(out, responses, progress=None,
+                          batch_size=PARQUET_ROW_GROUP_SIZE):
+    """Write answers to the responses as a typed Parquet file.
+
+    Each batch of rows from the database becomes one row group. Region,
+    group, question, status and category are dictionary-encoded.
+
+    Returns the number of answers written.
+    """
+    responses = responses.order_by().values('pk')
+    responses_sql, responses_params = responses.query.sql_with_params()
+    sql = PARQUET_ANSWERS_SQL.format(responses=responses_sql)
+
+    schema = _get_parquet_schema()
+    writer = pyarrow.parquet.ParquetWriter(out, schema)
+    count = 0
+    try:
+        for rows in _iter_row_batches(sql, responses_params, batch_size):
+            columns = list(zip(*rows))
+            arrays = []
+            for field, values in zip(schema, columns):
+                if pyarrow.types.is_dictionary(field.type):
+                    arrays.append(pyarrow.array(values, pyarrow.string()).dictionary_encode())
+                else:
+                    arrays.append(pyarrow.array(values, field.type))
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+            count += len(rows)
+            if progress:
+                progress(count)
+    finally:
+        writer.close()
+    return count
@@ -6,6 +6,8 @@ from django.utils.translation import ugettext_lazy as _
 
 from dash.utils import get_month_range
 
+from tracpro.contacts.models import DataField
+
 from . import models
 
 
@@ -98,7 +100,13 @@ class ChartFilterForm(forms.Form):
         for data_field in self.org.datafield_set.visible():
             field_name = 'contact_{}'.format(data_field.key)
             self.contact_fields.append((field_name, data_field))
-            self.base_fields[field_name] = forms.CharField(
+            if data_field.value_type == DataField.TYPE_NUMERIC:
+                field_type = forms.DecimalField
+            elif data_field.value_type == DataField.TYPE_DATETIME:
+                field_type = forms.DateField
+            else:
+                field_type = forms.CharField
+            self.base_fields[field_name] = field_type(
                 label='Contact: {}'.format(data_field.display_name),
                 required=False)
 
@@ -165,3 +173,25 @@ class ChartFilterForm(forms.Form):
                 self.cleaned_data['end_date'] = end_date
                 self.data['start_date'] = start_date
                 self.data['end_date'] = end_date
+
+
+class ExportJobForm(forms.Form):
+    """Request a background export of a poll's responses."""
+    poll = forms.ModelChoiceField(queryset=None)
+    file_format = forms.ChoiceField(
+        label=_("Format"), choices=models.ExportJob.FORMAT_CHOICES,
+        initial=models.ExportJob.FORMAT_CSV)
+    start_date = forms.DateField(label=_("Start date"), required=False)
+    end_date = forms.DateField(label=_("End date"), required=False)
+
+    def __init__(self, org, *args, **kwargs):
+        self.org = org
+        super(ExportJobForm, self).__init__(*args, **kwargs)
+        self.fields['poll'].queryset = models.Poll.objects.active().by_org(self.org)
+
+    def clean(self):
+        start_date = self.cleaned_data.get('start_date')
+        end_date = self.cleaned_data.get('end_date')
+        if start_date and end_date and start_date > end_date:
+            self.add_error('end_date', _("End date must be after start date."))
+        return self.cleaned_data
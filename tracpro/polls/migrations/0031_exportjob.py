@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('orgs', '0014_auto_20150722_1419'),
+        ('groups', '0005_auto_20150805_2050'),
+        ('polls', '0030_reset_question_types'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('file_format', models.CharField(default='csv', max_length=8, verbose_name='format', choices=[('csv', 'CSV'), ('csv.gz', 'CSV (gzip)')])),
+                ('include_subregions', models.BooleanField(default=True, verbose_name='include sub-regions')),
+                ('start_date', models.DateField(null=True, verbose_name='start date', blank=True)),
+                ('end_date', models.DateField(null=True, verbose_name='end date', blank=True)),
+                ('params_key', models.CharField(max_length=40, editable=False, db_index=True)),
+                ('data_version', models.CharField(max_length=64, editable=False)),
+                ('status', models.CharField(default='P', max_length=1, verbose_name='status', choices=[('P', 'Pending'), ('R', 'Running'), ('C', 'Complete'), ('F', 'Failed')])),
+                ('row_count', models.IntegerField(default=0, verbose_name='rows written')),
+                ('file', models.FileField(upload_to='exports', verbose_name='file', blank=True)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('completed_on', models.DateTimeField(null=True, blank=True)),
+                ('created_by', models.ForeignKey(related_name='export_jobs', to=settings.AUTH_USER_MODEL, null=True)),
+                ('org', models.ForeignKey(related_name='export_jobs', verbose_name='org', to='orgs.Org')),
+                ('poll', models.ForeignKey(related_name='export_jobs', verbose_name='poll', to='polls.Poll')),
+                ('region', models.ForeignKey(related_name='+', verbose_name='region', blank=True, to='groups.Region', null=True)),
+            ],
+        ),
+    ]
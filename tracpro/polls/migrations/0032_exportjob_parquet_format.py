@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0031_exportjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='exportjob',
+            name='file_format',
+            field=models.CharField(default='csv', max_length=8, verbose_name='format', choices=[('csv', 'CSV'), ('csv.gz', 'CSV (gzip)'), ('parquet', 'Parquet (one row per answer)')]),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """Record the contact's org, region and group on each response."""
+
+    dependencies = [
+        ('orgs', '0014_auto_20150722_1419'),
+        ('groups', '0005_auto_20150805_2050'),
+        ('contacts', '0012_contact_data_fields'),
+        ('polls', '0032_exportjob_parquet_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='response',
+            name='org',
+            field=models.ForeignKey(related_name='responses', verbose_name='Organization', to='orgs.Org', null=True),
+        ),
+        migrations.AddField(
+            model_name='response',
+            name='region',
+            field=models.ForeignKey(related_name='responses', verbose_name='Region', to='groups.Region', help_text='Region of the contact when this response was created', null=True),
+        ),
+        migrations.AddField(
+            model_name='response',
+            name='group',
+            field=models.ForeignKey(related_name='responses', verbose_name='Reporter group', to='groups.Group', help_text='Reporter group of the contact when this response was created', null=True),
+        ),
+        migrations.RunSQL(
+            "UPDATE polls_response r "
+            "SET org_id = c.org_id, region_id = c.region_id, group_id = c.group_id "
+            "FROM contacts_contact c "
+            "WHERE c.id = r.contact_id;",
+            migrations.RunSQL.noop),
+        migrations.AlterIndexTogether(
+            name='response',
+            index_together=set([('pollrun', 'region', 'status'), ('org', 'updated_on')]),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """A full-text search vector of answers, kept up to date by a trigger."""
+
+    dependencies = [
+        ('contacts', '0014_search_functions'),
+        ('polls', '0033_response_snapshot'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "ALTER TABLE polls_answer ADD COLUMN search_vector tsvector;",
+            "ALTER TABLE polls_answer DROP COLUMN search_vector;"),
+        migrations.RunSQL(
+            "UPDATE polls_answer AS a "
+            "SET search_vector = tracpro_search_vector(c.language, a.value) "
+            "FROM polls_response AS r, contacts_contact AS c "
+            "WHERE r.id = a.response_id AND c.id = r.contact_id;",
+            migrations.RunSQL.noop),
+        migrations.RunSQL(
+            "CREATE INDEX polls_answer_search "
+            "ON polls_answer USING gin (search_vector);",
+            "DROP INDEX polls_answer_search;"),
+        migrations.RunSQL(
+            """
+            CREATE FUNCTION polls_answer_search_vector() RETURNS trigger AS $$
+            BEGIN
+                NEW.search_vector := tracpro_search_vector(
+                    (SELECT c.language FROM polls_response AS r
+                     INNER JOIN contacts_contact AS c ON c.id = r.contact_id
+                     WHERE r.id = NEW.response_id), NEW.value);
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER polls_answer_search_vector
+            BEFORE INSERT OR UPDATE OF value, response_id ON polls_answer
+            FOR EACH ROW EXECUTE PROCEDURE polls_answer_search_vector();
+            """,
+            """
+            DROP TRIGGER polls_answer_search_vector ON polls_answer;
+            DROP FUNCTION polls_answer_search_vector();
+            """),
+    ]
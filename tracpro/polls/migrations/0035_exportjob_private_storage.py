@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import tracpro.polls.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0034_answer_search'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='exportjob',
+            name='file',
+            field=models.FileField(upload_to='exports', storage=tracpro.polls.storage.ExportStorage(), verbose_name='file', blank=True),
+        ),
+        # Files of completed exports were written to the public media root.
+        # Mark those jobs as failed so that the exports are written again.
+        migrations.RunSQL(
+            "UPDATE polls_exportjob SET status = 'F' WHERE status = 'C';",
+            migrations.RunSQL.noop),
+    ]
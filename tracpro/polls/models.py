@@ -1,8 +1,11 @@
 from __future__ import absolute_import, unicode_literals
 
 from collections import Counter, OrderedDict
+import datetime
 from decimal import Decimal, InvalidOperation
+import hashlib
 from itertools import chain, groupby
+import json
 from operator import itemgetter
 
 from dateutil.relativedelta import relativedelta
@@ -11,8 +14,9 @@ import pytz
 
 from django.conf import settings
 from django.core.cache import cache
+from django.core.urlresolvers import reverse
 from django.db import models, transaction
-from django.db.models import Q, Count
+from django.db.models import Q, Count, Max
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
@@ -20,8 +24,12 @@ from django.utils.translation import ugettext_lazy as _
 from dash.utils import get_cacheable, get_month_range
 
 from tracpro.contacts.models import Contact
+from tracpro.groups import leaderboards
+from tracpro.groups.models import Region
+from tracpro.utils import text_search_where
 
-from .tasks import pollrun_start
+from .storage import export_storage
+from .tasks import export_responses, pollrun_start
 from .utils import auto_range_categories, extract_words
 
 
@@ -148,6 +156,21 @@ class Poll(models.Model):
     def __str__(self):
         return self.name
 
+    def get_data_version(self):
+        """Return a value that changes whenever the poll's response data changes.
+
+        This includes changes to the responding contacts, whose details are
+        part of the data. The version is hashed to a fixed length.
+        """
+        responses = Response.objects.filter(pollrun__poll=self)
+        stats = responses.aggregate(
+            count=Count('pk'), last_updated=Max('updated_on'),
+            contact_modified=Max('contact__modified_on'))
+        last_updated = stats['last_updated'].isoformat() if stats['last_updated'] else ''
+        contact_modified = stats['contact_modified'].isoformat() if stats['contact_modified'] else ''
+        version = '{}:{}:{}'.format(stats['count'], last_updated, contact_modified)
+        return hashlib.sha1(version.encode('utf-8')).hexdigest()
+
     def get_flow_definition(self):
         """Retrieve extra metadata about the RapidPro flow."""
         if not hasattr(self, '_flow_definition'):
@@ -295,7 +318,7 @@ class PollRunQuerySet(models.QuerySet):
         q = Q(region=region)
 
         # Include PollRuns that include this region as a sub-region.
-        q |= Q(region__in=region.get_ancestors(),
+        q |= Q(region__in=region.get_ancestor_ids(),
                pollrun_type=PollRun.TYPE_PROPAGATED)
 
         # Include poll runs that weren't sent to a particular region.
@@ -303,7 +326,7 @@ class PollRunQuerySet(models.QuerySet):
 
         # Include PollRuns that were sent to the region's sub-regions.
         if include_subregions:
-            q |= Q(region__in=region.get_descendants())
+            q |= Q(region__in=list(region.get_descendant_ids()))
 
         return self.filter(q)
 
@@ -471,16 +494,17 @@ class PollRun(models.Model):
 
         if self.pollrun_type in (self.TYPE_UNIVERSAL, self.TYPE_SPOOFED):
             return True
+        tree = Region.get_tree(region.org_id)
         if self.pollrun_type == self.TYPE_REGIONAL:
             if include_subregions:
-                return region in self.region.get_ancestors()
+                return region.pk in tree.get_ancestor_ids(self.region_id)
             else:  # pragma: nocover
-                return region == self.region
+                return region.pk == self.region_id
         if self.pollrun_type == self.TYPE_PROPAGATED:
             if include_subregions:
-                return region in self.region.get_family()
+                return region.pk in tree.get_family_ids(self.region_id)
             else:
-                return region in self.region.get_descendants()
+                return region.pk in tree.get_descendant_ids(self.region_id)
 
     def get_answers_to(self, question, regions=None):
         """Return all answers from active responses to the question."""
@@ -490,7 +514,7 @@ class PollRun(models.Model):
             question=question,
         )
         if regions:
-            qs = qs.filter(response__contact__region__in=regions)
+            qs = qs.filter(response__region__in=regions)
         return qs.select_related('response__contact')
 
     def get_answer_auto_range_counts(self, question, regions=None):
@@ -534,10 +558,10 @@ class PollRun(models.Model):
         responses = self.responses.filter(is_active=True)
         if region:
             if include_subregions:
-                regions = region.get_descendants(include_self=True)
-                responses = responses.filter(contact__region__in=regions)
+                regions = region.get_descendant_ids(include_self=True)
+                responses = responses.filter(region__in=list(regions))
             else:
-                responses = responses.filter(contact__region=region)
+                responses = responses.filter(region=region)
         if not include_empty:
             responses = responses.exclude(status=Response.STATUS_EMPTY)
         return responses.select_related('contact')
@@ -582,6 +606,19 @@ class Response(models.Model):
 
     contact = models.ForeignKey('contacts.Contact', related_name='responses')
 
+    # The contact's org, region and group when the response was created.
+    org = models.ForeignKey(
+        'orgs.Org', null=True, verbose_name=_("Organization"), related_name='responses')
+
+    region = models.ForeignKey(
+        'groups.Region', null=True, verbose_name=_("Region"), related_name='responses',
+        help_text=_("Region of the contact when this response was created"))
+
+    group = models.ForeignKey(
+        'groups.Group', null=True, verbose_name=_("Reporter group"),
+        related_name='responses',
+        help_text=_("Reporter group of the contact when this response was created"))
+
     created_on = models.DateTimeField(
         help_text=_("When this response was created"))
 
@@ -596,6 +633,20 @@ class Response(models.Model):
         default=True,
         help_text=_("Whether this response is active"))
 
+    class Meta:
+        index_together = (
+            ('pollrun', 'region', 'status'),
+            ('org', 'updated_on'),
+        )
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.org_id is None:
+            # Snapshot the contact's current org, region and group.
+            self.org_id = self.contact.org_id
+            self.region_id = self.contact.region_id
+            self.group_id = self.contact.group_id
+        super(Response, self).save(*args, **kwargs)
+
     @classmethod
     def create_empty(cls, org, pollrun, run):
         """
@@ -605,7 +656,9 @@ class Response(models.Model):
         contact = Contact.get_or_fetch(org, uuid=run.contact)
 
         # de-activate any existing responses for this contact
-        pollrun.responses.filter(contact=contact).update(is_active=False)
+        retired = pollrun.responses.filter(contact=contact)
+        leaderboards.update(org.pk, removed=leaderboards.get_entries(retired))
+        retired.update(is_active=False)
 
         return Response.objects.create(
             flow_run_id=run.id, pollrun=pollrun, contact=contact,
@@ -619,7 +672,7 @@ class Response(models.Model):
         up-to-date with provided run, then it is updated. If the run doesn't
         match with an existing poll pollrun, it's assumed to be non-regional.
         """
-        response = Response.objects.filter(pollrun__poll__org=org, flow_run_id=run.id)
+        response = Response.objects.filter(org=org, flow_run_id=run.id)
         response = response.select_related('pollrun').first()
         run_updated_on = cls.get_run_updated_on(run)
 
@@ -644,6 +697,7 @@ class Response(models.Model):
             # clear existing answers which will be replaced
             response.answers.all().delete()
 
+            removed = [response.get_leaderboard_entry()]
             response.updated_on = run_updated_on
             response.status = status
             response.save(update_fields=('updated_on', 'status'))
@@ -656,7 +710,9 @@ class Response(models.Model):
             )
 
             # if contact has an older response for this pollrun, retire it
-            Response.objects.filter(pollrun=pollrun, contact=contact).update(is_active=False)
+            retired = Response.objects.filter(pollrun=pollrun, contact=contact)
+            removed = leaderboards.get_entries(retired)
+            retired.update(is_active=False)
 
             response = Response.objects.create(
                 flow_run_id=run.id, pollrun=pollrun, contact=contact,
@@ -664,6 +720,10 @@ class Response(models.Model):
                 status=status)
             response.is_new = True
 
+        # move this contact's counts on the most active leaderboards
+        leaderboards.update(
+            poll.org_id, added=[response.get_leaderboard_entry()], removed=removed)
+
         # organize values by ruleset UUID
         questions = poll.questions.active()
         valuesets_by_ruleset = {valueset.node: valueset for valueset in run.values}
@@ -687,6 +747,12 @@ class Response(models.Model):
 
         return response
 
+    def get_leaderboard_entry(self):
+        """Return this response's entry on the most active leaderboards."""
+        if not self.is_active or self.status == Response.STATUS_EMPTY:
+            return None
+        return (self.updated_on, self.region_id, self.group_id)
+
     @classmethod
     def get_run_updated_on(cls, run):
         # find the valueset with the latest time
@@ -700,6 +766,15 @@ class Response(models.Model):
 
 class AnswerQuerySet(models.QuerySet):
 
+    def search(self, text, language=None):
+        """Answers to open-ended questions matching the search text.
+
+        The search_vector column is maintained by a database trigger.
+        """
+        where, params = text_search_where('polls_answer.search_vector', text, language)
+        answers = self.filter(question__question_type=Question.TYPE_OPEN)
+        return answers.extra(where=[where], params=params)
+
     def word_counts(self):
         answers = self.values_list('value', 'response__contact__language')
         words = [extract_words(*a) for a in answers]
@@ -885,3 +960,171 @@ class Answer(models.Model):
         help_text=_("When this answer was submitted"))
 
     objects = AnswerManager()
+
+
+class ExportJobQuerySet(models.QuerySet):
+
+    def by_org(self, org):
+        return self.filter(org=org)
+
+    def by_user(self, org, user):
+        """Jobs that export data from regions the user has access to.
+
+        Only org admins may see exports of all regions.
+        """
+        jobs = self.by_org(org)
+        if not user.is_admin_for(org):
+            jobs = jobs.filter(region__in=user.get_all_regions(org))
+        return jobs
+
+
+class ExportJobManager(models.Manager.from_queryset(ExportJobQuerySet)):
+
+    def request_export(self, poll, user, file_format, region=None,
+                       include_subregions=True, start_date=None, end_date=None):
+        """Return a job to export the poll's responses, starting one if needed.
+
+        An identical request for the same version of the poll's data reuses
+        the existing job (and its file) rather than writing a new export.
+        """
+        params = [
+            poll.pk,
+            file_format,
+            region.pk if region else None,
+            include_subregions,
+            start_date.isoformat() if start_date else None,
+            end_date.isoformat() if end_date else None,
+        ]
+        params_key = hashlib.sha1(json.dumps(params).encode('utf-8')).hexdigest()
+        data_version = poll.get_data_version()
+
+        existing = self.filter(
+            poll=poll, params_key=params_key, data_version=data_version)
+        existing = existing.exclude(status=ExportJob.STATUS_FAILED)
+        existing = existing.order_by('-created_on').first()
+        if existing:
+            return existing
+
+        job = self.create(
+            org=poll.org, poll=poll, file_format=file_format, region=region,
+            include_subregions=include_subregions, start_date=start_date,
+            end_date=end_date, params_key=params_key,
+            data_version=data_version, created_by=user)
+        export_responses.delay(job.pk)
+        return job
+
+
+@python_2_unicode_compatible
+class ExportJob(models.Model):
+    """A background export of poll responses across poll runs."""
+
+    FORMAT_CSV = 'csv'
+    FORMAT_CSV_GZIP = 'csv.gz'
+    FORMAT_PARQUET = 'parquet'  # One typed row per answer.
+    FORMAT_CHOICES = (
+        (FORMAT_CSV, _("CSV")),
+        (FORMAT_CSV_GZIP, _("CSV (gzip)")),
+        (FORMAT_PARQUET, _("Parquet (one row per answer)")),
+    )
+
+    STATUS_PENDING = 'P'
+    STATUS_RUNNING = 'R'
+    STATUS_COMPLETE = 'C'
+    STATUS_FAILED = 'F'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, _("Pending")),
+        (STATUS_RUNNING, _("Running")),
+        (STATUS_COMPLETE, _("Complete")),
+        (STATUS_FAILED, _("Failed")),
+    )
+
+    org = models.ForeignKey(
+        'orgs.Org', related_name='export_jobs', verbose_name=_("org"))
+    poll = models.ForeignKey(
+        'polls.Poll', related_name='export_jobs', verbose_name=_("poll"))
+    file_format = models.CharField(
+        max_length=8, choices=FORMAT_CHOICES, default=FORMAT_CSV,
+        verbose_name=_("format"))
+
+    # Which responses to export.
+    region = models.ForeignKey(
+        'groups.Region', null=True, blank=True, related_name='+',
+        verbose_name=_("region"))
+    include_subregions = models.BooleanField(
+        default=True, verbose_name=_("include sub-regions"))
+    start_date = models.DateField(
+        null=True, blank=True, verbose_name=_("start date"))
+    end_date = models.DateField(
+        null=True, blank=True, verbose_name=_("end date"))
+
+    # Used to find an identical job for the current data.
+    params_key = models.CharField(max_length=40, db_index=True, editable=False)
+    data_version = models.CharField(max_length=64, editable=False)
+
+    status = models.CharField(
+        max_length=1, choices=STATUS_CHOICES, default=STATUS_PENDING,
+        verbose_name=_("status"))
+    row_count = models.IntegerField(
+        default=0, verbose_name=_("rows written"))
+    file = models.FileField(
+        upload_to='exports', storage=export_storage, blank=True, verbose_name=_("file"))
+
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, related_name='export_jobs')
+    created_on = models.DateTimeField(auto_now_add=True)
+    completed_on = models.DateTimeField(null=True, blank=True)
+
+    objects = ExportJobManager()
+
+    def __str__(self):
+        return "{poll} ({when})".format(
+            poll=self.poll.name,
+            when=self.created_on.strftime(settings.SITE_DATE_FORMAT),
+        )
+
+    def as_json(self):
+        return {
+            'id': self.pk,
+            'poll': {
+                'id': self.poll_id,
+                'name': self.poll.name,
+            },
+            'status': self.status,
+            'row_count': self.row_count,
+            'url': reverse('polls.exportjob_download', args=[self.pk]) if self.is_complete() else None,
+        }
+
+    def get_filename(self):
+        return 'responses-{poll}-{job}.{ext}'.format(
+            poll=self.poll_id, job=self.pk, ext=self.file_format)
+
+    def get_responses(self):
+        """Return the active, non-empty responses covered by this export."""
+        responses = Response.objects.filter(pollrun__poll=self.poll, is_active=True)
+        responses = responses.exclude(status=Response.STATUS_EMPTY)
+        if self.region:
+            if self.include_subregions:
+                regions = self.region.get_descendant_ids(include_self=True)
+                responses = responses.filter(region__in=list(regions))
+            else:
+                responses = responses.filter(region=self.region)
+        # Dates are inclusive, and in the org's timezone.
+        org_timezone = pytz.timezone(self.org.timezone)
+        if self.start_date:
+            start = datetime.datetime.combine(self.start_date, datetime.time.min)
+            responses = responses.filter(pollrun__conducted_on__gte=org_timezone.localize(start))
+        if self.end_date:
+            end = datetime.datetime.combine(self.end_date + datetime.timedelta(days=1), datetime.time.min)
+            responses = responses.filter(pollrun__conducted_on__lt=org_timezone.localize(end))
+        return responses.order_by('pollrun__conducted_on', 'updated_on', 'pk')
+
+    def is_complete(self):
+        return self.status == self.STATUS_COMPLETE
+
+    def set_progress(self, row_count):
+        self.row_count = row_count
+        ExportJob.objects.filter(pk=self.pk).update(row_count=row_count)
+
+    def set_status(self, status):
+        self.status = status
+        ExportJob.objects.filter(pk=self.pk).update(status=status)
@@ -0,0 +1,20 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ExportStorage(FileSystemStorage):
+    """Storage for response exports, outside of the public media root.
+
+    Export files contain contact details, so they are only served through
+    ExportJobCRUDL.Download, which checks the user's access.
+    """
+
+    def __init__(self):
+        super(ExportStorage, self).__init__(location=settings.EXPORTS_ROOT)
+
+
+export_storage = ExportStorage()
@@ -39,7 +39,7 @@ class FetchOrgRuns(OrgTask):
         if last_time is not None:
             last_time = parse_iso8601(last_time)
         else:
-            newest_runs = Response.objects.filter(pollrun__poll__org=org).order_by('-created_on')
+            newest_runs = Response.objects.filter(org=org).order_by('-created_on')
             newest_runs = newest_runs.exclude(pollrun__pollrun_type=PollRun.TYPE_SPOOFED)
             newest_run = newest_runs.first()
             last_time = newest_run.created_on if newest_run else None
@@ -68,6 +68,30 @@ class FetchOrgRuns(OrgTask):
         redis_connection.set(last_time_key, format_iso8601(until))
 
 
+@task
+def export_responses(job_id):
+    """Write the file for an export job, recording progress on the job."""
+    from tracpro.polls.exports import write_export
+    from tracpro.polls.models import ExportJob
+
+    job = ExportJob.objects.select_related('org', 'poll').get(pk=job_id)
+    job.set_status(ExportJob.STATUS_RUNNING)
+
+    try:
+        row_count = write_export(job)
+    except Exception:
+        job.set_status(ExportJob.STATUS_FAILED)
+        logger.error("Export job #%d failed" % job.pk, exc_info=1)
+        return
+
+    job.row_count = row_count
+    job.status = ExportJob.STATUS_COMPLETE
+    job.completed_on = timezone.now()
+    job.save(update_fields=('file', 'row_count', 'status', 'completed_on'))
+
+    logger.info("Exported %d responses for export job #%d" % (row_count, job.pk))
+
+
 @task
 def pollrun_start(pollrun_id):
     """
@@ -85,15 +109,18 @@ def pollrun_start(pollrun_id):
 
     contacts = Contact.objects.active()
     if pollrun.pollrun_type == PollRun.TYPE_PROPAGATED:
-        descendants = pollrun.region.get_descendants(include_self=True)
-        contacts = contacts.filter(region__in=descendants)
+        descendants = pollrun.region.get_descendant_ids(include_self=True)
+        contacts = contacts.filter(region__in=list(descendants))
     elif pollrun.pollrun_type == PollRun.TYPE_REGIONAL:
         contacts = contacts.filter(region=pollrun.region)
     contact_uuids = list(contacts.values_list('uuid', flat=True))
 
     runs = client.create_runs(pollrun.poll.flow_uuid, contact_uuids, restart_participants=True)
     for run in runs:
-        Response.create_empty(org, pollrun, run)
+        try:
+            Response.create_empty(org, pollrun, run)
+        except ValueError as e:
+            logger.error("Unable to save run #%d due to error: %s" % (run.id, e.message))
 
     logger.info("Created %d new runs for new poll pollrun #%d" % (len(runs), pollrun.pk))
 
@@ -118,7 +145,10 @@ def pollrun_restart_participants(pollrun_id, contact_uuids):
 
     runs = client.create_runs(pollrun.poll.flow_uuid, contact_uuids, restart_participants=True)
     for run in runs:
-        Response.create_empty(org, pollrun, run)
+        try:
+            Response.create_empty(org, pollrun, run)
+        except ValueError as e:
+            logger.error("Unable to save run #%d due to error: %s" % (run.id, e.message))
 
     logger.info("Created %d restart runs for poll pollrun #%d" % (len(runs), pollrun.pk))
 
@@ -0,0 +1,247 @@
+from __future__ import absolute_import, unicode_literals
+
+import datetime
+import gzip
+
+import mock
+import pyarrow.parquet
+import pytz
+import unicodecsv
+
+from django.core.urlresolvers import reverse
+
+from tracpro.test.cases import TracProDataTest
+
+from .. import exports
+from ..models import ExportJob, Response
+from . import factories
+
+
+class ExportTestBase(TracProDataTest):
+
+    def setUp(self):
+        super(ExportTestBase, self).setUp()
+        date = datetime.datetime(2014, 1, 1, 7, tzinfo=pytz.UTC)
+        self.pollrun = factories.UniversalPollRun(poll=self.poll1, conducted_on=date)
+        self.response1 = factories.Response(
+            pollrun=self.pollrun, contact=self.contact1,
+            created_on=date, updated_on=date,
+            status=Response.STATUS_COMPLETE)
+        factories.Answer(
+            response=self.response1, question=self.poll1_question1,
+            value="5.0000", category="1 - 10", submitted_on=date)
+        factories.Answer(
+            response=self.response1, question=self.poll1_question2,
+            value="Sunny", category="All Responses", submitted_on=date)
+        self.response2 = factories.Response(
+            pollrun=self.pollrun, contact=self.contact4,
+            created_on=date, updated_on=date,
+            status=Response.STATUS_PARTIAL)
+        factories.Answer(
+            response=self.response2, question=self.poll1_question1,
+            value="6.0000", category="1 - 10", submitted_on=date)
+        factories.Response(
+            pollrun=self.pollrun, contact=self.contact5,
+            created_on=date, updated_on=date,
+            status=Response.STATUS_EMPTY)
+
+
+@mock.patch('tracpro.polls.models.export_responses.delay')
+class TestExportJobManager(ExportTestBase):
+
+    def test_request_export(self, mock_delay):
+        job = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV)
+        self.assertEqual(job.org, self.unicef)
+        self.assertEqual(job.status, ExportJob.STATUS_PENDING)
+        mock_delay.assert_called_once_with(job.pk)
+
+    def test_request_export__duplicate(self, mock_delay):
+        """An identical request should reuse the existing job."""
+        job1 = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV)
+        job2 = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV)
+        self.assertEqual(job1, job2)
+        self.assertEqual(mock_delay.call_count, 1)
+
+    def test_request_export__different_params(self, mock_delay):
+        job1 = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV)
+        job2 = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV_GZIP)
+        job3 = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV, region=self.region1)
+        self.assertEqual(len(set([job1.pk, job2.pk, job3.pk])), 3)
+
+    def test_request_export__data_changed(self, mock_delay):
+        """A new job should be started once the poll's data changes."""
+        job1 = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV)
+        factories.Response(
+            pollrun=self.pollrun, contact=self.contact2,
+            status=Response.STATUS_COMPLETE)
+        job2 = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV)
+        self.assertNotEqual(job1, job2)
+
+    def test_request_export__contact_changed(self, mock_delay):
+        """A new job should be started once a responding contact changes."""
+        job1 = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV)
+        self.contact1.name = "Annie"
+        self.contact1.save()
+        job2 = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV)
+        self.assertNotEqual(job1, job2)
+
+    def test_request_export__microseconds(self, mock_delay):
+        """The data version should fit its column for any response timestamps."""
+        date = datetime.datetime(2014, 1, 2, 7, 30, 15, 123456, tzinfo=pytz.UTC)
+        self.response1.updated_on = date
+        self.response1.save()
+        job = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV)
+        job.refresh_from_db()
+        self.assertEqual(job.data_version, self.poll1.get_data_version())
+        self.assertLessEqual(
+            len(job.data_version), ExportJob._meta.get_field('data_version').max_length)
+
+    def test_request_export__failed(self, mock_delay):
+        """A failed job should not be reused."""
+        job1 = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV)
+        job1.set_status(ExportJob.STATUS_FAILED)
+        job2 = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV)
+        self.assertNotEqual(job1, job2)
+
+
+@mock.patch('tracpro.polls.models.export_responses.delay')
+class TestWriteExport(ExportTestBase):
+
+    def read_rows(self, job):
+        job.file.open('rb')
+        try:
+            if job.file_format == ExportJob.FORMAT_CSV_GZIP:
+                return list(unicodecsv.reader(gzip.GzipFile(fileobj=job.file)))
+            return list(unicodecsv.reader(job.file))
+        finally:
+            job.file.close()
+
+    def test_write_export(self, mock_delay):
+        job = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV)
+        self.assertEqual(exports.write_export(job), 2)
+
+        rows = self.read_rows(job)
+        self.assertEqual(rows[0], [
+            'Date', 'Name', 'URN', 'Region', 'Group',
+            'Number of sheep', 'How is the weather?'])
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1][1:], [
+            'Ann', 'tel:1234', 'Kandahar', 'Farmers', '5.0000', 'Sunny'])
+        self.assertEqual(rows[2][1:], [
+            'Dan', 'twitter:danny', 'Khost', 'Teachers', '6.0000', ''])
+
+    def test_write_export__gzip_region(self, mock_delay):
+        job = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV_GZIP, region=self.region1)
+        self.assertEqual(exports.write_export(job), 1)
+
+        rows = self.read_rows(job)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][1], 'Ann')
+
+    def test_write_export__dates(self, mock_delay):
+        """The end date is included, in the org's timezone."""
+        job = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV,
+            start_date=datetime.date(2014, 1, 1), end_date=datetime.date(2014, 1, 1))
+        self.assertEqual(exports.write_export(job), 2)
+
+        job = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV,
+            start_date=datetime.date(2014, 1, 2))
+        self.assertEqual(exports.write_export(job), 0)
+
+    def test_write_export__moved_contact(self, mock_delay):
+        """Responses are exported with the region they were given in."""
+        self.contact1.region = self.region2
+        self.contact1.save()
+        job = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV)
+        exports.write_export(job)
+
+        rows = self.read_rows(job)
+        self.assertEqual(rows[1][1:5], ['Ann', 'tel:1234', 'Kandahar', 'Farmers'])
+
+    def test_write_export__parquet(self, mock_delay):
+        job = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_PARQUET)
+        self.assertEqual(exports.write_export(job), 3)
+
+        job.file.open('rb')
+        try:
+            table = pyarrow.parquet.read_table(job.file).to_pydict()
+        finally:
+            job.file.close()
+        self.assertEqual(table['contact'], ['C-001', 'C-001', 'C-004'])
+        self.assertEqual(table['region'], ['Kandahar', 'Kandahar', 'Khost'])
+        self.assertEqual(table['value'], ['5.0000', 'Sunny', '6.0000'])
+        self.assertEqual(table['value_numeric'], [5.0, None, 6.0])
+
+
+class TestExportJobCRUDL(ExportTestBase):
+
+    @mock.patch('tracpro.polls.models.export_responses.delay')
+    def test_create(self, mock_delay):
+        self.login(self.admin)
+        url = reverse('polls.exportjob_create')
+        response = self.url_post('unicef', url, {
+            'poll': self.poll1.pk,
+            'file_format': ExportJob.FORMAT_CSV_GZIP,
+        })
+        self.assertRedirects(response, reverse('polls.exportjob_list'), 'unicef')
+        job = ExportJob.objects.get()
+        self.assertEqual(job.poll, self.poll1)
+        self.assertEqual(job.file_format, ExportJob.FORMAT_CSV_GZIP)
+        mock_delay.assert_called_once_with(job.pk)
+
+    def test_create__other_org_poll(self):
+        self.login(self.admin)
+        url = reverse('polls.exportjob_create')
+        response = self.url_post('unicef', url, {
+            'poll': self.poll2.pk,
+            'file_format': ExportJob.FORMAT_CSV,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].has_error('poll'))
+        self.assertFalse(ExportJob.objects.exists())
+
+    @mock.patch('tracpro.polls.models.export_responses.delay')
+    def test_download(self, mock_delay):
+        job_all = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV)
+        job_region1 = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV, region=self.region1)
+        job_region3 = ExportJob.objects.request_export(
+            self.poll1, self.admin, ExportJob.FORMAT_CSV, region=self.region3)
+        for job in (job_all, job_region1, job_region3):
+            exports.write_export(job)
+
+        self.login(self.admin)
+        response = self.url_get('unicef', reverse('polls.exportjob_download', args=[job_all.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response['Content-Disposition'],
+            'attachment; filename="%s"' % job_all.get_filename())
+        self.assertIn('Ann', b''.join(response.streaming_content).decode('utf-8'))
+
+        # Users only see exports of their regions.
+        self.login(self.user1)
+        response = self.url_get('unicef', reverse('polls.exportjob_list'))
+        self.assertEqual(list(response.context['object_list']), [job_region1])
+        for job, status_code in ((job_all, 404), (job_region1, 200), (job_region3, 404)):
+            response = self.url_get('unicef', reverse('polls.exportjob_download', args=[job.pk]))
+            self.assertEqual(response.status_code, status_code)
@@ -788,6 +788,22 @@ class TestResponse(TracProDataTest):
         # same run if we call again
         self.assertEqual(Response.from_run(self.unicef, run), response5)
 
+    def test_snapshot(self):
+        """The contact's org, region and group are recorded at creation."""
+        pollrun = factories.UniversalPollRun(poll=self.poll1)
+        response = factories.Response(pollrun=pollrun, contact=self.contact1)
+        self.assertEqual(response.org, self.unicef)
+        self.assertEqual(response.region, self.region1)
+        self.assertEqual(response.group, self.group1)
+
+        # Moving the contact doesn't change where its past responses are counted.
+        self.contact1.region = self.region2
+        self.contact1.save()
+        response.refresh_from_db()
+        self.assertEqual(response.region, self.region1)
+        self.assertEqual(list(pollrun.get_responses(self.region1)), [response])
+        self.assertEqual(list(pollrun.get_responses(self.region2)), [])
+
 
 class TestAnswer(TracProDataTest):
 
@@ -816,6 +832,26 @@ class TestAnswer(TracProDataTest):
             value="rain", category=dict(eng="Yes"))
         self.assertEqual(answer3.category, "Yes")
 
+    def test_search(self):
+        pollrun = factories.UniversalPollRun(
+            poll=self.poll1, conducted_on=timezone.now())
+        response = factories.Response(pollrun=pollrun, contact=self.contact1)
+        answer1 = factories.Answer(
+            response=response, question=self.poll1_question2,
+            value="The pumps are broken", category=None)
+        factories.Answer(
+            response=response, question=self.poll1_question2,
+            value="All fine", category=None)
+        factories.Answer(
+            response=response, question=self.poll1_question1,
+            value="broken", category=None)
+
+        # Words are stemmed in the contact's language, and only answers to
+        # open-ended questions are searched.
+        self.assertEqual(list(Answer.objects.search("pump", 'eng')), [answer1])
+        self.assertEqual(list(Answer.objects.search("broken")), [answer1])
+        self.assertEqual(list(Answer.objects.search("rain")), [])
+
     def test_auto_range_counts(self):
         qs = Answer.objects.none()
         self.assertEqual(qs.auto_range_counts(), {})
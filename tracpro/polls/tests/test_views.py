@@ -26,6 +26,39 @@ class PollCRUDLTest(TracProDataTest):
         self.assertEqual(len(response.context['object_list']), 1)
 
 
+class PollRunCRUDLTest(TracProDataTest):
+
+    def test_read__moved_contact(self):
+        """Answers are charted in the region they were given in."""
+        date = datetime.datetime(2014, 1, 1, 7, tzinfo=pytz.UTC)
+        pollrun = factories.UniversalPollRun(poll=self.poll1, conducted_on=date)
+        response = factories.Response(
+            pollrun=pollrun, contact=self.contact1,
+            created_on=date, updated_on=date,
+            status=Response.STATUS_COMPLETE)
+        factories.Answer(
+            response=response, question=self.poll1_question1,
+            value="5.0000", category="1 - 10", submitted_on=date)
+
+        self.contact1.region = self.region2
+        self.contact1.save()
+
+        url = reverse('polls.pollrun_read', args=[pollrun.pk])
+        self.login(self.admin)
+
+        def get_chart_data():
+            response = self.url_get('unicef', url)
+            question = response.context['questions'][0]
+            self.assertEqual(question, self.poll1_question1)
+            return question.chart_data
+
+        self.switch_region(self.region1)
+        self.assertEqual(get_chart_data(), {'categories': ["1 - 10"], 'data': [1]})
+
+        self.switch_region(self.region2)
+        self.assertEqual(get_chart_data(), {'categories': [], 'data': []})
+
+
 class ResponseCRUDLTest(TracProDataTest):
 
     def setUp(self):
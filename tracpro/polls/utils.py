@@ -1,9 +1,10 @@
 import math
 import re
 
-import pycountry
 import stop_words
 
+from tracpro.contacts import languages
+
 
 def auto_range_categories(value_min, value_max):
     """
@@ -40,9 +41,9 @@ def extract_words(text, language):
     """
     ignore_words = []
     if language:
-        code = pycountry.languages.get(bibliographic=language).alpha2
+        code = languages.get_alpha2(language)
         try:
-            ignore_words = stop_words.get_stop_words(code)
+            ignore_words = stop_words.get_stop_words(code) if code else []
         except stop_words.StopWordError:
             pass
 
@@ -1,8 +1,8 @@
 from __future__ import absolute_import, unicode_literals
 
 from collections import OrderedDict
-
-import unicodecsv
+import shutil
+import tempfile
 
 from dash.orgs.views import OrgPermsMixin, OrgObjPermsMixin
 from dash.utils import get_obj_cacheable
@@ -12,18 +12,18 @@ from django.contrib import messages
 from django.core.urlresolvers import reverse
 from django.db.models import Q
 from django.http import (
-    HttpResponse, HttpResponseBadRequest, JsonResponse)
+    FileResponse, HttpResponse, HttpResponseBadRequest, JsonResponse)
 from django.shortcuts import get_object_or_404, redirect
 from django.utils.translation import ugettext_lazy as _
 
 from smartmin import views as smartmin
-from smartmin.templatetags.smartmin import format_datetime
 
+from tracpro.contacts import languages
 from tracpro.contacts.models import Contact
 from tracpro.groups.models import Group, Region
 
-from . import charts, forms, tasks
-from .models import Poll, Question, PollRun, Response
+from . import charts, exports, forms, tasks
+from .models import Answer, ExportJob, Poll, Question, PollRun, Response
 
 
 class PollCRUDL(smartmin.SmartCRUDL):
@@ -70,19 +70,23 @@ class PollCRUDL(smartmin.SmartCRUDL):
             return pollruns
 
         def get_answer_filters(self):
-            contacts = Contact.objects.filter(org=self.request.org)
+            filters = Q(response__is_active=True)
 
+            # Filter by the region recorded on each response.
             if self.request.region:
-                contacts = contacts.filter(region__in=self.request.data_regions)
+                filters &= Q(response__region__in=self.request.data_region_ids)
 
+            # Resolve each data field filter to a (cached) set of contact ids.
+            contact_ids = None
             for name, data_field in self.filter_form.contact_fields:
                 value = self.filter_form.cleaned_data.get(name)
-                if value:
-                    contacts = contacts.filter(
-                        contactfield__field=data_field,
-                        contactfield__value__icontains=value)
+                if value is not None and value != '':
+                    matching = Contact.objects.get_ids_matching_data_field(data_field, value)
+                    contact_ids = matching if contact_ids is None else contact_ids & matching
+            if contact_ids is not None:
+                filters &= Q(response__contact__in=contact_ids)
 
-            return Q(response__is_active=True) & Q(response__contact__in=contacts)
+            return filters
 
         def get_question_data(self):
             # Do not display any data if invalid data was submitted.
@@ -276,12 +280,13 @@ class PollRunCRUDL(smartmin.SmartCRUDL):
                 self.request.include_subregions)
 
         def get_answer_filters(self):
-            contacts = Contact.objects.filter(org=self.request.org)
+            filters = Q(response__is_active=True)
 
+            # Filter by the region recorded on each response.
             if self.request.region:
-                contacts = contacts.filter(region__in=self.request.data_regions)
+                filters &= Q(response__region__in=self.request.data_region_ids)
 
-            return Q(response__is_active=True) & Q(response__contact__in=contacts)
+            return filters
 
         def get_context_data(self, **kwargs):
             context = super(PollRunCRUDL.Read, self).get_context_data(**kwargs)
@@ -332,9 +337,9 @@ class PollRunCRUDL(smartmin.SmartCRUDL):
             # Calculate all reporter group or region activity per group or region
             for group_or_region in groups_or_regions:
                 if group_by_reporter_group:
-                    responses_group = responses.filter(contact__group=group_or_region)
+                    responses_group = responses.filter(group=group_or_region)
                 else:
-                    responses_group = responses.filter(contact__region=group_or_region)
+                    responses_group = responses.filter(region=group_or_region)
                 if responses_group:
                     per_group_counts[group_or_region] = {
                         "E": responses_group.filter(status=Response.STATUS_EMPTY).count(),
@@ -347,9 +352,9 @@ class PollRunCRUDL(smartmin.SmartCRUDL):
 
             # Calculate all no-group or no-region activity
             if group_by_reporter_group:
-                responses_no_group = responses.filter(contact__group__isnull=True)
+                responses_no_group = responses.filter(group__isnull=True)
             else:
-                responses_no_group = responses.filter(contact__region__isnull=True)
+                responses_no_group = responses.filter(region__isnull=True)
             if responses_no_group:
                 no_group_counts = {
                     "E": responses_no_group.filter(status=Response.STATUS_EMPTY).count(),
@@ -452,7 +457,7 @@ class PollRunCRUDL(smartmin.SmartCRUDL):
 
 class ResponseCRUDL(smartmin.SmartCRUDL):
     model = Response
-    actions = ('by_pollrun', 'by_contact')
+    actions = ('by_pollrun', 'by_contact', 'search')
 
     class ByPollrun(OrgPermsMixin, smartmin.SmartListView):
         default_order = ('-updated_on',)
@@ -461,6 +466,7 @@ class ResponseCRUDL(smartmin.SmartCRUDL):
 
         def dispatch(self, request, *args, **kwargs):
             self.csv = request.GET.get('_format') == 'csv'
+            self.parquet = request.GET.get('_format') == 'parquet'
             return super(ResponseCRUDL.ByPollrun, self).dispatch(
                 request, *args, **kwargs)
 
@@ -496,7 +502,7 @@ class ResponseCRUDL(smartmin.SmartCRUDL):
                 include_empty=False)
 
         def get_paginate_by(self, queryset):
-            if self.csv:
+            if self.csv or self.parquet:
                 return None
             return super(ResponseCRUDL.ByPollrun, self).get_paginate_by(queryset)
 
@@ -542,7 +548,7 @@ class ResponseCRUDL(smartmin.SmartCRUDL):
             pollrun = self.derive_pollrun()
             context['pollrun'] = pollrun
 
-            if not self.csv:
+            if not (self.csv or self.parquet):
                 # can only restart regional polls and if they're the last pollrun
                 can_restart = self.request.region and pollrun.is_last_for_region(
                     self.request.region)
@@ -567,29 +573,16 @@ class ResponseCRUDL(smartmin.SmartCRUDL):
             if self.csv:
                 response = HttpResponse(content_type='text/csv', status=200)
                 response['Content-Disposition'] = 'attachment; filename="responses.csv"'
-                writer = unicodecsv.writer(response)
-
                 questions = self.derive_questions().values()
-
-                resp_headers = ['Date']
-                contact_headers = ['Name', 'URN', 'Region', 'Group']
-                question_headers = [q.name for q in questions]
-                writer.writerow(resp_headers + contact_headers + question_headers)
-
-                for resp in context['object_list']:
-                    resp_cols = [format_datetime(resp.updated_on)]
-                    contact_cols = [
-                        resp.contact.name, resp.contact.urn,
-                        resp.contact.region, resp.contact.group]
-                    answer_cols = []
-
-                    answers_by_question_id = {a.question_id: a for a in resp.answers.all()}
-                    for question in questions:
-                        answer = answers_by_question_id.get(question.pk, None)
-                        answer_cols.append(answer.value if answer else '')
-
-                    writer.writerow(resp_cols + contact_cols + answer_cols)
-
+                exports.write_responses_csv(response, context['object_list'], questions)
+                return response
+            elif self.parquet:
+                response = HttpResponse(content_type='application/octet-stream', status=200)
+                response['Content-Disposition'] = 'attachment; filename="answers.parquet"'
+                with tempfile.TemporaryFile() as tmp:
+                    exports.write_answers_parquet(tmp, context['object_list'])
+                    tmp.seek(0)
+                    shutil.copyfileobj(tmp, response)
                 return response
             return super(ResponseCRUDL.ByPollrun, self).render_to_response(
                 context, **response_kwargs)
@@ -651,3 +644,131 @@ class ResponseCRUDL(smartmin.SmartCRUDL):
             context = super(ResponseCRUDL.ByContact, self).get_context_data(**kwargs)
             context['contact'] = self.derive_contact()
             return context
+
+    class Search(OrgPermsMixin, smartmin.SmartListView):
+        """Answers to open-ended questions matching the search text, as JSON.
+
+        Answers are returned newest first. The next page is requested by
+        passing the 'next' value of a page as 'before'.
+        """
+        max_results = 50
+
+        def get(self, request, *args, **kwargs):
+            text = self.request.GET.get('search', '')
+            before = self.request.GET.get('before', '')
+            results, next_id = [], None
+            if text.strip():
+                # Search the selected regions, or else all of the user's regions.
+                region_ids = self.request.data_region_ids
+                if region_ids is None:
+                    region_ids = self.request.user_region_ids
+                language = languages.get_code(getattr(request, 'LANGUAGE_CODE', None))
+                answers = Answer.objects.filter(
+                    response__org=self.request.org, response__region__in=region_ids,
+                    response__is_active=True)
+                answers = answers.search(text, language).order_by('-pk')
+                if before.isdigit():
+                    answers = answers.filter(pk__lt=before)
+                answers = answers.select_related('question__poll', 'response__contact')
+                answers = list(answers[:self.max_results])
+                results = [{'id': a.pk, 'value': a.value, 'submitted_on': a.submitted_on,
+                            'poll': a.question.poll.name, 'question': a.question.name,
+                            'contact': a.response.contact.name,
+                            'contact_id': a.response.contact_id} for a in answers]
+                if len(answers) == self.max_results:
+                    next_id = answers[-1].pk
+            return JsonResponse({
+                'count': len(results),
+                'results': results,
+                'next': next_id,
+            })
+
+
+class ExportJobCRUDL(smartmin.SmartCRUDL):
+    model = ExportJob
+    actions = ('create', 'read', 'list', 'download')
+
+    class Create(OrgPermsMixin, smartmin.SmartFormView):
+        form_class = forms.ExportJobForm
+        title = _("Export responses")
+        submit_button_name = _("Export")
+
+        def get_form_kwargs(self):
+            kwargs = super(ExportJobCRUDL.Create, self).get_form_kwargs()
+            kwargs['org'] = self.request.org
+            return kwargs
+
+        def form_valid(self, form):
+            request = self.request
+            if request.region is None and not request.user.is_admin_for(request.org):
+                form.add_error(None, _("Only administrators may export responses for all regions."))
+                return self.form_invalid(form)
+
+            job = ExportJob.objects.request_export(
+                poll=form.cleaned_data['poll'],
+                user=request.user,
+                file_format=form.cleaned_data['file_format'],
+                region=request.region,
+                include_subregions=request.include_subregions,
+                start_date=form.cleaned_data.get('start_date'),
+                end_date=form.cleaned_data.get('end_date'))
+
+            if request.is_ajax():
+                return JsonResponse(job.as_json())
+            messages.info(request, _("Your export has been started. The file "
+                                     "will be available here once it is ready."))
+            return redirect('polls.exportjob_list')
+
+        def form_invalid(self, form):
+            if self.request.is_ajax():
+                return JsonResponse({'errors': form.errors}, status=400)
+            return super(ExportJobCRUDL.Create, self).form_invalid(form)
+
+    class Read(OrgPermsMixin, smartmin.SmartReadView):
+
+        def get_queryset(self):
+            jobs = ExportJob.objects.by_user(self.request.org, self.request.user)
+            return jobs.select_related('poll')
+
+        def render_to_response(self, context, **response_kwargs):
+            return JsonResponse(self.object.as_json())
+
+    class Download(OrgPermsMixin, smartmin.SmartReadView):
+        """Serve the file of a completed export."""
+        content_types = {
+            ExportJob.FORMAT_CSV: 'text/csv',
+            ExportJob.FORMAT_CSV_GZIP: 'application/gzip',
+            ExportJob.FORMAT_PARQUET: 'application/octet-stream',
+        }
+
+        def get_queryset(self):
+            jobs = ExportJob.objects.by_user(self.request.org, self.request.user)
+            return jobs.filter(status=ExportJob.STATUS_COMPLETE)
+
+        def render_to_response(self, context, **response_kwargs):
+            job = self.object
+            job.file.open('rb')
+            response = FileResponse(job.file, content_type=self.content_types[job.file_format])
+            response['Content-Disposition'] = 'attachment; filename="%s"' % job.get_filename()
+            return response
+
+    class List(OrgPermsMixin, smartmin.SmartListView):
+        fields = ('created_on', 'poll', 'file_format', 'status', 'row_count', 'download')
+        default_order = ('-created_on',)
+        title = _("Exports")
+
+        def derive_queryset(self, **kwargs):
+            qs = ExportJob.objects.by_user(self.request.org, self.request.user)
+            return qs.select_related('poll')
+
+        def get_download(self, obj):
+            if obj.is_complete():
+                url = reverse('polls.exportjob_download', args=[obj.pk])
+                return '<a href="%s">%s</a>' % (url, _("Download"))
+            return ''
+
+        def get_file_format(self, obj):
+            return obj.get_file_format_display()
+
+        def get_status(self, obj):
+            return obj.get_status_display()
@@ -74,9 +74,11 @@ def _user_get_direct_regions(user, org):
 def _user_get_all_regions(user, org):
     """Return org regions user has direct or implied (by hierarchy) permission for."""
     def calculate():
-        regions = user.get_direct_regions(org).get_descendants(include_self=True)
-        regions = regions.filter(is_active=True)
-        return regions
+        tree = Region.get_tree(org.pk)
+        region_ids = set()
+        for region_id in user.get_direct_regions(org).values_list('pk', flat=True):
+            region_ids.update(tree.get_descendant_ids(region_id, include_self=True))
+        return Region.objects.filter(pk__in=region_ids, is_active=True)
     attr_name = '_regions_with_descendants_{}'.format(org.pk)  # cache per org
     return get_obj_cacheable(user, attr_name, calculate)
 
@@ -88,10 +90,10 @@ def _user_update_regions(user, regions):
     user.regions.clear()
     user.regions.add(*regions)
 
-    for org_name in set(region.org.name for region in regions):
+    for org_id in set(region.org_id for region in regions):
         for attr in ('_regions_with_descendants_{}', '_regions_{}'):
-            if hasattr(user, attr.format(org_name)):
-                delattr(user, attr.format(org_name))
+            if hasattr(user, attr.format(org_id)):
+                delattr(user, attr.format(org_id))
 
 
 def _user_has_region_access(user, region):
@@ -102,7 +104,7 @@ def _user_has_region_access(user, region):
     if user.is_superuser or user.is_admin_for(region.org):
         return True
     else:
-        pks = region.get_ancestors(include_self=True).values_list('pk')
+        pks = region.get_ancestor_ids(include_self=True)
         return user.regions.filter(pk__in=pks).exists()
 
 
@@ -50,6 +50,7 @@ INSTALLED_APPS = [
     'django.contrib.contenttypes',
     'django.contrib.humanize',
     'django.contrib.messages',
+    'django.contrib.postgres',
     'django.contrib.sessions',
     'django.contrib.sites',
     'django.contrib.staticfiles',
@@ -164,6 +165,10 @@ LOGOUT_URL = reverse_lazy('users.user_logout')
 
 MEDIA_ROOT = os.path.join(PROJECT_ROOT, 'public', 'media')
 
+# Response exports contain contact details, so they aren't kept under the
+# public MEDIA_ROOT.
+EXPORTS_ROOT = os.path.join(PROJECT_ROOT, 'exports')
+
 MEDIA_URL = "/media/"
 
 MIDDLEWARE_CLASSES = (
@@ -265,6 +270,7 @@ CELERYBEAT_SCHEDULE = {
     'sync-data-fields': _org_scheduler_task('tracpro.contacts.tasks.SyncOrgDataFields'),
     'fetch-runs': _org_scheduler_task('tracpro.polls.tasks.FetchOrgRuns'),
     'fetch-inbox-messages': _org_scheduler_task('tracpro.msgs.tasks.FetchOrgInboxMessages'),
+    'rebuild-leaderboards': _org_scheduler_task('tracpro.groups.tasks.RebuildOrgLeaderboards'),
 }
 
 COMPRESS_PRECOMPILERS = (
@@ -284,6 +290,7 @@ GROUP_PERMISSIONS = {
         'groups.region.*',
         'msgs.message.*',
         'msgs.inboxmessage.*',
+        'polls.exportjob.*',
         'polls.poll.*',
         'polls.pollrun.*',
         'polls.response.*',
@@ -297,6 +304,10 @@ GROUP_PERMISSIONS = {
         'msgs.inboxmessage.*',
         'msgs.message_send',
         'msgs.message_by_contact',
+        'polls.exportjob_create',
+        'polls.exportjob_download',
+        'polls.exportjob_read',
+        'polls.exportjob_list',
         'polls.poll_read',
         'polls.pollrun_create',
         'polls.pollrun_restart',
@@ -307,11 +318,20 @@ GROUP_PERMISSIONS = {
         'polls.pollrun_by_poll',
         'polls.response_by_contact',
         'polls.response_by_pollrun',
+        'polls.response_search',
         'profiles.profile_user_read',
     ),
     "Viewers": (),
 }
 
+# Broadcasts are sent to this many contacts per API call, with up to
+# MESSAGE_SEND_CONCURRENCY calls at once. Failed calls are retried with
+# exponential backoff.
+MESSAGE_BATCH_SIZE = 100
+MESSAGE_SEND_CONCURRENCY = 4
+MESSAGE_SEND_RETRIES = 3
+MESSAGE_SEND_RETRY_DELAY = 1  # seconds
+
 ORG_CONFIG_FIELDS = [
     {
         'name': 'available_languages',
@@ -339,14 +359,15 @@ PERMISSIONS = {
     ),
     'orgs.org': ('create', 'update', 'list', 'edit', 'home'),
     'baseline.baselineterm': ('create', 'read', 'update', 'delete', 'list', 'data_spoof', 'clear_spoof'),
-    'contacts.contact': ('create', 'read', 'update', 'delete', 'list'),
+    'contacts.contact': ('create', 'read', 'update', 'delete', 'list', 'search'),
     'groups.group': ('list', 'most_active', 'select'),
     'groups.region': ('list', 'most_active', 'select', 'update_hierarchy'),
     'msgs.message': ('list', 'send', 'by_contact'),
-    'msgs.inboxmessage': ('read', 'list', 'conversation'),
+    'msgs.inboxmessage': ('read', 'list', 'conversation', 'latest', 'search'),
+    'polls.exportjob': ('create', 'read', 'list', 'download'),
     'polls.poll': ('read', 'update', 'list', 'select'),
     'polls.pollrun': ('create', 'restart', 'read', 'participation', 'list', 'by_poll', 'latest'),
-    'polls.response': ('by_pollrun', 'by_contact'),
+    'polls.response': ('by_pollrun', 'by_contact', 'search'),
     # can't create profiles.user.* permissions because we don't own User
     'profiles.profile': ('user_create', 'user_read', 'user_update', 'user_list'),
 }
@@ -48,6 +48,8 @@ LOGGING['handlers']['file']['filename'] = os.path.join(WEBSERVER_ROOT, 'log', 't
 
 MEDIA_ROOT = os.path.join(WEBSERVER_ROOT, 'public', 'media')
 
+EXPORTS_ROOT = os.path.join(WEBSERVER_ROOT, 'exports')
+
 SECRET_KEY = os.environ.get('SECRET_KEY', '')
 
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'HTTPS')
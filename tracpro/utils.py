@@ -0,0 +1,77 @@
+from __future__ import absolute_import, unicode_literals
+
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import connection
+
+from tracpro.contacts.languages import get_search_config
+
+
+def bulk_update(model, fields, rows, batch_size=1000):
+    """Update the given fields for many rows of a model, in batches.
+
+    Each row is a tuple of the primary key followed by a value for each of
+    the fields. Rows are updated with a single UPDATE ... FROM (VALUES ...)
+    statement per batch, and rows whose values are unchanged are not
+    written. Returns the number of rows updated.
+
+    As with QuerySet.update(), save() is not called and no signals are sent.
+    """
+    opts = model._meta
+    qn = connection.ops.quote_name
+    columns = [opts.get_field(name).column for name in fields]
+    casts = [opts.get_field(name).db_type(connection) for name in fields]
+
+    row_sql = '({})'.format(', '.join(['%s'] * (len(fields) + 1)))
+    sql = (
+        "UPDATE {table} AS t SET {assignments} "
+        "FROM (VALUES {{values}}) AS v ({pk}, {columns}) "
+        "WHERE t.{pk} = v.{pk} AND ({changed})"
+    ).format(
+        table=qn(opts.db_table),
+        pk=qn(opts.pk.column),
+        columns=', '.join(qn(c) for c in columns),
+        assignments=', '.join(
+            '{0} = v.{0}::{1}'.format(qn(c), cast) for c, cast in zip(columns, casts)),
+        changed=' OR '.join(
+            't.{0} IS DISTINCT FROM v.{0}::{1}'.format(qn(c), cast)
+            for c, cast in zip(columns, casts)),
+    )
+
+    rows = list(rows)
+    count = 0
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            params = [value for row in batch for value in row]
+            cursor.execute(sql.format(values=', '.join([row_sql] * len(batch))), params)
+            count += cursor.rowcount
+    return count
+
+
+def get_version(key):
+    """Return the version token stored at the cache key, creating it if needed."""
+    version = cache.get(key)
+    if version is None:
+        version = uuid4().hex
+        if not cache.add(key, version, None):
+            version = cache.get(key)
+    return version
+
+
+def bump_version(key):
+    """Replace the version token stored at the cache key."""
+    cache.set(key, uuid4().hex, None)
+
+
+def text_search_where(column, text, language=None):
+    """Return SQL and params to match a search_vector column to the text.
+
+    The text is parsed with the 'simple' configuration, to match words as
+    they were written, and with the configuration for the language (an ISO
+    639-2 code), to also match other forms of the same words.
+    """
+    sql = ("{} @@ (plainto_tsquery('simple', %s) || "
+           "plainto_tsquery(%s::regconfig, %s))").format(column)
+    return sql, [text, get_search_config(language), text]